@@ -1,11 +1,37 @@
-from main import create_flask_app
-from flask.ext.sqlalchemy import SQLAlchemy
-from flask.ext.bcrypt import Bcrypt
+from threading import Lock
+
+from database import SQLAlchemy
 
 db = SQLAlchemy()
-flask_bcrypt = Bcrypt()
+# Created by get_bcrypt, Flask-Bcrypt imports bcrypt
+flask_bcrypt = None
+
+args = {'db':db}
+
+# The app is created on first use, importing the package builds nothing
+_app = None
+_app_lock = Lock()
+
+
+def create_flask_app(*args, **kwargs):
+    "See assentio.main.create_flask_app"
+    from main import create_flask_app
+    return create_flask_app(*args, **kwargs)
+
+
+def get_bcrypt():
+    "Return the Flask-Bcrypt object of the default app, creating it once"
+    global flask_bcrypt
+    if flask_bcrypt is None:
+        from flask.ext.bcrypt import Bcrypt
+        flask_bcrypt = Bcrypt()
+    return flask_bcrypt
 
-args = {'db':db,
-        'bcrypt':flask_bcrypt}
 
-app = create_flask_app(**args)
+def get_app():
+    "Return the default app, creating it on the first call"
+    global _app
+    with _app_lock:
+        if _app is None:
+            _app = create_flask_app(bcrypt=get_bcrypt(), **args)
+        return _app
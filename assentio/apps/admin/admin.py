@@ -1,16 +1,13 @@
-import os
 from flask.ext.admin import Admin
 
-from flask import Blueprint, send_from_directory
 from assentio import db
 from assentio.apps.login.models import User
 from assentio.apps.blog import Post, Page, SocialButton, TextPortlet
 from assentio.apps.blog.slots import PortletSlot
 
-from flask.ext.admin.contrib.fileadmin import FileAdmin
-
 from views import (MyIndexView, UnaccessibleModelView, PostModelView,
-                   PageModelView, SocialButtonView, PortletView)
+                   PageModelView, SocialButtonView, PortletView, StatsView,
+                   MediaFileAdmin)
 
 
 class AdminApp(object):
@@ -30,8 +27,6 @@ class AdminApp(object):
         if not self.app:
             self.app = app
 
-        self.__bp = Blueprint('admin_bp', __name__)
-
         admin = Admin(name=app_name,
                       index_view=MyIndexView(endpoint='adminview'))
         admin.init_app(self.app)
@@ -57,20 +52,10 @@ class AdminApp(object):
         admin.add_view(SocialButtonView(SocialButton, db.session,
                                                     category="Contents"))
 
-        # adding fileadmin view and creating the media path
-        media_path = os.path.join(self.app.instance_path, 'media')
-        if not os.path.exists(media_path):
-            os.mkdir(media_path)
-        admin.add_view(FileAdmin(media_path, '/media/', name='Files',
+        # adding fileadmin view of the media folder, see MediaFiles
+        media_path = self.app.extensions['media'].path
+        admin.add_view(MediaFileAdmin(media_path, '/media/', name='Files',
                                                     category='Blog'))
 
-        # TIP: In a production environment media folder should be served by the
-        # webserver itself or through a  CDN - as the static too
-        @self.__bp.route('/media/<path:filename>')
-        def media(filename):
-            # Only for testing purpose
-            if self.app.config.get('TESTING', None) and filename == 'anything':
-                return 'OK'
-            return send_from_directory(media_path, filename)
-
-        self.app.register_blueprint(self.__bp)
+        # adding the requests statistics view
+        admin.add_view(StatsView(name='Stats', endpoint='stats'))
@@ -3,8 +3,10 @@ from wtforms import fields as f, widgets as w
 from wtforms.ext.sqlalchemy.orm import converts
 from wtforms.ext.sqlalchemy.fields import QuerySelectField
 
-from flask.ext.admin import expose, AdminIndexView
+from flask import current_app
+from flask.ext.admin import expose, AdminIndexView, BaseView
 from flask.ext.admin.form import ChosenSelectWidget
+from flask.ext.admin.contrib.fileadmin import FileAdmin
 from flask.ext.admin.contrib.sqlamodel import ModelView
 from flask.ext.admin.contrib.sqlamodel.form import AdminModelConverter
 from flask.ext.login import current_user, login_required
@@ -20,6 +22,35 @@ class MyIndexView(AdminIndexView):
         return self.render('admin/index.html')
 
 
+class MediaFileAdmin(FileAdmin):
+    "Generate the derivatives of the uploaded images, see ImageDerivatives"
+
+    def save_file(self, path, file_data):
+        super(MediaFileAdmin, self).save_file(path, file_data)
+        images = current_app.extensions.get('images')
+        if images and images.enabled:
+            images.submit(path)
+
+
+class StatsView(BaseView):
+    "The per endpoint statistics, see InstrumentationMiddleware"
+
+    @expose('/')
+    def index(self):
+        instrumentation = current_app.extensions.get('instrumentation')
+        summary = instrumentation and instrumentation.summary() or []
+        hasher = current_app.extensions.get('password_hasher')
+        db = current_app.extensions['sqlalchemy'].db
+        pool = getattr(db, 'pool_stats', None)
+        return self.render('admin/stats.html', summary=summary,
+                           hashing=hasher and hasher.stats(),
+                           pool=pool and pool())
+
+    # Receive a 403 FORBIDDEN if not authenticated
+    def is_accessible(self):
+        return current_user.is_authenticated()
+
+
 # Adding coverter for the new Encrypted field
 @converts('Encrypted')
 def conv_Encrypted(self, field_args, **extra):
@@ -31,6 +62,8 @@ AdminModelConverter.conv_Encrypted = conv_Encrypted
 
 
 class UnaccessibleModelView(ModelView):
+    excluded_list_columns = ('_modified',)
+
     # Receive a 403 FORBIDDEN if not authenticated
     def is_accessible(self):
         return current_user.is_authenticated()
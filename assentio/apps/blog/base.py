@@ -1,17 +1,18 @@
-import os
-
+from flask import current_app
 from sqlalchemy.orm import validates
 from sqlalchemy.ext.declarative import declared_attr
 
 from assentio import db
-from assentio.utils import DBMixin, classproperty
+from assentio.utils import DBMixin, TimestampMixin, classproperty
 
 from .slots import PortletSlot
 
-template_folder = os.path.join(os.path.split(__file__)[0], 'templates')
 
+class BasePortlet(TimestampMixin, DBMixin):
+    # The template rendering the portlet, it must depend only on the portlet
+    # as the rendered html is cached
+    template = None
 
-class BasePortlet(DBMixin):
     id = db.Column(db.Integer, primary_key=True)
     state = db.Column(db.String(10), nullable=False, default='private')
     title = db.Column(db.String(120), nullable=False)
@@ -31,6 +32,12 @@ class BasePortlet(DBMixin):
     def __tablename__(cls):
         return cls.__name__.lower()
 
+    @declared_attr
+    def __table_args__(cls):
+        # Portlets are loaded by slot, filtered by state and sorted by order
+        return (db.Index('ix_%s_slot_state_order' % cls.__name__.lower(),
+                         'slot_id', 'state', 'order'),)
+
     @classproperty
     def type(cls):
         return cls.__name__.lower()
@@ -51,5 +58,8 @@ class BasePortlet(DBMixin):
         return '<%s "%s">' % (self.type, self.title)
 
     def get_template(self):
-        "Must return the rendered template portlet"
-        raise NotImplementedError
+        "Return the rendered template portlet"
+        if self.template is None:
+            raise NotImplementedError
+
+        return current_app.extensions['blog'].render_portlet(self)
@@ -1,13 +1,32 @@
 import os
+from hashlib import sha1
+from collections import namedtuple
 
-from flask import Blueprint
+from sqlalchemy import select, func, union_all
+from sqlalchemy.orm import joinedload, contains_eager
+from flask import Blueprint, g, has_request_context, render_template
+from flask.ext.sqlalchemy import models_committed
 from flask.ext.login import current_user
 
+from assentio import db
+from assentio.cache import MemoryCache
+from assentio.utils import get_pk, to_http_date
+
 from .models import Post, Page, SocialButton, post_types
 from .slots import PortletSlot
+from .base import BasePortlet
 from .portlets import TextPortlet
+from .feed import FeedCache
+from .pagination import KeysetPagination
+from .search import SearchIndex
+
+# Detached copies of the navigation contents, kept across requests
+CachedPage = namedtuple('CachedPage', 'id category order post')
+CachedPost = namedtuple('CachedPost', 'id title state')
+CachedButton = namedtuple('CachedButton', 'id name image url disabled')
 
-template_folder = os.path.join(os.path.split(__file__)[0], 'templates')
+template_folder = os.path.join(os.path.split(os.path.abspath(__file__))[0],
+                               'templates')
 blog_bp = Blueprint('blog', __name__, template_folder=template_folder)
 
 
@@ -32,8 +51,34 @@ class BlogApp(object):
 
         # Prepare the registry to store portlets and store the basics one
         self.app.extensions['blog_portlets'] = set()
+        self.portlet_classes = {}
         self.update_portlets(TextPortlet)
 
+        # The pre-serialized RSS feed, see FeedCache
+        self.app.config.setdefault('FEED_MAX_ITEMS', 20)
+        self.app.config.setdefault('FEED_PAGED', False)
+        self.app.config.setdefault('FEED_DIR', None)
+        self.app.config.setdefault('FEED_TIMEOUT', 300)
+        self.app.config.setdefault('FEED_URL_ROOT', None)
+        self.feed = FeedCache(self)
+
+        # The rendered portlets, see render_portlet
+        self.app.config.setdefault('PORTLET_CACHE_MAX_SIZE', 4 * 1024 * 1024)
+        self.app.config.setdefault('PORTLET_CACHE_TIMEOUT', 300)
+        self.portlets_cache = MemoryCache(
+                    self.app.config['PORTLET_CACHE_MAX_SIZE'],
+                    default_timeout=self.app.config['PORTLET_CACHE_TIMEOUT'])
+        models_committed.connect(self._invalidate_portlets, sender=self.app)
+
+        # The navigation pages and social buttons, see get_navigation
+        self.app.config.setdefault('NAVIGATION_CACHE_TIMEOUT', 300)
+        self.navigation_cache = MemoryCache(
+                default_timeout=self.app.config['NAVIGATION_CACHE_TIMEOUT'])
+
+        # The full-text search, see SearchIndex
+        self.app.config.setdefault('SEARCH_PER_PAGE', 10)
+        self.search_index = SearchIndex(self)
+
         self.app.register_blueprint(blog_bp)
 
     def update_portlets(self, portletclass):
@@ -41,6 +86,7 @@ class BlogApp(object):
           :param portletclass: is the portlet class you want to register
         """
         self.app.extensions['blog_portlets'].add(portletclass.type)
+        self.portlet_classes[portletclass.type] = portletclass
 
     def _get_posts(self, types=[], unrestricted=False, ordered=False):
         """Wrapped method which simply return posts
@@ -79,9 +125,13 @@ class BlogApp(object):
 
         pages = Page.query
 
-        # If anonymous user search only for published posts
+        # If anonymous user search only for published posts, the posts are
+        # loaded along with the pages in both cases
         if not current_user.is_authenticated() and not unrestricted:
-            pages = pages.join(Post).filter(Post.state == 'public')
+            pages = pages.join(Page.post).filter(Post.state == 'public')
+            pages = pages.options(contains_eager(Page.post))
+        else:
+            pages = pages.options(joinedload(Page.post))
 
         if ordered:
             pages = pages.order_by(Page.order)
@@ -106,38 +156,112 @@ class BlogApp(object):
 
         return btns
 
-    def get_portlets_by_slot(self, name, unrestricted=False, ordered=False):
-        "Return all the portlets related to a slot"
-        portlets = []
-        slot = PortletSlot.query.filter(PortletSlot.name == name)
+    def get_navigation(self):
+        """Return the (pages, social buttons) visible by the user, ordered.
+        They're detached copies kept across requests along with the stamps
+        of the components they were loaded with (see get_components_version)
+        so the commits of any worker are noticed"""
+        restricted = not current_user.is_authenticated()
+        key = 'restricted' if restricted else 'unrestricted'
+        version = self.get_components_version()
+
+        cached = self.navigation_cache.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        pages = [CachedPage(page.id, page.category, page.order,
+                            CachedPost(page.post.id, page.post.title,
+                                       page.post.state))
+                            for page in self.get_pages(ordered=True)]
+        buttons = [CachedButton(btn.id, btn.name, btn.image, btn.url,
+                                btn.disabled)
+                            for btn in self.get_social_buttons(ordered=True)]
+        navigation = (pages, buttons)
+        self.navigation_cache.set(key, (version, navigation))
+        return navigation
 
-        # The slot does not exist
-        if not slot.count():
+    def get_portlets_by_slot(self, name, unrestricted=False, ordered=False):
+        "Return all the portlets related to a slot, sorted by their order"
+        portlets = self.get_all_portlets(unrestricted=unrestricted)
+        return list(portlets.get(name, ()))
+
+    def get_all_portlets(self, unrestricted=False):
+        """Return the portlets of every slot, as {slot name: portlets}
+        ordered by the portlet order. They're loaded once per request, with
+        a query for the slots plus one for each portlet type"""
+        # If anonymous user search only for published portlets
+        restricted = not unrestricted and not current_user.is_authenticated()
+
+        if has_request_context():
+            loaded = g.__dict__.setdefault('_blog_portlets', {})
+            if restricted not in loaded:
+                loaded[restricted] = self._load_portlets(restricted)
+            return loaded[restricted]
+
+        return self._load_portlets(restricted)
+
+    def _load_portlets(self, restricted):
+        "Load the portlets of every slot"
+        slots = dict(db.session.query(PortletSlot.id, PortletSlot.name))
+        portlets = dict((name, []) for name in slots.values())
+
+        if not slots:
             return portlets
 
-        slot = slot[0]
+        for portlet_class in self.portlet_classes.values():
+            query = portlet_class.query.filter(
+                                    portlet_class.slot_id.in_(slots.keys()))
 
-        portlet_types = self.app.extensions['blog_portlets']
+            if restricted:
+                query = query.filter(portlet_class.state == 'public')
 
-        for ptype in portlet_types:
-            portlets.extend(getattr(slot, 'portlet_%s' % ptype))
+            for portlet in query.order_by(portlet_class.order):
+                portlets[slots[portlet.slot_id]].append(portlet)
 
-        # If anonymous user search only for published posts
-        if not current_user.is_authenticated() and not unrestricted:
-            portlets = filter(lambda x: x.state == 'public', portlets)
-
-        if ordered:
-            portlets.sort(key=lambda portlet: portlet.order)
+        # Each type is already ordered, merge them
+        for slot_portlets in portlets.values():
+            slot_portlets.sort(key=lambda portlet: portlet.order)
 
         return portlets
 
-    def get_all_page_components(self, post=None, page=None):
+    def render_portlet(self, portlet):
+        """Return the html of the portlet. Its template is compiled once by
+        the app jinja environment and the html is rendered once per portlet
+        version"""
+        key = '%s-%s' % (portlet.type, portlet.id)
+        version = portlet._modified
+
+        cached = self.portlets_cache.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        html = render_template(portlet.template, portlet=portlet)
+        self.portlets_cache.set(key, (version, html))
+        return html
+
+    def _invalidate_portlets(self, sender, changes):
+        "Throw away the html of the changed portlets"
+        for model, operation in changes:
+            if isinstance(model, BasePortlet):
+                self.portlets_cache.delete('%s-%s' % (model.type,
+                                                      get_pk(model)))
+
+    def get_posts_page(self, before=None, after=None, per_page=4):
+        """Return the KeysetPagination of the posts older than the before
+        cursor or newer than the after one. Raise ValueError if the cursor
+        is not valid"""
+        return KeysetPagination(self.get_all_posts(), before=before,
+                                after=after, per_page=per_page)
+
+    def get_all_page_components(self, post=None, page=None, posts=None):
         "Return all elements needed to correctly render the page"
 
         arguments = {}
 
         if post:
             arguments['post'] = post
+        elif posts is not None:
+            arguments['posts'] = posts
         else:
             if page:
                 arguments['posts'] =\
@@ -145,10 +269,86 @@ class BlogApp(object):
             else:
                 arguments['posts'] = self.get_all_posts(ordered=True)
 
-        arguments['pages'] = self.get_pages(ordered=True)
-        arguments['social_buttons'] = self.get_social_buttons(ordered=True)
+        arguments.update(self._get_common_components())
+        return arguments
 
-        # add the function so it can be retrieved from the template
-        arguments['get_portlet_by_slot'] = self.get_portlets_by_slot
+    def _get_common_components(self):
+        "Return the components shown in every page, once per request"
+        if has_request_context() and '_blog_components' in g.__dict__:
+            return g._blog_components
+
+        pages, social_buttons = self.get_navigation()
+        components = {'pages': pages, 'social_buttons': social_buttons,
+                      # add the function so it can be retrieved from the
+                      # template
+                      'get_portlet_by_slot': self.get_portlets_by_slot}
+
+        if has_request_context():
+            g._blog_components = components
+        return components
+
+    def _get_validators(self, stamps, *extra):
+        """Return the (etag, last_modified) validators of the contents
+        stamped by the stamps rows. Extra values are mixed into the etag"""
+        dates = [date for date, count in stamps if date]
+        last_modified = to_http_date(max(dates)) if dates else None
+
+        seed = repr((stamps, current_user.get_id()) + extra)
+        return sha1(seed).hexdigest(), last_modified
+
+    def _fetch_stamps(self, selects):
+        "Return the stamps rows of the selects, in a single query"
+        query = union_all(*selects) if len(selects) > 1 else selects[0]
+        return db.session.execute(query).fetchall()
+
+    def _stamp(self, model, *criteria):
+        "Select the last modification time and the rows count of a model"
+        table = model.__table__
+        stamp = select([func.max(table.c.modified), func.count()],
+                        from_obj=[table])
+        for criterion in criteria:
+            stamp = stamp.where(criterion)
+        return stamp
+
+    def _get_components_stamps(self):
+        "Stamps of the contents shown in every page (navigation, portlets..)"
+        posts = Post.__table__.c
+        # The posts of the pages are shown as titles in the navigation
+        stamps = [self._stamp(Page), self._stamp(Post, posts.type == 'page'),
+                  self._stamp(SocialButton), self._stamp(PortletSlot)]
+        stamps.extend(self._stamp(portlet_class) for portlet_class in
+                                                self.portlet_classes.values())
+        return stamps
+
+    def get_components_version(self):
+        """Return the stamps of the components shown in every page, fetched
+        once per request, along with the page validators if they're
+        checked"""
+        if has_request_context() and '_blog_version' in g.__dict__:
+            return g._blog_version
+
+        version = tuple(self._fetch_stamps(self._get_components_stamps()))
+        if has_request_context():
+            g._blog_version = version
+        return version
+
+    def get_page_validators(self, post=None):
+        """Return the (etag, last_modified) validators of a page showing the
+        post or, if None, the posts listing. They're cheap enough to be
+        checked before rendering anything"""
+        stamps = self._get_components_stamps()
+        components = len(stamps)
 
-        return arguments
+        if post:
+            posts = Post.__table__.c
+            stamps.append(self._stamp(Post, posts.id == post.id))
+        else:
+            stamps.append(self._stamp(Post))
+
+        stamps = self._fetch_stamps(stamps)
+        if has_request_context():
+            g._blog_version = tuple(stamps[:components])
+
+        # The images are rendered with their derivatives once ready
+        images = self.app.extensions.get('images')
+        return self._get_validators(stamps, images and images.generation)
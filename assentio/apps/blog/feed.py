@@ -0,0 +1,288 @@
+import os
+from time import time
+from datetime import datetime
+from hashlib import sha1
+from urlparse import urljoin
+from cStringIO import StringIO
+from xml.sax.saxutils import XMLGenerator
+
+from PyRSS2Gen import RSS2, RSSItem, Guid
+
+from flask import url_for, request
+from flask.ext.sqlalchemy import models_committed
+
+from assentio.utils import get_pk, to_http_date, gzipped, write_atomic
+
+from .models import Post
+
+ATOM_NS = 'http://www.w3.org/2005/Atom'
+
+# Format of the last modification dates stored on disk
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class PagedRSS2(RSS2):
+    "RSS2 feed with the RFC 5005 (paged feeds) navigation links"
+    rss_attrs = {'version': '2.0', 'xmlns:atom': ATOM_NS}
+
+    def __init__(self, links=(), **kwargs):
+        RSS2.__init__(self, **kwargs)
+        self.links = links
+
+    def publish_extensions(self, handler):
+        for rel, href in self.links:
+            handler.startElement('atom:link', {'rel': rel, 'href': href})
+            handler.endElement('atom:link')
+
+
+class SerializedItem(object):
+    "An already serialized RSSItem"
+
+    def __init__(self, xml):
+        self.xml = xml
+
+    def publish(self, handler):
+        # ignorable whitespaces are written as they are, without escaping
+        handler.ignorableWhitespace(self.xml)
+
+
+class FeedDocument(object):
+    "A serialized feed page, with its gzipped copy and validators"
+
+    def __init__(self, xml, last_modified=None, created=None):
+        self.xml = xml
+        self.last_modified = last_modified
+        self.created = created or time()
+        self.etag = sha1(xml).hexdigest()
+        self.gzipped = gzipped(xml)
+
+
+class FeedCache(object):
+    """Keep the serialized feed ready to be sent.
+
+    Every item is serialized once and kept along with the modification
+    stamp of its post, so when a post is published, edited or unpublished
+    only that item is built again, by any worker. Feed pages are stored in
+    memory or, if FEED_DIR is configured, on disk where they're shared by
+    all the workers.
+
+    Configurations:
+        FEED_MAX_ITEMS: the number of items of a feed page
+        FEED_PAGED: link the older posts as paged feeds (RFC 5005)
+        FEED_DIR: the directory where feed pages are stored, if any,
+                  relative to the instance folder
+        FEED_TIMEOUT: seconds in-memory pages are kept, as other workers'
+                      changes can't be noticed without FEED_DIR
+        FEED_URL_ROOT: the root of the feed urls, e.g. http://example.com/,
+                       by default the one of the first feed request
+    """
+
+    def __init__(self, blog_app):
+        self.blog_app = blog_app
+        config = blog_app.app.config
+
+        self.max_items = config['FEED_MAX_ITEMS']
+        self.paged = config['FEED_PAGED']
+        self.directory = config['FEED_DIR'] and os.path.join(
+                        blog_app.app.instance_path, config['FEED_DIR'])
+        self.timeout = config['FEED_TIMEOUT']
+        self.url_root = config['FEED_URL_ROOT']
+
+        if self.directory and not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        # {post id: {url root: ((date, modified), serialized item)}}
+        self.items = {}
+        # {(url root, page): FeedDocument}
+        self.documents = {}
+
+        models_committed.connect(self.invalidate, sender=blog_app.app)
+
+    def invalidate(self, sender, changes):
+        "Throw away the changed items and the pages"
+        posts = [get_pk(model) for model, operation in changes
+                                                if isinstance(model, Post)]
+        if not posts:
+            return
+
+        for post_id in posts:
+            self.items.pop(post_id, None)
+
+        for key in self.documents.keys():
+            self._remove(key)
+
+    def clear(self):
+        "Throw away everything"
+        self.items.clear()
+        for key in self.documents.keys():
+            self._remove(key)
+
+    def get_url_root(self):
+        """Return the root of the feed urls. It's never taken from the Host
+        of every request, or any client could fill the cache with copies of
+        the feed"""
+        if self.url_root is None:
+            self.url_root = request.url_root
+        return self.url_root
+
+    def get_document(self, url_root, page=1):
+        "Return the FeedDocument of the page or None if it doesn't exist"
+        key = (url_root, page)
+
+        if self.directory:
+            document = self._load(key)
+            if document:
+                return document
+        else:
+            document = self.documents.get(key)
+            if document and document.created + self.timeout > time():
+                return document
+            self.documents.pop(key, None)
+
+        document = self.build(url_root, page)
+        if document:
+            self._store(key, document)
+        return document
+
+    def build(self, url_root, page):
+        "Serialize the feed page, building only the missing items"
+        if page < 1 or page > 1 and not self.paged:
+            return None
+
+        posts = self.blog_app.get_all_posts(unrestricted=True)
+        posts = posts.filter_by(state='public')
+        posts = posts.order_by(Post.date.desc(), Post.id.desc())
+
+        # Fetch the ids only, the posts are loaded just for the new items
+        offset = (page - 1) * self.max_items
+        rows = posts.with_entities(Post.id, Post.date, Post._modified)
+        rows = rows.offset(offset).limit(self.max_items + 1).all()
+        has_next = len(rows) > self.max_items
+        rows = rows[:self.max_items]
+
+        if page > 1 and not rows:
+            return None
+
+        # The items changed since they were serialized, even by another
+        # worker, are built again
+        stamps = dict((post_id, (date, modified))
+                      for post_id, date, modified in rows)
+        missing = [post_id for post_id, stamp in stamps.items()
+                    if self.item_stamp(post_id, url_root) != stamp]
+        if missing:
+            for post in posts.filter(Post.id.in_(missing)):
+                self.items.setdefault(post.id, {})[url_root] = \
+                    (stamps[post.id], self.serialize_item(post, url_root))
+
+        items = [SerializedItem(self.items[post_id][url_root][1])
+                    for post_id, date, modified in rows]
+
+        stamps = [modified or date for post_id, date, modified in rows]
+        stamps = filter(None, stamps)
+        last_modified = to_http_date(max(stamps)) if stamps else None
+
+        feed_url = urljoin(url_root, url_for('blog.rss'))
+        links = []
+        if self.paged:
+            links.append(('self', self.page_url(feed_url, page)))
+            links.append(('first', feed_url))
+            if page > 1:
+                links.append(('previous', self.page_url(feed_url, page - 1)))
+            if has_next:
+                links.append(('next', self.page_url(feed_url, page + 1)))
+
+        feed = PagedRSS2(title='Progress in Development',
+                         link=feed_url,
+                         description='Antonio Sagliocco personal blog',
+                         lastBuildDate=last_modified,
+                         items=items,
+                         links=links)
+
+        return FeedDocument(feed.to_xml('utf-8'), last_modified)
+
+    def item_stamp(self, post_id, url_root):
+        "Return the (date, modified) of the post the item was built from"
+        item = self.items.get(post_id, {}).get(url_root)
+        return item and item[0]
+
+    def serialize_item(self, post, url_root):
+        "Return the item of the post as xml"
+        post_url = urljoin(url_root, url_for('blog.post', post_id=post.id))
+        item = RSSItem(title=post.title,
+                       link=post_url,
+                       description=post.description,
+                       guid=Guid(post_url),
+                       pubDate=post.date)
+
+        out = StringIO()
+        item.publish(XMLGenerator(out, 'utf-8'))
+        return out.getvalue()
+
+    @staticmethod
+    def page_url(feed_url, page):
+        return feed_url if page == 1 else '%s?page=%d' % (feed_url, page)
+
+    def _path(self, (url_root, page)):
+        name = '%s-%d.xml' % (sha1(url_root).hexdigest(), page)
+        return os.path.join(self.directory, name)
+
+    def _load(self, key):
+        "Return the document stored on disk, if any"
+        path = self._path(key)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+
+        # Read it again only if it has been rewritten
+        document = self.documents.get(key)
+        if document and document.created == mtime:
+            return document
+
+        try:
+            with open(path, 'rb') as stored:
+                xml = stored.read()
+            with open('%s.lm' % path) as stored:
+                last_modified = stored.read()
+        except IOError:
+            return None
+
+        if last_modified:
+            last_modified = datetime.strptime(last_modified, DATE_FORMAT)
+        else:
+            last_modified = None
+        document = FeedDocument(xml, last_modified, mtime)
+        self.documents[key] = document
+        return document
+
+    def _store(self, key, document):
+        self.documents[key] = document
+        if not self.directory:
+            return
+
+        path = self._path(key)
+        last_modified = document.last_modified
+        if last_modified:
+            last_modified = last_modified.strftime(DATE_FORMAT)
+        else:
+            last_modified = ''
+
+        # The xml is the last file written as it marks the page as
+        # available
+        write_atomic(path + '.lm', last_modified)
+        write_atomic(path, document.xml, precompress=True)
+
+        document.created = os.path.getmtime(path)
+
+    def _remove(self, key):
+        self.documents.pop(key, None)
+        if not self.directory:
+            return
+
+        path = self._path(key)
+        for suffix in ('', '.gz', '.br', '.lm'):
+            try:
+                os.remove(path + suffix)
+            except OSError:
+                pass
+
@@ -7,7 +7,7 @@ from sqlalchemy.ext.hybrid import hybrid_property
 from flask.ext.login import current_user
 
 from assentio import db
-from assentio.utils import DBMixin
+from assentio.utils import DBMixin, TimestampMixin
 
 states = dict(private='Private', public='Public')
 post_types = dict(standard='Standard', image='Image', quote='Quote',
@@ -17,7 +17,7 @@ page_categories = {'top-navigation': 'Top Navigation',
                    'bottom-navigation': "Bottom Navigation"}
 
 
-class Post(DBMixin, db.Model):
+class Post(TimestampMixin, DBMixin, db.Model):
     # '_'-prefixed column name are not shown by flask-admin
     id = db.Column(db.Integer, primary_key=True)
     stored_shortname = db.Column(db.String(120), unique=True)
@@ -88,8 +88,13 @@ class Post(DBMixin, db.Model):
     def author(self, value):
         self._author = value
 
+# The public listings filter on state and type and sort by date, the home
+# page seeks on (date, id), see KeysetPagination
+db.Index('ix_post_state_type_date', Post.state, Post.type, Post.date)
+db.Index('ix_post_date_id', Post.date, Post.id)
 
-class Page(DBMixin, db.Model):
+
+class Page(TimestampMixin, DBMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     category = db.Column(db.String(25), nullable=False,
                                             default='top-navigation')
@@ -110,8 +115,10 @@ class Page(DBMixin, db.Model):
         assert value in page_categories.keys()
         return value
 
+db.Index('ix_page_category_order', Page.category, Page.order)
+
 
-class SocialButton(DBMixin, db.Model):
+class SocialButton(TimestampMixin, DBMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(25), nullable=False)
     image = db.Column(db.String)
@@ -127,3 +134,6 @@ class SocialButton(DBMixin, db.Model):
 
     def __repr__(self):
         return '<SocialButton "%r">' % (self.name)
+
+db.Index('ix_social_button_state_order', SocialButton.state,
+         SocialButton.order)
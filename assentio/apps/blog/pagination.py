@@ -0,0 +1,91 @@
+from math import ceil
+from datetime import datetime
+
+from sqlalchemy import or_, and_
+
+from .models import Post
+
+# Format of the date in the cursors
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def make_cursor(post):
+    "Return the cursor pointing to the post"
+    return '%s-%d' % (post.date.strftime(CURSOR_DATE_FORMAT), post.id)
+
+
+def parse_cursor(cursor):
+    "Return the (date, id) pointed by the cursor, raise ValueError if invalid"
+    date, post_id = cursor.split('-')
+    return datetime.strptime(date, CURSOR_DATE_FORMAT), int(post_id)
+
+
+class KeysetPagination(object):
+    """A page of posts, ordered from the newest one. Unlike the
+    Flask-SQLAlchemy Pagination a page is addressed by the (date, id) of
+    the post next to it, so it costs the same whichever is its distance
+    from the first page, and the total number of posts is counted only if
+    asked. Posts without a date can't be addressed, they're not listed.
+
+    :param query: the posts query
+    :param before: cursor of the post following the page (newer posts)
+    :param after: cursor of the post preceding the page (older posts)
+    :param per_page: the number of posts of the page
+    """
+
+    def __init__(self, query, before=None, after=None, per_page=4):
+        query = query.filter(Post.date != None)
+        self.query = query
+        self.per_page = per_page
+
+        if before:
+            date, post_id = parse_cursor(before)
+            query = query.filter(or_(Post.date < date,
+                                     and_(Post.date == date,
+                                          Post.id < post_id)))
+        elif after:
+            date, post_id = parse_cursor(after)
+            query = query.filter(or_(Post.date > date,
+                                     and_(Post.date == date,
+                                          Post.id > post_id)))
+
+        # Going to newer posts the order is reversed
+        if after:
+            query = query.order_by(Post.date.asc(), Post.id.asc())
+        else:
+            query = query.order_by(Post.date.desc(), Post.id.desc())
+
+        # Fetch one more post to know if there's another page
+        items = query.limit(per_page + 1).all()
+        more = len(items) > per_page
+        items = items[:per_page]
+
+        if after:
+            items.reverse()
+            self.has_prev, self.has_next = more, True
+        else:
+            self.has_prev, self.has_next = bool(before), more
+
+        self.items = items
+
+    @property
+    def next_cursor(self):
+        "Cursor of the older posts page"
+        return make_cursor(self.items[-1]) if self.items else None
+
+    @property
+    def prev_cursor(self):
+        "Cursor of the newer posts page"
+        return make_cursor(self.items[0]) if self.items else None
+
+    @property
+    def total(self):
+        "The total number of posts, it costs a COUNT query"
+        if not hasattr(self, '_total'):
+            self._total = self.query.order_by(None).count()
+        return self._total
+
+    @property
+    def pages(self):
+        "The total number of pages"
+        return int(ceil(self.total / float(self.per_page)))
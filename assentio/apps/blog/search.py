@@ -0,0 +1,194 @@
+import re
+from weakref import WeakKeyDictionary
+from HTMLParser import HTMLParser
+
+from jinja2 import Markup, escape
+from sqlalchemy import (event, DDL, Table, MetaData, Column, Integer, Text,
+                        func, select, literal_column)
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm.attributes import get_history
+
+from assentio import db
+
+from .models import Post, post_types
+
+# The FTS5 index of the posts, the rowid is the post id. It's not a model:
+# it lives in its own metadata and it's created along with the db tables,
+# if the SQLite library has FTS5
+search_table = Table('post_search', MetaData(),
+                     Column('rowid', Integer, primary_key=True),
+                     Column('title', Text),
+                     Column('description', Text),
+                     Column('body', Text))
+
+create_search_table = DDL("CREATE VIRTUAL TABLE IF NOT EXISTS post_search "
+                          "USING fts5(title, description, body, "
+                          "tokenize='porter unicode61')")
+event.listen(db.metadata, 'after_create', create_search_table.execute_if(
+                    callable_=lambda ddl, target, bind, **kw: has_fts5(bind)))
+
+# The indexed post fields
+FIELDS = ('title', 'description', 'body')
+
+# Matches are marked with these before the text is escaped
+MATCH_START, MATCH_END = '\x02', '\x03'
+
+tags_re = re.compile(r'<[^>]*>')
+
+
+def strip_tags(html):
+    "Return the text of the html"
+    return HTMLParser().unescape(tags_re.sub(' ', html or u''))
+
+
+def highlight(text):
+    "Escape the text and mark the matches"
+    return Markup(escape(text).replace(MATCH_START, Markup('<mark>'))
+                              .replace(MATCH_END, Markup('</mark>')))
+
+
+def match_expression(terms):
+    "Return the FTS5 query matching all the terms, as they've been typed"
+    return ' '.join('"%s"' % term.replace('"', '""')
+                                            for term in terms.split())
+
+
+class SearchResult(object):
+    "A matching post with its highlighted title and body snippet"
+
+    def __init__(self, post, title, snippet):
+        self.post = post
+        self.title = highlight(title)
+        self.snippet = highlight(snippet)
+
+
+# {engine: FTS5 available}
+_fts5 = WeakKeyDictionary()
+
+
+def has_fts5(connection):
+    """Check the SQLite library has FTS5, probing it once per engine. It's
+    available only on SQLite, and not on every build"""
+    engine = connection.engine
+    if engine not in _fts5:
+        supported = connection.dialect.name == 'sqlite'
+        if supported:
+            try:
+                connection.execute('CREATE VIRTUAL TABLE temp.fts5_probe '
+                                   'USING fts5(content)')
+                connection.execute('DROP TABLE temp.fts5_probe')
+            except DBAPIError:
+                supported = False
+        _fts5[engine] = supported
+    return _fts5[engine]
+
+
+# {engine: the index exists}
+_indexed = WeakKeyDictionary()
+
+
+def is_supported(connection):
+    """Check the index exists, dbs created before it or without FTS5 have
+    none. It's looked up once per engine, see forget_index"""
+    engine = connection.engine
+    if engine not in _indexed:
+        _indexed[engine] = has_fts5(connection) and connection.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                    "AND name = 'post_search'").scalar() is not None
+    return _indexed[engine]
+
+
+def forget_index(target, connection, **kw):
+    "Look up the index again, once the tables have been created"
+    _indexed.pop(connection.engine, None)
+
+event.listen(db.metadata, 'after_create', forget_index)
+
+
+def index_post(mapper, connection, post):
+    "Add the post to the index"
+    if is_supported(connection):
+        connection.execute(search_table.insert().values(
+                                    rowid=post.id,
+                                    title=post.title,
+                                    description=post.description or u'',
+                                    body=strip_tags(post.body)))
+
+
+def reindex_post(mapper, connection, post):
+    "Index the post again, if any indexed field changed"
+    if any(get_history(post, field).has_changes() for field in FIELDS):
+        unindex_post(mapper, connection, post)
+        index_post(mapper, connection, post)
+
+
+def unindex_post(mapper, connection, post):
+    "Remove the post from the index"
+    if is_supported(connection):
+        connection.execute(search_table.delete()
+                                    .where(search_table.c.rowid == post.id))
+
+
+# The index is updated within the flush writing the posts
+event.listen(Post, 'after_insert', index_post)
+event.listen(Post, 'after_update', reindex_post)
+event.listen(Post, 'after_delete', unindex_post)
+
+
+class SearchIndex(object):
+    """Full-text search over the posts title, description and body, through
+    an SQLite FTS5 table. The index is updated in the same transaction of
+    the posts changes, rebuild it with manage.py reindex.
+
+    Configurations:
+        SEARCH_PER_PAGE: the number of results of a page
+    """
+
+    def __init__(self, blog_app):
+        self.blog_app = blog_app
+        self.per_page = blog_app.app.config['SEARCH_PER_PAGE']
+
+    @property
+    def enabled(self):
+        return is_supported(db.session.connection())
+
+    def reindex(self):
+        """Rebuild the whole index, creating it if it's missing, return the
+        number of indexed posts"""
+        connection = db.session.connection()
+        if not has_fts5(connection):
+            return 0
+        connection.execute(create_search_table)
+        forget_index(search_table, connection)
+        connection.execute(search_table.delete())
+
+        count = 0
+        for post in Post.query.yield_per(100):
+            index_post(None, connection, post)
+            count += 1
+
+        db.session.commit()
+        return count
+
+    def search(self, terms, page=1):
+        """Return the Pagination of the SearchResult of the posts visible by
+        the user matching all the terms, the most relevant first"""
+        matches = select([
+                    search_table.c.rowid.label('id'),
+                    func.highlight(literal_column('post_search'), 0,
+                                   MATCH_START, MATCH_END).label('title'),
+                    func.snippet(literal_column('post_search'), -1,
+                                 MATCH_START, MATCH_END, u'\u2026',
+                                 24).label('snippet'),
+                    literal_column('rank').label('rank')],
+                  literal_column('post_search').match(match_expression(terms)),
+                  from_obj=[search_table]).alias('matches')
+
+        posts = self.blog_app._get_posts(types=post_types.keys())
+        posts = posts.join(matches, matches.c.id == Post.id)
+        posts = posts.add_columns(matches.c.title, matches.c.snippet)
+        posts = posts.order_by(matches.c.rank)
+
+        pagination = posts.paginate(page, self.per_page)
+        pagination.items = [SearchResult(*row) for row in pagination.items]
+        return pagination
@@ -1,8 +1,8 @@
 from assentio import db
-from assentio.utils import DBMixin
+from assentio.utils import DBMixin, TimestampMixin
 
 
-class PortletSlot(DBMixin, db.Model):
+class PortletSlot(TimestampMixin, DBMixin, db.Model):
     "Base class for slot management"
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(25), nullable=False, unique=True)
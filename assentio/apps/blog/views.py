@@ -1,18 +1,17 @@
-import datetime
-
-from urlparse import urljoin
-from PyRSS2Gen import RSS2, RSSItem, Guid
-
 from flask import (redirect, url_for, current_app, render_template,
-                    make_response, request)
+                    make_response, request, abort)
 from flask.ext.login import current_user
 
+from assentio.utils import not_modified, set_validators
+from assentio.database import replica_reads
+
 from .blog import blog_bp
 from .models import Post
 
 
 @blog_bp.route('/post/<int:post_id>')
 @blog_bp.route('/post/<shortname>')
+@replica_reads
 def post(post_id=None, shortname=None):
     blog_app = current_app.extensions['blog']
 
@@ -30,32 +29,67 @@ def post(post_id=None, shortname=None):
     if search_index == 'id':
         return redirect(url_for('.post', shortname=post.shortname))
     else:
+        # Answer with a 304 before building anything if the client is fresh
+        etag, last_modified = blog_app.get_page_validators(post=post)
+        response = not_modified(etag, last_modified)
+        if response:
+            return response
+
         arguments = blog_app.get_all_page_components(post=post)
-        return render_template("post.html", **arguments)
+        response = make_response(render_template("post.html", **arguments))
+        return set_validators(response, etag, last_modified)
 
 
 @blog_bp.route('/feed')
+@replica_reads
 def rss():
     blog_app = current_app.extensions['blog']
-    posts = blog_app.get_all_posts(ordered=True)
-    host = request.url_root
-    items = []
-
-    for post in posts:
-        post_url = urljoin(host, url_for('blog.post', post_id=post.id))
-        rss = RSSItem(title=post.title,
-                      link=post_url,
-                      description=post.description,
-                      guid=Guid(post_url),
-                      pubDate=post.date)
-        items.append(rss)
-
-    feed = RSS2(title='Progress in Development',
-                link=urljoin(host, url_for('blog.rss')),
-                description='Antonio Sagliocco personal blog',
-                lastBuildDate=datetime.datetime.now(),
-                items=items)
-
-    response = make_response(feed.to_xml())
-    response.mimetype = 'application/rss+xml'
+
+    # Older posts are linked as paged feeds, if enabled
+    page = request.args.get('page', 1)
+    try:
+        page = int(page)
+    except ValueError:
+        return abort(404)
+    if page < 1:
+        return abort(404)
+
+    # The feed is kept serialized, nothing is built if no post changed
+    feed = blog_app.feed
+    document = feed.get_document(feed.get_url_root(), page)
+    if document is None:
+        return abort(404)
+
+    gzipped = bool(request.accept_encodings['gzip'])
+    etag = gzipped and '%s-gzip' % document.etag or document.etag
+
+    response = not_modified(etag, document.last_modified)
+    if not response:
+        response = make_response(gzipped and document.gzipped or document.xml)
+        response.mimetype = 'application/rss+xml'
+        if gzipped:
+            response.content_encoding = 'gzip'
+        set_validators(response, etag, document.last_modified)
+
+    response.vary.add('Accept-Encoding')
     return response
+
+
+@blog_bp.route('/search')
+@replica_reads
+def search():
+    blog_app = current_app.extensions['blog']
+    if not blog_app.search_index.enabled:
+        return abort(404)
+
+    page = request.args.get('page', 1)
+    try:
+        page = int(page)
+    except ValueError:
+        return abort(404)
+
+    terms = request.args.get('q', '').strip()
+    results = terms and blog_app.search_index.search(terms, page) or []
+
+    arguments = blog_app.get_all_page_components(posts=results)
+    return render_template('search.html', terms=terms, **arguments)
@@ -0,0 +1,211 @@
+import re
+from threading import Lock, BoundedSemaphore
+from timeit import default_timer
+from multiprocessing import Pool, TimeoutError
+
+import bcrypt
+
+from flask import current_app
+from werkzeug.security import safe_str_cmp
+
+# The cost factor of a bcrypt hash: $2a$<cost>$<salt and hash>
+cost_re = re.compile(r'^\$2[aby]?\$(\d\d)\$')
+
+
+class HashingBusy(Exception):
+    "Too many passwords are being hashed, or a client is sending too many"
+
+
+def _hash_password(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check_password(pw_hash, password):
+    return safe_str_cmp(bcrypt.hashpw(password, pw_hash), pw_hash)
+
+
+def _guarded(function, *args):
+    "Return (True, result) or (False, error), so the callback always runs"
+    try:
+        return True, function(*args)
+    except Exception, error:
+        return False, error
+
+
+def encode(password):
+    if isinstance(password, unicode):
+        password = password.encode('u8')
+    return str(password)
+
+
+class PasswordHasher(object):
+    """Hash and check the passwords with bcrypt in a pool of processes, so
+    login storms don't hold the request workers and the GIL for the whole
+    hashing. At most PASSWORD_HASHING_PROCESSES passwords are hashed and
+    PASSWORD_HASHING_QUEUE wait: password checks beyond that are refused
+    with HashingBusy, as are the concurrent logins of a client beyond
+    LOGIN_CONCURRENCY_PER_IP.
+
+    With no processes the passwords are hashed in the request thread by the
+    bcrypt extension (or not hashed at all if it's not installed).
+
+    Configurations:
+        BCRYPT_LOG_ROUNDS: the cost factor, passwords hashed with another
+                           one are hashed again on login
+        PASSWORD_HASHING_PROCESSES: the size of the processes pool
+        PASSWORD_HASHING_QUEUE: the checks waiting for a process
+        PASSWORD_HASHING_TIMEOUT: seconds a hashing can take
+        LOGIN_CONCURRENCY_PER_IP: the concurrent logins of a client
+    """
+
+    def __init__(self, app):
+        config = app.config
+        config.setdefault('PASSWORD_HASHING_PROCESSES', 2)
+        config.setdefault('PASSWORD_HASHING_QUEUE', 16)
+        config.setdefault('PASSWORD_HASHING_TIMEOUT', 10)
+        config.setdefault('LOGIN_CONCURRENCY_PER_IP', 2)
+
+        self.rounds = config.get('BCRYPT_LOG_ROUNDS', 12)
+        self.processes = config['PASSWORD_HASHING_PROCESSES']
+        self.timeout = config['PASSWORD_HASHING_TIMEOUT']
+        self.per_client = config['LOGIN_CONCURRENCY_PER_IP']
+        self.slots = BoundedSemaphore(max(1, self.processes) +
+                                      config['PASSWORD_HASHING_QUEUE'])
+
+        # Created on first use, so it's never shared by forked workers
+        self._pool = None
+        self._lock = Lock()
+        # {client address: running logins}
+        self.clients = {}
+
+        # Metrics
+        self.pending = 0
+        self.peak = 0
+        self.completed = 0
+        self.rejected = 0
+        self.hashing_time = 0.0
+
+        app.extensions['password_hasher'] = self
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = Pool(self.processes)
+            return self._pool
+
+    @property
+    def bcrypt(self):
+        return current_app.extensions.get('bcrypt')
+
+    def hash(self, password):
+        "Return the hash of the password, waiting for a free slot"
+        bcrypt_ext = self.bcrypt
+        if bcrypt_ext is None:
+            return password
+        if not self.processes:
+            # The extension hashes with the same BCRYPT_LOG_ROUNDS
+            return bcrypt_ext.generate_password_hash(password)
+        if not password:
+            raise ValueError('Password must be non-empty.')
+        return self._run(_hash_password, (encode(password), self.rounds),
+                         blocking=True)
+
+    def check(self, pw_hash, password):
+        """Check the password against the hash, raise HashingBusy if there
+        are too many checks waiting"""
+        bcrypt_ext = self.bcrypt
+        if bcrypt_ext is None:
+            # Bcrypt not installed, check plain text
+            return pw_hash == password
+        try:
+            if not self.processes:
+                return bcrypt_ext.check_password_hash(pw_hash, password)
+            return self._run(_check_password,
+                             (encode(pw_hash), encode(password)))
+        # This happens in case of invalid salt
+        except ValueError:
+            return False
+
+    def needs_rehash(self, pw_hash):
+        "Check if the hash has been made with another cost factor"
+        if self.bcrypt is None:
+            return False
+        match = cost_re.match(pw_hash or '')
+        return bool(match) and int(match.group(1)) != self.rounds
+
+    def _run(self, function, args, blocking=False):
+        if not self.slots.acquire(blocking):
+            with self._lock:
+                self.rejected += 1
+            raise HashingBusy()
+
+        with self._lock:
+            self.pending += 1
+            self.peak = max(self.peak, self.pending)
+        started = default_timer()
+
+        # The slot is held until the hashing is over, even if the request
+        # stopped waiting for it, so the pool never queues more than allowed
+        def finished(outcome):
+            self.slots.release()
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+                self.hashing_time += default_timer() - started
+
+        try:
+            result = self.pool.apply_async(_guarded, (function,) + args,
+                                           callback=finished)
+        except Exception:
+            finished(None)
+            raise
+
+        try:
+            succeeded, value = result.get(self.timeout)
+        except TimeoutError:
+            raise HashingBusy()
+        if not succeeded:
+            raise value
+        return value
+
+    def client_slot(self, address):
+        "Return the context of a login of the client"
+        return ClientSlot(self, address)
+
+    def stats(self):
+        "Return the metrics of the hashing"
+        with self._lock:
+            return {'processes': self.processes,
+                    'pending': self.pending,
+                    'peak': self.peak,
+                    'completed': self.completed,
+                    'rejected': self.rejected,
+                    'mean': self.completed and
+                            self.hashing_time * 1000 / self.completed or 0.0,
+                    'clients': len(self.clients)}
+
+
+class ClientSlot(object):
+    "Limit the concurrent logins of a client, see PasswordHasher"
+
+    def __init__(self, hasher, address):
+        self.hasher = hasher
+        self.address = address
+
+    def __enter__(self):
+        hasher = self.hasher
+        with hasher._lock:
+            running = hasher.clients.get(self.address, 0)
+            if running >= hasher.per_client:
+                hasher.rejected += 1
+                raise HashingBusy()
+            hasher.clients[self.address] = running + 1
+        return self
+
+    def __exit__(self, *exc_info):
+        hasher = self.hasher
+        with hasher._lock:
+            running = hasher.clients.pop(self.address, 1) - 1
+            if running:
+                hasher.clients[self.address] = running
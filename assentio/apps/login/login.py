@@ -1,18 +1,69 @@
 import os
+from functools import partial
 
-from flask import Blueprint, g
-from flask.ext.login import LoginManager, current_user, login_user, logout_user
+from werkzeug.local import LocalProxy
+from flask import Blueprint, current_app, g, session, _request_ctx_stack
+from flask.sessions import SecureCookieSessionInterface
+from flask.ext.login import (LoginManager, UserMixin, current_user,
+                             login_user, logout_user)
+from flask.ext.sqlalchemy import models_committed
 
+from assentio.cache import MemoryCache
+from assentio.utils import get_pk
+from assentio.middlewares.instrumentation import current_stats
+
+from .hashing import PasswordHasher
 from .models import User
 from .views import LoginView, LogoutView
 
-template_folder = os.path.join(os.path.split(__file__)[0], 'templates')
+template_folder = os.path.join(os.path.split(os.path.abspath(__file__))[0],
+                               'templates')
 login_bp = Blueprint('auth', __name__, template_folder=template_folder)
 
 
+class CachedUser(UserMixin):
+    "The identity of a logged-in user, as kept in the users cache"
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+    def __repr__(self):
+        return '<CachedUser %r>' % self.username
+
+
+# The session keys Flask-Login writes on every request, logged-in or not
+LOGIN_BOOKKEEPING = ('_id', '_fresh', 'remember')
+
+
+class LoginSessions(SecureCookieSessionInterface):
+    """Send a new session cookie only if it holds more than the Flask-Login
+    bookkeeping, e.g. a logged-in user or a flashed message: anonymous
+    requests must not receive one, or their responses could not be stored
+    in the page cache"""
+
+    def should_set_cookie(self, app, session):
+        "Check the session is worth a cookie, the received ones are updated"
+        return not session.new or \
+                    any(key not in LOGIN_BOOKKEEPING for key in session)
+
+    def save_session(self, app, session, response):
+        if self.should_set_cookie(app, session):
+            SecureCookieSessionInterface.save_session(self, app, session,
+                                                      response)
+
+
 class ExtendedLoginManager(LoginManager):
     def init_app(self, app, add_context_processor=True):
         super(ExtendedLoginManager, self).init_app(app, add_context_processor)
+        app.session_interface = LoginSessions()
+
+        # The identities of the logged-in users, see load_user
+        app.config.setdefault('USER_CACHE_TIMEOUT', 300)
+        self.users = MemoryCache(
+                        max_size=1024 * 1024,
+                        default_timeout=app.config['USER_CACHE_TIMEOUT'])
+        models_committed.connect(self._invalidate_users, sender=app)
 
         # define the load user method, applying the @user_loader decorator
         self.load_user = self.user_loader(self.load_user)
@@ -34,17 +85,67 @@ class ExtendedLoginManager(LoginManager):
         if not hasattr(app, 'extensions'):
             app.extensions = {}
 
+        # Passwords are hashed out of the request workers
+        self.hasher = PasswordHasher(app)
+
         # before_request handlers
         self.g_current_user = app.before_request(self.g_current_user)
 
         app.extensions['login_manager'] = self
 
-    @staticmethod
-    def load_user(userid):
-        "Helper function required by Flask-login"
+    def load_user(self, userid):
+        """Helper function required by Flask-login: the identity of the
+        users is cached, so logged-in requests don't query the user"""
+        key = 'user:%s' % userid
+        identity = self.users.get(key)
+        stats = current_stats()
+
+        if identity is None:
+            user = User.query.filter_by(id=userid).first()
+            if user is None:
+                return None
+            identity = (user.id, user.username)
+            self.users.set(key, identity)
+            if stats is not None:
+                stats.user_cache_misses += 1
+        elif stats is not None:
+            stats.user_cache_hits += 1
+
+        return CachedUser(*identity)
+
+    def _invalidate_users(self, sender, changes):
+        "Forget the identity of the changed users"
+        for model, operation in changes:
+            if isinstance(model, User):
+                self.users.delete('user:%s' % get_pk(model))
+
+    def reload_user(self):
+        """Load the user of the session lazily, the first time the current
+        user is used: requests not using it don't load it"""
+        ctx = _request_ctx_stack.top
+        user_id = session.get('user_id', None)
+        if user_id is None:
+            ctx.user = self.anonymous_user()
+        else:
+            ctx.user = LocalProxy(partial(self._resolve_user, ctx, user_id))
+
+    def _resolve_user(self, ctx, user_id):
+        user = getattr(ctx, '_resolved_user', None)
+        if user is not None:
+            return user
+
+        user = self.user_callback(user_id)
+        if user is None:
+            # The user doesn't exist anymore, log it out
+            session.pop('user_id', None)
+            session.pop('_fresh', None)
+            user = self.anonymous_user()
 
-        user = User.query.filter_by(id=userid).first()
-        return user or None
+        ctx._resolved_user = user
+        # Later uses of the current user skip the proxy
+        if isinstance(ctx.user, LocalProxy):
+            ctx.user = user
+        return user
 
     @staticmethod
     def g_current_user():
@@ -57,6 +158,10 @@ class ExtendedLoginManager(LoginManager):
         user = User.query.filter_by(username=username).first()
 
         if user and user.check_password(password):
+            # Hash the password again if the cost factor changed
+            if self.hasher.needs_rehash(user.password):
+                user.password = password
+                current_app.extensions['sqlalchemy'].db.session.commit()
             return user
         return False
 
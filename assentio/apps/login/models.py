@@ -13,11 +13,8 @@ class Encrypted(types.TypeDecorator):
 
     def process_bind_param(self, value, dialect):
         # encrypt the password before storing in the db
-        # if the encrypt extension is installed
-        bcrypt = current_app.extensions.get('bcrypt', None)
-        if bcrypt:
-            return bcrypt.generate_password_hash(value)
-        return value
+        # if the encrypt extension is installed, see PasswordHasher
+        return current_app.extensions['password_hasher'].hash(value)
 
 
 class User(UserMixin, DBMixin, db.Model):
@@ -36,15 +33,7 @@ class User(UserMixin, DBMixin, db.Model):
         return self.username
 
     def check_password(self, plaintext_password):
-        "Validate the password against the stored one"
-        bcrypt = current_app.extensions.get('bcrypt', None)
-        if bcrypt:
-            try:
-                return bcrypt.check_password_hash(self.password,
-                                                    plaintext_password)
-            # This happens in case of invalid salt
-            except ValueError:
-                return False
-        else:
-            # Bcrypt not installed, check plain text
-            return self.password == plaintext_password
+        """Validate the password against the stored one, raise HashingBusy
+        if too many passwords are being checked"""
+        hasher = current_app.extensions['password_hasher']
+        return hasher.check(self.password, plaintext_password)
@@ -6,6 +6,11 @@ from flask import (request, render_template, abort, redirect, current_app,
 from flask.ext.wtf import Form, TextField, HiddenField, Required
 from flask.ext.login import current_user, login_required
 
+from .hashing import HashingBusy
+
+# Seconds a client should wait before trying again to log in
+RETRY_AFTER = 5
+
 
 class LoginForm(Form):
     username = TextField('username', validators=[Required()])
@@ -25,7 +30,11 @@ class LoginView(views.MethodView):
         super(LoginView, self).__init__(*args, **kwargs)
         self._form = LoginForm(next=request.args.get('next', None))
         self._lm = current_app.extensions['login_manager']
-        self.arguments = current_app.extensions['blog'].get_all_page_components()
+
+    @property
+    def arguments(self):
+        "The page components, loaded only if a page is rendered"
+        return current_app.extensions['blog'].get_all_page_components()
 
     def get(self):
         if not current_user.is_anonymous():
@@ -38,7 +47,18 @@ class LoginView(views.MethodView):
             username = self._form.data.get('username', None)
             password = self._form.data.get('password', None)
 
-            if self._lm.authenticate_user(username, password):
+            # Login storms must not hold all the workers
+            try:
+                with self._lm.hasher.client_slot(request.remote_addr):
+                    authenticated = self._lm.authenticate_user(username,
+                                                               password)
+            except HashingBusy:
+                flash("Too many login attempts, please retry later")
+                return render_template("login.html", form=self._form,
+                                       **self.arguments), 503, \
+                       {'Retry-After': str(RETRY_AFTER)}
+
+            if authenticated:
                 flash("Logged in successfully.")
                 next_param = request.form.get("next", None)
 
@@ -0,0 +1,191 @@
+import os
+import re
+import json
+import hashlib
+import posixpath
+
+from flask import url_for
+
+from assentio.utils import write_atomic
+
+try:
+    from jsmin import jsmin
+except ImportError:
+    jsmin = None
+
+# The bundles built from the static files: {bundle: [files]}
+BUNDLES = {
+    'css/site.css': ['css/style.css', 'css/responsive.css'],
+    'css/admin-forms.css': ['chosen/chosen.css', 'css/datepicker.css'],
+    'js/admin-forms.js': ['js/bootstrap-datepicker.js', 'js/form.js'],
+}
+
+# Static files loading other files relatively to their own url can't be
+# moved to the assets folder
+EXCLUDED = ('ckeditor/',)
+
+# The extensions of the files copied along with their precompressed siblings
+COMPRESSED = ('.css', '.js', '.svg', '.txt')
+
+url_re = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+comments_re = re.compile(r'/\*.*?\*/', re.S)
+spaces_re = re.compile(r'\s+')
+separators_re = re.compile(r'\s*([{};,>])\s*')
+
+
+def minify_css(css):
+    "Remove the comments and the useless whitespaces of the css"
+    css = comments_re.sub('', css)
+    css = spaces_re.sub(' ', css)
+    return separators_re.sub(r'\1', css).replace(';}', '}').strip()
+
+
+def minify_js(js):
+    "Minify the js, if the jsmin module is installed"
+    if jsmin is None:
+        return js
+    return jsmin(js)
+
+
+def fingerprint(name, data):
+    "Return the name with the hash of the data before the extension"
+    root, ext = posixpath.splitext(name)
+    return '%s.%s%s' % (root, hashlib.md5(data).hexdigest()[:12], ext)
+
+
+class AssetManifest(object):
+    """Fingerprinted static files: the build copies every static file (but
+    the EXCLUDED ones) into the assets folder with the hash of its contents
+    in the name, concatenates and minifies the BUNDLES and precompresses the
+    css and js files. The {file: fingerprinted file} manifest is stored in
+    the assets folder and loaded at startup.
+
+    Templates use asset_url, a replacement of url_for giving the
+    fingerprinted url of the static files, and asset_bundle, giving the
+    urls of a bundle (the bundle itself once built, its files otherwise).
+    Fingerprinted urls never change contents, so they're cached as
+    immutable (see the 'assets' caching policy).
+
+    Configurations:
+        ASSETS_FOLDER: the assets folder, within the static folder
+        ASSETS_BUNDLES: the bundles to build
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.folder = app.config['ASSETS_FOLDER']
+        self.bundles = app.config.get('ASSETS_BUNDLES', BUNDLES)
+        self.manifest = self.load()
+        app.extensions['assets'] = self
+
+    @property
+    def directory(self):
+        return os.path.join(self.app.static_folder, self.folder)
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.directory, 'manifest.json')
+
+    def load(self):
+        "Return the manifest of the last build, if any"
+        try:
+            with open(self.manifest_path) as stored:
+                return json.load(stored)
+        except (IOError, ValueError):
+            return {}
+
+    def url(self, endpoint, **values):
+        "url_for, with the fingerprinted url of the built static files"
+        if endpoint == 'static':
+            filename = self.manifest.get(values.get('filename'))
+            if filename:
+                values['filename'] = filename
+        return url_for(endpoint, **values)
+
+    def bundle_urls(self, name):
+        "Return the urls to include the bundle"
+        if name in self.manifest:
+            return [self.url('static', filename=name)]
+        return [url_for('static', filename=filename)
+                                        for filename in self.bundles[name]]
+
+    def build(self):
+        "Build the assets, return the new manifest"
+        sources = self.get_sources()
+        manifest = {}
+
+        # Stylesheets refer to other files, they're built once the others
+        # have their fingerprinted names
+        names = sorted(sources, key=lambda name: name.endswith('.css'))
+        for name in names:
+            with open(sources[name], 'rb') as source:
+                data = source.read()
+            if name.endswith('.css'):
+                data = self.rewrite_urls(name, data, manifest)
+            manifest[name] = self.write(name, data)
+
+        for bundle, files in sorted(self.bundles.items()):
+            contents = []
+            for name in files:
+                with open(sources[name], 'rb') as source:
+                    data = source.read()
+                if name.endswith('.css'):
+                    contents.append(minify_css(
+                            self.rewrite_urls(name, data, manifest)))
+                else:
+                    contents.append(minify_js(data))
+            separator = bundle.endswith('.js') and ';\n' or '\n'
+            manifest[bundle] = self.write(bundle, separator.join(contents))
+
+        self.write_manifest(manifest)
+        self.manifest = manifest
+        return manifest
+
+    def get_sources(self):
+        "Return the {name: path} of the static files"
+        static_folder = self.app.static_folder
+        sources = {}
+        for root, dirs, files in os.walk(static_folder):
+            if os.path.abspath(root) == os.path.abspath(self.directory):
+                dirs[:] = []
+                continue
+            for filename in files:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, static_folder)
+                name = name.replace(os.sep, '/')
+                if not name.startswith(EXCLUDED):
+                    sources[name] = path
+        return sources
+
+    def rewrite_urls(self, name, css, manifest):
+        "Point the urls of the stylesheet to the fingerprinted files"
+        static_path = self.app.static_url_path + '/'
+
+        def replace(match):
+            url = match.group(2)
+            if url.startswith(static_path):
+                target = url[len(static_path):]
+            elif url.startswith(('/', 'data:', 'http:', 'https:')):
+                return match.group(0)
+            else:
+                target = posixpath.normpath(
+                            posixpath.join(posixpath.dirname(name), url))
+            target, sep, suffix = target.partition('?')
+            if target not in manifest:
+                return match.group(0)
+            return 'url(%s%s%s%s)' % (static_path, manifest[target], sep,
+                                     suffix)
+
+        return url_re.sub(replace, css)
+
+    def write(self, name, data):
+        """Write the fingerprinted file and its precompressed copies, return
+        its name relative to the static folder"""
+        filename = fingerprint(name, data)
+        path = os.path.join(self.directory, *filename.split('/'))
+        write_atomic(path, data, precompress=name.endswith(COMPRESSED))
+        return '%s/%s' % (self.folder, filename)
+
+    def write_manifest(self, manifest):
+        write_atomic(self.manifest_path,
+                     json.dumps(manifest, indent=2, sort_keys=True))
@@ -0,0 +1,2 @@
+from .corpus import seed_corpus
+from .runner import run_benchmark, main
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+
+from assentio import db
+from assentio.apps.login import User
+from assentio.apps.blog import Post, Page, SocialButton, TextPortlet
+from assentio.apps.blog.slots import PortletSlot
+
+BODY = ''.join('<p>Paragraph %d of a synthetic post, with some <b>markup</b> '
+               'and enough words to be indexed and rendered.</p>' % i
+                                                        for i in range(10))
+
+# Posts are committed in batches of this size
+BATCH_SIZE = 500
+
+
+def seed_corpus(app, posts=1000, pages=5, slots=3, portlets=2, buttons=3):
+    """Store a synthetic corpus through the blog models: posts of every
+    type (one every hour, going back from now), pages and their posts,
+    social buttons and slots with their text portlets. Return the user
+    owning the contents"""
+    with app.test_request_context() as ctx:
+        user = User('benchmark')
+        user.password = 'benchmark'
+        db.session.add(user)
+        db.session.commit()
+
+        # Post validators need an authenticated user
+        ctx.user = user
+
+        types = ('standard', 'quote', 'image', 'flashnews')
+        now = datetime.now()
+        for i in range(posts):
+            post = Post('Synthetic post %d' % i)
+            post.shortname = 'synthetic-post-%d' % i
+            post.body = BODY
+            post.description = 'Description of the synthetic post %d' % i
+            post.type = types[i % len(types)]
+            post.state = 'public'
+            post.date = now - timedelta(hours=i)
+            db.session.add(post)
+            if i % BATCH_SIZE == BATCH_SIZE - 1:
+                db.session.commit()
+        db.session.commit()
+
+        for i in range(pages):
+            post = Post('Synthetic page %d' % i)
+            post.shortname = 'synthetic-page-%d' % i
+            post.body = BODY
+            post.type = 'page'
+            post.state = 'public'
+            page = Page()
+            page.post = post
+            page.order = i
+            db.session.add(page)
+
+        for i in range(buttons):
+            button = SocialButton()
+            button.name = 'button-%d' % i
+            button.url = 'http://example.com/%d' % i
+            button.order = i
+            button.state = 'public'
+            db.session.add(button)
+
+        # The first slot is the one rendered by the templates
+        for i in range(slots):
+            slot = PortletSlot()
+            slot.name = i and 'slot-%d' % i or 'right_column'
+            for j in range(portlets):
+                portlet = TextPortlet()
+                portlet.title = 'Portlet %d of slot %d' % (j, i)
+                portlet.body = BODY
+                portlet.order = j
+                portlet.state = 'public'
+                portlet.slot = slot
+                db.session.add(portlet)
+
+        db.session.commit()
+        return user
@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import httplib
+import resource
+import argparse
+import tempfile
+from threading import Thread
+from timeit import default_timer
+
+from sqlalchemy import event
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from assentio import db
+from assentio.main import create_flask_app
+from assentio.manage import _syncdb as syncdb
+from assentio.utils import percentile
+from assentio.apps.blog import Post
+
+from .corpus import seed_corpus
+
+
+class BenchmarkConfig(object):
+    DEBUG = False
+    TESTING = False
+    CSRF_ENABLED = False
+
+
+def make_app(database, page_cache=True):
+    "Return an app on the sqlite database, without the debug toolbar"
+    config = type('Config', (BenchmarkConfig,), {
+                'SQLALCHEMY_DATABASE_URI': 'sqlite:///%s' % database,
+                'PAGE_CACHE_BACKEND': page_cache and 'memory' or None})
+    return create_flask_app(config_object=config, db=db)
+
+
+class QueryCounter(object):
+    "Count the statements executed by the engine"
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self)
+
+    def __call__(self, *args):
+        self.count += 1
+
+
+class TestClientDriver(object):
+    "Send the requests through the Flask test client"
+    name = 'client'
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        response = self.client.get(path)
+        # Consume the body, as a server would
+        response.data
+        return response.status_code
+
+    def close(self):
+        pass
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    "Don't log the requests"
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class ServerDriver(object):
+    "Send the requests to a real WSGI server, running in a thread"
+    name = 'server'
+
+    def __init__(self, app):
+        self.server = make_server('127.0.0.1', 0, app, threaded=True,
+                                  request_handler=QuietRequestHandler)
+        self.port = self.server.socket.getsockname()[1]
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self, path):
+        connection = httplib.HTTPConnection('127.0.0.1', self.port)
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        connection.close()
+        return response.status
+
+    def close(self):
+        self.server.shutdown()
+
+
+def peak_memory():
+    "Return the peak resident memory of the process, in KB"
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(driver, counter, path, requests, warmup):
+    "Return the statistics of requests GETs of path"
+    for i in range(warmup):
+        driver.get(path)
+
+    timings = []
+    statuses = set()
+    queries = counter.count
+    started = default_timer()
+    for i in range(requests):
+        start = default_timer()
+        statuses.add(driver.get(path))
+        timings.append(default_timer() - start)
+    elapsed = default_timer() - started
+    queries = counter.count - queries
+
+    timings.sort()
+    return {'path': path,
+            'status': sorted(statuses),
+            'requests': requests,
+            'throughput': requests / elapsed,
+            'mean': sum(timings) / requests * 1000,
+            'p50': percentile(timings, 50) * 1000,
+            'p90': percentile(timings, 90) * 1000,
+            'p99': percentile(timings, 99) * 1000,
+            'max': timings[-1] * 1000,
+            'queries': float(queries) / requests,
+            'peak_memory': peak_memory()}
+
+
+def run_benchmark(posts=1000, pages=5, slots=3, portlets=2, requests=100,
+                  warmup=10, listing_page=10, server=False, page_cache=True,
+                  database=None):
+    """Seed a synthetic corpus and measure the public request paths.
+    Return the results as a json serializable dict, timings are in ms"""
+    if database is None:
+        fd, database = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        os.remove(database)
+        remove_database = True
+    else:
+        remove_database = False
+
+    app = make_app(database, page_cache=page_cache)
+    syncdb(app)
+
+    ctx = app.app_context()
+    ctx.push()
+    try:
+        started = default_timer()
+        seed_corpus(app, posts=posts, pages=pages, slots=slots,
+                    portlets=portlets)
+        seeding = default_timer() - started
+
+        post = Post.query.filter_by(type='standard').first()
+        paths = [('index', '/'),
+                 ('index_page', '/?page=%d' % listing_page),
+                 ('post', '/post/%s' % post.shortname),
+                 ('post_id', '/post/%d' % post.id),
+                 ('feed', '/feed'),
+                 ('login', '/login/')]
+        db.session.remove()
+
+        counter = QueryCounter(db.get_engine(app))
+        driver = (server and ServerDriver or TestClientDriver)(app)
+        try:
+            results = dict((name, measure(driver, counter, path, requests,
+                                          warmup))
+                                                    for name, path in paths)
+        finally:
+            driver.close()
+    finally:
+        ctx.pop()
+        if remove_database:
+            os.remove(database)
+
+    return {'config': {'posts': posts, 'pages': pages, 'slots': slots,
+                       'portlets': portlets, 'requests': requests,
+                       'warmup': warmup, 'driver': driver.name,
+                       'page_cache': page_cache},
+            'seeding': seeding,
+            'results': results}
+
+
+def compare(results, baseline):
+    "Return the [(name, metric, baseline, current, change %)] of the runs"
+    rows = []
+    for name, current in sorted(results['results'].items()):
+        previous = baseline['results'].get(name)
+        if not previous:
+            continue
+        for metric in ('p50', 'p90', 'p99', 'throughput', 'queries'):
+            change = previous[metric] and \
+                    (current[metric] - previous[metric]) / previous[metric]
+            rows.append((name, metric, previous[metric], current[metric],
+                         change * 100))
+    return rows
+
+
+def report(results, out=sys.stdout):
+    "Print the results as a table"
+    out.write('%(posts)d posts, %(requests)d requests per path through the '
+              '%(driver)s, page cache %(page_cache)s\n' % results['config'])
+    out.write('%-12s %6s %9s %8s %8s %8s %8s %8s %10s\n' % (
+                    'path', 'status', 'req/s', 'mean', 'p50', 'p90', 'p99',
+                    'queries', 'memory KB'))
+    for name, stats in sorted(results['results'].items()):
+        out.write('%-12s %6s %9.1f %8.2f %8.2f %8.2f %8.2f %8.1f %10d\n' % (
+                    name, ','.join(map(str, stats['status'])),
+                    stats['throughput'], stats['mean'], stats['p50'],
+                    stats['p90'], stats['p99'], stats['queries'],
+                    stats['peak_memory']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+                description='Benchmark the Assentio public request paths')
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--pages', type=int, default=5)
+    parser.add_argument('--slots', type=int, default=3)
+    parser.add_argument('--portlets', type=int, default=2,
+                        help='portlets per slot')
+    parser.add_argument('--requests', type=int, default=100,
+                        help='timed requests per path')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='untimed requests per path')
+    parser.add_argument('--listing-page', type=int, default=10,
+                        help='the K of the /?page=K path')
+    parser.add_argument('--server', action='store_true',
+                        help='send the requests to a real WSGI server')
+    parser.add_argument('--no-page-cache', action='store_true',
+                        help='disable the server-side page cache')
+    parser.add_argument('--database',
+                        help='sqlite file to use, kept after the run')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare',
+                        help='compare with the results of a previous run')
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(posts=args.posts, pages=args.pages,
+                            slots=args.slots, portlets=args.portlets,
+                            requests=args.requests, warmup=args.warmup,
+                            listing_page=args.listing_page,
+                            server=args.server,
+                            page_cache=not args.no_page_cache,
+                            database=args.database)
+    report(results)
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            baseline = json.load(baseline)
+        print '\n%-12s %-10s %10s %10s %8s' % ('path', 'metric', 'baseline',
+                                              'current', 'change')
+        for row in compare(results, baseline):
+            print '%-12s %-10s %10.2f %10.2f %+7.1f%%' % row
+
+if __name__ == '__main__':
+    main()
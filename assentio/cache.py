@@ -0,0 +1,110 @@
+import sys
+from time import time
+from threading import RLock
+from collections import OrderedDict
+
+from werkzeug.utils import import_string
+from werkzeug.contrib.cache import BaseCache, NullCache, FileSystemCache
+
+
+class MemoryCache(BaseCache):
+    """An in-process LRU cache bounded by the (approximate) size of the stored
+    values. When the limit is exceeded the least recently used entries are
+    evicted.
+
+    :param max_size: the maximum number of bytes kept in the cache
+    :param default_timeout: the timeout used if no timeout is passed to set
+    """
+
+    def __init__(self, max_size=32 * 1024 * 1024, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = RLock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+
+            expires, size, value = entry
+            if expires <= time():
+                self.size -= size
+                return None
+
+            # Store it again as the most recently used entry
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+
+        size = sizeof(value)
+        with self._lock:
+            self.delete(key)
+
+            # Don't let a single huge value flush the whole cache
+            if size > self.max_size:
+                return
+
+            self._entries[key] = (time() + timeout, size, value)
+            self.size += size
+
+            while self.size > self.max_size:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if self.get(key) is None:
+                self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def sizeof(value):
+    "Return the approximate memory footprint of value, in bytes"
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(sizeof(k) + sizeof(v) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return sum(sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+
+cache_backends = {'null': NullCache,
+                  'memory': MemoryCache,
+                  'filesystem': FileSystemCache}
+
+
+def make_cache(backend, **options):
+    """Return a cache instance. Accepted backends are:
+        - None or 'null': caching disabled
+        - 'memory': an in-process LRU cache (see MemoryCache)
+        - 'filesystem': a cache shared across processes, stored in a
+          directory (requires the cache_dir option)
+        - a BaseCache subclass or its import path
+    """
+    if not backend:
+        backend = 'null'
+
+    if isinstance(backend, basestring):
+        backend = cache_backends.get(backend) or import_string(backend)
+
+    return backend(**options)
@@ -0,0 +1,384 @@
+import hmac
+from time import time
+from hashlib import sha1
+from functools import wraps, partial
+from itertools import count
+from threading import Lock
+from weakref import WeakKeyDictionary
+from contextlib import contextmanager
+from timeit import default_timer
+
+from sqlalchemy import event, exc, orm
+from sqlalchemy.pool import QueuePool
+from flask import current_app, g, request, has_request_context
+from werkzeug.security import safe_str_cmp
+from flask.ext.sqlalchemy import (SQLAlchemy as BaseSQLAlchemy,
+                                  _SignallingSession, _EngineConnector,
+                                  models_committed)
+
+from assentio.middlewares.instrumentation import current_stats
+
+# The pool of the server databases, when not configured
+SERVER_POOL_DEFAULTS = {'pool_size': 10, 'max_overflow': 10,
+                        'pool_timeout': 10, 'pool_recycle': 3600}
+
+# The pool of the sqlite database files, when not configured
+SQLITE_POOL_SIZE = 5
+
+# The signed cookie storing until when the reads of a user who wrote
+# something go to the primary, see ReplicaSet
+PRIMARY_UNTIL_COOKIE = 'primary_until'
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool measuring how long the checkouts wait for a connection,
+    in the request stats and in total"""
+
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+        self._waits_lock = Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def _do_get(self):
+        started = default_timer()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            self._record(default_timer() - started)
+
+    def _record(self, duration):
+        stats = current_stats()
+        if stats is not None:
+            stats.pool_wait += duration
+        with self._waits_lock:
+            self.checkouts += 1
+            # Idle connections are handed out in microseconds
+            if duration >= 0.001:
+                self.waits += 1
+                self.wait_time += duration
+                self.max_wait = max(self.max_wait, duration)
+
+    def stats(self):
+        "Return the status and the checkout waits of the pool, in ms"
+        with self._waits_lock:
+            return {'size': self.size(),
+                    'checked_out': self.checkedout(),
+                    'overflow': self.overflow(),
+                    'checkouts': self.checkouts,
+                    'waits': self.waits,
+                    'mean_wait': self.waits and
+                                 self.wait_time * 1000 / self.waits or 0.0,
+                    'max_wait': self.max_wait * 1000}
+
+
+def set_sqlite_pragmas(pragmas):
+    "Return a connect listener running the pragmas on new connections"
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas:
+                cursor.execute('PRAGMA %s = %s' % (name, value))
+        finally:
+            cursor.close()
+    return connect
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Check the connection is still alive on checkout, so connections
+    dropped by the server are replaced instead of failing the request"""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        # The pool tries again with a new connection
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+class ReplicaConnector(_EngineConnector):
+    "The connector of the replica engines, bound by ('replica', index)"
+
+    def get_uri(self):
+        return self._app.config['SQLALCHEMY_REPLICAS'][self._bind[1]]
+
+
+class ReplicaSet(object):
+    """The read replicas of the app database, picked round-robin once per
+    reading block (see RoutingSession), so all its reads come from the same
+    replica and see the same snapshot of the database. A replica
+    is pinged before use every SQLALCHEMY_REPLICA_CHECK_INTERVAL seconds,
+    and skipped until the next check if it doesn't answer.
+
+    Users who commit something read from the primary for the following
+    SQLALCHEMY_REPLICA_LAG seconds, so they see their own writes even if
+    the replicas are behind. The deadline is kept in a cookie of its own,
+    signed with the SECRET_KEY, and not in the session: the public workers
+    never load it (see AnonymousUsers) but still read the cookie.
+    """
+
+    def __init__(self, db, app):
+        self.db = db
+        self.app = app
+        self._counter = count()
+        self._lock = Lock()
+        # {index: last check}, {index: down until}
+        self.checked = {}
+        self.down = {}
+        models_committed.connect(self._pin_to_primary, sender=app)
+        app.after_request(self._set_cookie)
+        app.extensions['db_replicas'] = self
+
+    @property
+    def uris(self):
+        return self.app.config['SQLALCHEMY_REPLICAS']
+
+    def reads_primary(self):
+        "Check if the user of the request must read from the primary"
+        if not has_request_context():
+            return False
+        until = getattr(g, '_primary_until', None) or \
+                    self.load(request.cookies.get(PRIMARY_UNTIL_COOKIE))
+        return until > time()
+
+    def sign(self, until):
+        "Return the cookie value of the deadline"
+        until = str(int(until))
+        return '%s.%s' % (until, hmac.new(self.app.secret_key, until,
+                                          sha1).hexdigest())
+
+    def load(self, value):
+        "Return the deadline of a cookie value, 0 if it isn't valid"
+        until = (value or '').partition('.')[0]
+        if not until.isdigit() or not safe_str_cmp(self.sign(until), value):
+            return 0
+        return int(until)
+
+    def _pin_to_primary(self, sender, changes):
+        if self.uris and has_request_context():
+            g._primary_until = \
+                        time() + self.app.config['SQLALCHEMY_REPLICA_LAG']
+
+    def _set_cookie(self, response):
+        until = getattr(g, '_primary_until', None)
+        if until is not None:
+            interface = self.app.session_interface
+            response.set_cookie(PRIMARY_UNTIL_COOKIE, self.sign(until),
+                    max_age=self.app.config['SQLALCHEMY_REPLICA_LAG'] + 1,
+                    path=interface.get_cookie_path(self.app),
+                    domain=interface.get_cookie_domain(self.app),
+                    httponly=True)
+        return response
+
+    def get_engine(self):
+        "Return the engine of the next healthy replica, None if there's none"
+        uris = self.uris
+        for attempt in range(len(uris)):
+            with self._lock:
+                index = self._counter.next() % len(uris)
+            now = time()
+            if self.down.get(index, 0) > now:
+                continue
+            engine = self.db.get_engine(self.app, ('replica', index))
+            interval = self.app.config['SQLALCHEMY_REPLICA_CHECK_INTERVAL']
+            if self.checked.get(index, 0) + interval <= now:
+                self.checked[index] = now
+                if not self.check(engine):
+                    self.down[index] = now + interval
+                    continue
+            return engine
+        return None
+
+    def check(self, engine):
+        "Check the replica answers"
+        try:
+            connection = engine.connect()
+            try:
+                connection.execute('SELECT 1')
+            finally:
+                connection.close()
+        except exc.DBAPIError:
+            return False
+        return True
+
+
+class RoutingSession(_SignallingSession):
+    """A session reading from the replicas while replica_reads is set (see
+    SQLAlchemy.reading), but for the flushes and the users who just wrote
+    something. Models with a bind key keep using their bind. The replica is
+    picked by the first read of the block and kept until its end"""
+
+    def __init__(self, db, **options):
+        self.replica_reads = False
+        # The engine of the reading block, False if no replica is healthy
+        self.replica = None
+        _SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper, clause=None):
+        if self.replica_reads and not self._flushing and \
+                not (mapper is not None and
+                     getattr(mapper.mapped_table, 'info', {}).get('bind_key')):
+            replicas = self.app.extensions.get('db_replicas')
+            if replicas is not None and replicas.uris and \
+                                            not replicas.reads_primary():
+                if self.replica is None:
+                    self.replica = replicas.get_engine() or False
+                if self.replica:
+                    return self.replica
+        return _SignallingSession.get_bind(self, mapper, clause)
+
+
+def replica_reads(view):
+    "Decorate a read-only view so its queries go to the replicas"
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with current_app.extensions['sqlalchemy'].db.reading():
+            return view(*args, **kwargs)
+    return wrapper
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """Flask-SQLAlchemy with the engines tuned for production.
+
+    Server databases (e.g. PostgreSQL) get a TimedQueuePool sized by the
+    SQLALCHEMY_POOL_* configurations, or SERVER_POOL_DEFAULTS, and
+    connections checked out are pinged first. SQLite database files get a
+    pool too, so the pragmas and the page cache of the connections are
+    kept across requests, and every new connection runs the SQLITE_*
+    pragmas. The time spent waiting for a connection is recorded in the
+    request stats and reported by the pool (see pool_stats).
+
+    The reads of the views decorated by replica_reads, or made within
+    reading, go to the SQLALCHEMY_REPLICAS (see ReplicaSet), everything
+    else goes to the primary.
+
+    Configurations:
+        SQLALCHEMY_POOL_SIZE: the connections kept open
+        SQLALCHEMY_MAX_OVERFLOW: the connections opened beyond the pool
+                                 size under load
+        SQLALCHEMY_POOL_TIMEOUT: seconds a checkout waits for a connection
+        SQLALCHEMY_POOL_RECYCLE: seconds after which connections are
+                                 replaced
+        SQLALCHEMY_POOL_PRE_PING: ping the connections on checkout, None
+                                  for server databases only
+        SQLITE_JOURNAL_MODE: the journal mode, WAL lets readers and a
+                             writer work concurrently
+        SQLITE_SYNCHRONOUS: NORMAL is safe with WAL and syncs much less
+        SQLITE_CACHE_SIZE: the page cache, negative values are in KiB
+        SQLITE_MMAP_SIZE: the bytes of the database read through mmap
+        SQLITE_BUSY_TIMEOUT: ms a connection waits for a lock
+        SQLITE_CACHED_STATEMENTS: the prepared statements cached by every
+                                  connection
+        SQLALCHEMY_REPLICAS: the uris of the read replicas
+        SQLALCHEMY_REPLICA_CHECK_INTERVAL: seconds between the checks of a
+                                           replica
+        SQLALCHEMY_REPLICA_LAG: seconds the users who wrote something read
+                                from the primary
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._tuned = WeakKeyDictionary()
+        self._tuned_lock = Lock()
+        BaseSQLAlchemy.__init__(self, *args, **kwargs)
+
+    def init_app(self, app):
+        config = app.config
+        config.setdefault('SQLALCHEMY_MAX_OVERFLOW', None)
+        config.setdefault('SQLALCHEMY_POOL_PRE_PING', None)
+        config.setdefault('SQLITE_JOURNAL_MODE', 'WAL')
+        config.setdefault('SQLITE_SYNCHRONOUS', 'NORMAL')
+        config.setdefault('SQLITE_CACHE_SIZE', -16 * 1024)
+        config.setdefault('SQLITE_MMAP_SIZE', 64 * 1024 * 1024)
+        config.setdefault('SQLITE_BUSY_TIMEOUT', 5000)
+        config.setdefault('SQLITE_CACHED_STATEMENTS', 100)
+        config.setdefault('SQLALCHEMY_REPLICAS', [])
+        config.setdefault('SQLALCHEMY_REPLICA_CHECK_INTERVAL', 30)
+        config.setdefault('SQLALCHEMY_REPLICA_LAG', 10)
+        BaseSQLAlchemy.init_app(self, app)
+        ReplicaSet(self, app)
+
+    def create_scoped_session(self, options=None):
+        if options is None:
+            options = {}
+        scopefunc = options.pop('scopefunc', None)
+        return orm.scoped_session(partial(RoutingSession, self, **options),
+                                  scopefunc=scopefunc)
+
+    def make_connector(self, app, bind=None):
+        if isinstance(bind, tuple):
+            return ReplicaConnector(self, app, bind)
+        return BaseSQLAlchemy.make_connector(self, app, bind)
+
+    @contextmanager
+    def reading(self):
+        """Send the reads of the session to the replicas, all of them to the
+        same replica. Nested blocks keep the replica of the outer one"""
+        session = self.session()
+        previous = session.replica_reads, session.replica
+        if not session.replica_reads:
+            session.replica_reads = True
+            session.replica = None
+        try:
+            yield session
+        finally:
+            session.replica_reads, session.replica = previous
+
+    def apply_pool_defaults(self, app, options):
+        BaseSQLAlchemy.apply_pool_defaults(self, app, options)
+        if app.config['SQLALCHEMY_MAX_OVERFLOW'] is not None:
+            options['max_overflow'] = app.config['SQLALCHEMY_MAX_OVERFLOW']
+
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername.startswith('sqlite'):
+            connect_args = options.setdefault('connect_args', {})
+            connect_args['cached_statements'] = \
+                                    app.config['SQLITE_CACHED_STATEMENTS']
+            if info.database not in (None, '', ':memory:'):
+                options.setdefault('pool_size', SQLITE_POOL_SIZE)
+                # Pooled connections are shared by the request threads
+                connect_args['check_same_thread'] = False
+                options.setdefault('poolclass', TimedQueuePool)
+        else:
+            # MySQL has its own defaults in Flask-SQLAlchemy
+            if info.drivername != 'mysql':
+                for option, value in SERVER_POOL_DEFAULTS.items():
+                    options.setdefault(option, value)
+            options.setdefault('poolclass', TimedQueuePool)
+        BaseSQLAlchemy.apply_driver_hacks(self, app, info, options)
+
+    def get_engine(self, app, bind=None):
+        engine = BaseSQLAlchemy.get_engine(self, app, bind)
+        # Engines are created lazily, and again if the uri changes
+        if engine not in self._tuned:
+            with self._tuned_lock:
+                if engine not in self._tuned:
+                    self.tune_engine(app, engine)
+                    self._tuned[engine] = True
+        return engine
+
+    def tune_engine(self, app, engine):
+        "Register the pragmas and the ping on the connections of the engine"
+        config = app.config
+        is_sqlite = engine.dialect.name == 'sqlite'
+        if is_sqlite:
+            pragmas = [('journal_mode', config['SQLITE_JOURNAL_MODE']),
+                       ('synchronous', config['SQLITE_SYNCHRONOUS']),
+                       ('cache_size', config['SQLITE_CACHE_SIZE']),
+                       ('mmap_size', config['SQLITE_MMAP_SIZE']),
+                       ('busy_timeout', config['SQLITE_BUSY_TIMEOUT'])]
+            event.listen(engine, 'connect', set_sqlite_pragmas(
+                    [(name, value) for name, value in pragmas
+                                                    if value is not None]))
+
+        pre_ping = config['SQLALCHEMY_POOL_PRE_PING']
+        if pre_ping or (pre_ping is None and not is_sqlite):
+            event.listen(engine, 'checkout', ping_connection)
+
+    def pool_stats(self, app=None):
+        "Return the stats of the pool of the engine, if it's timed"
+        pool = self.get_engine(self.get_app(app)).pool
+        if isinstance(pool, TimedQueuePool):
+            return pool.stats()
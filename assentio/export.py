@@ -0,0 +1,192 @@
+import os
+import re
+import json
+from collections import deque
+from urlparse import urlsplit
+
+from werkzeug.urls import url_unquote
+
+from assentio.utils import write_atomic
+
+# Links of these paths are followed, to export all the listing pages
+LISTINGS = ('/', '/feed')
+
+link_re = re.compile(r'href="([^"]+)"')
+
+# Extensions of the exported files, by mimetype
+EXTENSIONS = {'text/html': '.html', 'application/rss+xml': '.xml'}
+
+
+def export_path(url, mimetype):
+    """Return the file, relative to the export directory, of the url: the
+    query string (if any) is part of the file name
+
+        / -> index.html
+        /?before=<cursor> -> index.before=<cursor>.html
+        /post/hello -> post/hello.html
+        /feed?page=2 -> feed.page=2.xml
+    """
+    parts = urlsplit(url)
+    path = url_unquote(parts.path)
+    if path.endswith('/'):
+        path += 'index'
+    if parts.query:
+        path += '.%s' % parts.query.replace('/', '%2F')
+    return path.lstrip('/') + EXTENSIONS.get(mimetype, '.html')
+
+
+class SiteExporter(object):
+    """Render the public site, as seen by anonymous users, into a directory
+    tree of static files with their precompressed .gz (and .br, if the
+    brotli module is installed) siblings.
+
+    The listings are exported by following their links from the home page
+    and the feed, every public post and page by its shortname. The post id
+    urls, which redirect to the shortname ones, are written as an nginx
+    include in redirects.conf.
+
+    Exports are incremental: the ETag of every file is kept in
+    manifest.json and sent back on the next export, so the pages whose
+    contents didn't change are answered with a 304 and not rendered again.
+    Files of pages not existing anymore are removed.
+
+    The directory can be served by nginx, falling back to the app for the
+    admin and the login:
+
+        location = / {
+            try_files /index.before=$arg_before.html
+                      /index.after=$arg_after.html /index.html @assentio;
+        }
+        location = /feed {
+            default_type application/rss+xml;
+            try_files /feed.page=$arg_page.xml /feed.xml @assentio;
+        }
+        location /post/ {
+            include <directory>/redirects.conf;
+            try_files $uri.html @assentio;
+        }
+    """
+
+    def __init__(self, app, directory, base_url='http://localhost/'):
+        self.app = app
+        self.directory = os.path.abspath(directory)
+        self.base_url = base_url
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+
+    def export(self):
+        """Export the site, return the {'rendered', 'unchanged', 'removed'}
+        counts of files"""
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        manifest = self.load_manifest()
+        exported = {}
+        redirects = {}
+        counts = {'rendered': 0, 'unchanged': 0, 'removed': 0}
+
+        client = self.app.test_client()
+        queue = deque(self.get_urls())
+        queued = set(queue)
+
+        while queue:
+            url = queue.popleft()
+            entry = manifest.get(url)
+
+            headers = {}
+            if entry and os.path.exists(self._path(entry['file'])):
+                headers['If-None-Match'] = entry['etag']
+
+            response = client.get(url, base_url=self.base_url,
+                                  headers=headers)
+
+            if response.status_code == 304:
+                exported[url] = entry
+                counts['unchanged'] += 1
+                with open(self._path(entry['file']), 'rb') as stored:
+                    body = stored.read()
+
+            elif response.status_code == 200:
+                body = response.data
+                entry = {'file': export_path(url, response.mimetype),
+                         'etag': response.headers.get('ETag')}
+                if not self._path(entry['file']).startswith(self.directory):
+                    continue
+                self.write(entry['file'], body)
+                exported[url] = entry
+                counts['rendered'] += 1
+
+            else:
+                if response.status_code in (301, 302):
+                    redirects[url] = self._local(
+                                            response.headers['Location'])
+                continue
+
+            # Follow the links to the other listing pages
+            for link in link_re.findall(body):
+                link = self._local(link.replace('&amp;', '&'))
+                if link and urlsplit(link).path in LISTINGS and \
+                                                    link not in queued:
+                    queued.add(link)
+                    queue.append(link)
+
+        # Remove the pages not existing anymore
+        files = set(entry['file'] for entry in exported.values())
+        for url, entry in manifest.items():
+            if url not in exported and entry['file'] not in files:
+                self.remove(entry['file'])
+                counts['removed'] += 1
+
+        self.write_redirects(redirects)
+        self.write('manifest.json', json.dumps(exported, indent=2,
+                                               sort_keys=True),
+                   compress=False)
+        return counts
+
+    def get_urls(self):
+        "Return the urls of the contents to export"
+        from assentio.apps.blog import Post
+
+        urls = list(LISTINGS)
+        with self.app.app_context():
+            for post_id, shortname in Post.query.filter_by(state='public')\
+                            .with_entities(Post.id, Post.stored_shortname):
+                urls.append('/post/%s' % shortname)
+                urls.append('/post/%d' % post_id)
+        return urls
+
+    def load_manifest(self):
+        "Return the {url: {'file', 'etag'}} of the last export"
+        try:
+            with open(self.manifest_path) as stored:
+                return json.load(stored)
+        except (IOError, ValueError):
+            return {}
+
+    def write(self, name, data, compress=True):
+        "Write atomically the file and its precompressed copies"
+        write_atomic(self._path(name), data, precompress=compress)
+
+    def remove(self, name):
+        path = self._path(name)
+        for suffix in ('', '.gz', '.br'):
+            try:
+                os.remove(path + suffix)
+            except OSError:
+                pass
+
+    def write_redirects(self, redirects):
+        "Write the redirects as an nginx include"
+        lines = ['location = %s { return 302 %s; }' % (url, location)
+                                for url, location in sorted(redirects.items())]
+        self.write('redirects.conf', '\n'.join(lines) + '\n', compress=False)
+
+    def _path(self, name):
+        return os.path.normpath(os.path.join(self.directory, name))
+
+    def _local(self, url):
+        "Return the path and query of the url if it's a site one, or None"
+        if url.startswith(self.base_url):
+            url = '/' + url[len(self.base_url):]
+        if url.startswith('/') and not url.startswith('//'):
+            return url
+        return None
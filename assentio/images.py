@@ -0,0 +1,274 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+
+from jinja2 import Markup, escape
+from flask.helpers import safe_join
+from flask.signals import Namespace
+
+from assentio.utils import write_atomic
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger('assentio.images')
+
+# The derivatives of the images: (name, width), images are never upscaled
+VARIANTS = (('thumbnail', 320), ('content', 770), ('retina', 1540))
+
+# The formats of the derivatives, by format of the original. Images of other
+# formats (e.g. animated gifs) are sent as they are
+FORMATS = {'JPEG': '.jpg', 'PNG': '.png'}
+
+# The folder of the derivatives, within the media folder
+DERIVED_FOLDER = 'derived'
+
+# The file of the derived folder rewritten when derivatives are ready, see
+# ImageDerivatives.generation
+GENERATION_FILE = 'generation'
+
+# The EXIF orientation tag, and the transpositions undoing its values
+ORIENTATION_TAG = 0x0112
+TRANSPOSITIONS = {2: 'FLIP_LEFT_RIGHT', 3: 'ROTATE_180', 4: 'FLIP_TOP_BOTTOM',
+                  5: 'TRANSPOSE', 6: 'ROTATE_270', 7: 'TRANSVERSE',
+                  8: 'ROTATE_90'}
+
+signals = Namespace()
+
+# Sent by the app once the derivatives of an image are ready, the pages
+# rendered with the original are out of date
+derivatives_ready = signals.signal('derivatives-ready')
+
+
+def orient(image):
+    "Return the image transposed as its EXIF orientation says"
+    try:
+        exif = image._getexif() or {}
+    except Exception:
+        # Not a JPEG, or broken EXIF data
+        return image
+    method = TRANSPOSITIONS.get(exif.get(ORIENTATION_TAG))
+    if method is None:
+        return image
+    return image.transpose(getattr(Image, method))
+
+
+class ImageInfo(object):
+    "An image with its dimensions and its derivatives, if known"
+
+    def __init__(self, src, width=None, height=None, variants=()):
+        self.src = src
+        self.width = width
+        self.height = height
+        # [(url, width, height)], the smallest first
+        self.variants = variants
+
+    @property
+    def srcset(self):
+        if not self.variants:
+            return None
+        candidates = list(self.variants)
+        if self.width > candidates[-1][1]:
+            candidates.append((self.src, self.width, self.height))
+        return ', '.join('%s %dw' % (url, width)
+                                        for url, width, height in candidates)
+
+    def attributes(self, sizes=None):
+        "Return the src, srcset, sizes, width and height attributes"
+        attributes = [('src', self.src)]
+        if self.srcset:
+            attributes.append(('srcset', self.srcset))
+            if sizes:
+                attributes.append(('sizes', sizes))
+        if self.width:
+            attributes.append(('width', self.width))
+            attributes.append(('height', self.height))
+        return Markup(' '.join('%s="%s"' % (name, escape(value))
+                                            for name, value in attributes))
+
+
+class ImageDerivatives(object):
+    """Resized and recompressed variants of the images of the media folder.
+
+    The derivatives are generated by a pool of IMAGE_WORKERS threads, when a
+    file is uploaded or the first time an image is rendered: until then the
+    original is sent, and once they're ready the generation changes so the
+    pages rendered meanwhile are rendered again (see get_page_validators
+    and PageCacheMiddleware). They're stored in the media derived folder, named
+    after the hash of the original contents, along with a json file with
+    the dimensions of the original and of its variants. The dimensions are
+    cached in memory too, so templates can emit the srcset, width and height
+    attributes without touching the images.
+
+    Derivatives are generated only if Pillow is installed.
+
+    Configurations:
+        IMAGE_VARIANTS: the (name, width) of the derivatives
+        IMAGE_QUALITY: the JPEG quality of the derivatives
+        IMAGE_WORKERS: the threads generating the derivatives
+    """
+
+    def __init__(self, app, media_url='/media'):
+        self.app = app
+        self.media_path = os.path.join(app.instance_path, 'media')
+        self.media_url = media_url
+        self.variants = app.config['IMAGE_VARIANTS']
+        self.quality = app.config['IMAGE_QUALITY']
+        self.workers = app.config['IMAGE_WORKERS']
+        self.enabled = Image is not None
+        self.generation_path = os.path.join(self.media_path, DERIVED_FOLDER,
+                                            GENERATION_FILE)
+
+        # {(path, mtime, size): ImageInfo}
+        self.infos = {}
+        # {path: AsyncResult} of the images being processed
+        self.pending = {}
+        self._lock = Lock()
+        self._pool = None
+
+        app.extensions['images'] = self
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            return self._pool
+
+    @property
+    def generation(self):
+        """The modification time of the generation file, shared by all the
+        workers, None if no derivative has been generated yet"""
+        try:
+            return os.path.getmtime(self.generation_path)
+        except OSError:
+            return None
+
+    def local_path(self, url):
+        "Return the path of the media file of the url, if it's a media one"
+        prefix = self.media_url + '/'
+        if not url or not url.startswith(prefix) or \
+                url.startswith(prefix + DERIVED_FOLDER + '/'):
+            return None
+        return safe_join(self.media_path, url[len(prefix):].split('?')[0])
+
+    def url(self, path):
+        "Return the url of the media file"
+        return '%s/%s' % (self.media_url, os.path.relpath(
+                                path, self.media_path).replace(os.sep, '/'))
+
+    def info(self, url):
+        """Return the ImageInfo of the image url. Derivatives not generated
+        yet are scheduled, never generated on the request thread"""
+        path = self.local_path(url)
+        if not self.enabled or path is None:
+            return ImageInfo(url)
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return ImageInfo(url)
+
+        info = self.infos.get((path, stat.st_mtime, stat.st_size))
+        if info is not None:
+            return info
+
+        self.submit(path)
+        return ImageInfo(url)
+
+    def submit(self, path):
+        "Generate the derivatives of the image in the pool"
+        pool = self.pool
+        with self._lock:
+            result = self.pending.get(path)
+            if result is None:
+                result = self.pending[path] = pool.apply_async(self._derive,
+                                                               (path,))
+        return result
+
+    def _derive(self, path):
+        try:
+            info = self.derive(path)
+            if info.variants:
+                write_atomic(self.generation_path, path)
+                derivatives_ready.send(self.app)
+            return info
+        except Exception:
+            logger.exception('Cannot generate the derivatives of %s', path)
+            # Not retried until the file changes
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return
+            self.infos[(path, stat.st_mtime, stat.st_size)] = \
+                                                    ImageInfo(self.url(path))
+        finally:
+            with self._lock:
+                self.pending.pop(path, None)
+
+    def derive(self, path):
+        "Generate the derivatives of the image, return its ImageInfo"
+        stat = os.stat(path)
+        with open(path, 'rb') as original:
+            data = original.read()
+        digest = hashlib.sha1(data).hexdigest()
+
+        folder = os.path.join(self.media_path, DERIVED_FOLDER, digest[:2])
+        metadata_path = os.path.join(folder, '%s.json' % digest)
+        try:
+            with open(metadata_path) as stored:
+                metadata = json.load(stored)
+        except (IOError, ValueError):
+            metadata = self.resize(path, folder, digest)
+            write_atomic(metadata_path, json.dumps(metadata))
+
+        info = ImageInfo(self.url(path), metadata['width'], metadata['height'],
+                         [('%s/%s/%s/%s' % (self.media_url, DERIVED_FOLDER,
+                                            digest[:2], filename),
+                           width, height)
+                          for filename, width, height in metadata['variants']])
+        self.infos[(path, stat.st_mtime, stat.st_size)] = info
+        return info
+
+    def resize(self, path, folder, digest):
+        """Write the variants of the image, return the metadata of the
+        original and of the variants"""
+        image = Image.open(path)
+        extension = FORMATS.get(image.format)
+        # Phone photos are stored sideways, with their orientation in EXIF
+        image = orient(image)
+        width, height = image.size
+        metadata = {'width': width, 'height': height, 'variants': []}
+
+        if extension is None:
+            return metadata
+
+        if image.mode not in ('RGB', 'RGBA', 'L'):
+            image = image.convert(extension == '.png' and 'RGBA' or 'RGB')
+
+        for name, variant_width in self.variants:
+            if variant_width >= width:
+                break
+            variant_height = max(1, height * variant_width // width)
+            variant = image.resize((variant_width, variant_height),
+                                   Image.ANTIALIAS)
+
+            buf = tempfile.SpooledTemporaryFile()
+            if extension == '.jpg':
+                variant.save(buf, 'JPEG', quality=self.quality,
+                             optimize=True, progressive=True)
+            else:
+                variant.save(buf, 'PNG', optimize=True)
+            buf.seek(0)
+
+            filename = '%s-%d%s' % (digest, variant_width, extension)
+            write_atomic(os.path.join(folder, filename), buf.read())
+            metadata['variants'].append((filename, variant_width,
+                                         variant_height))
+        return metadata
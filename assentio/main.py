@@ -1,13 +1,23 @@
 import os
 from flask import (Flask, render_template, Blueprint, current_app, request,
-                   abort)
-from flask_debugtoolbar import DebugToolbarExtension
+                   abort, make_response)
 
-from assentio.middlewares import SimpleCachingMiddleware
+from assentio.middlewares import (SimpleCachingMiddleware, PageCacheMiddleware,
+                                  CompressionMiddleware,
+                                  InstrumentationMiddleware, TimedTemplate)
 
-from utils import datetimeformat
+from media import MediaFiles
+from assets import AssetManifest
+from startup import BootstrapTimer
+from database import replica_reads
+from images import ImageDerivatives, VARIANTS
+from roles import ROLES, AnonymousUsers, LazyAdmin
+from templating import TemplateCache
+from utils import datetimeformat, not_modified, set_validators
 
-MIDDLEWARES = (SimpleCachingMiddleware,)
+# The first one is the innermost: the page cache stores the compressed pages
+MIDDLEWARES = (SimpleCachingMiddleware, CompressionMiddleware,
+               PageCacheMiddleware, InstrumentationMiddleware)
 
 # Applying the Application Factory pattern
 # http://bit.ly/Pjc5N3, slide 53
@@ -17,19 +27,37 @@ bp = Blueprint('common', __name__)
 
 # defining routes
 @bp.route('/')
+@replica_reads
 def index():
     blog_app = current_app.extensions['blog']
 
-    # Retrieve the pagenumber for pagination if any
-    # Default page is 1
-    page = request.args.get('page', 1)
-    try:
-        page = int(page)
-    except ValueError:
-        return abort(404)
-
-    arguments = blog_app.get_all_page_components(page=page)
-    return render_template('index.html', **arguments)
+    # Answer with a 304 before building anything if the client is fresh
+    etag, last_modified = blog_app.get_page_validators()
+    response = not_modified(etag, last_modified)
+    if response:
+        return response
+
+    # Numbered pages are still supported, but the listing is walked with the
+    # before/after cursors which don't need OFFSET and COUNT queries
+    if 'page' in request.args:
+        try:
+            page = int(request.args['page'])
+        except ValueError:
+            return abort(404)
+        arguments = blog_app.get_all_page_components(page=page)
+    else:
+        before = request.args.get('before')
+        after = request.args.get('after')
+        try:
+            posts = blog_app.get_posts_page(before=before, after=after)
+        except ValueError:
+            return abort(404)
+        if not posts.items and (before or after):
+            return abort(404)
+        arguments = blog_app.get_all_page_components(posts=posts)
+
+    response = make_response(render_template('index.html', **arguments))
+    return set_validators(response, etag, last_modified)
 
 
 def create_flask_app(config_file=None, config_object=None, **kwargs):
@@ -37,12 +65,35 @@ def create_flask_app(config_file=None, config_object=None, **kwargs):
         :param db: A Flask-SQLAlchemy instance
         :param bcrypt: (optional) -> A Flask-Bcrypt instance
     """
+    timer = BootstrapTimer()
     app = Flask(__name__)
 
     # Setting default values
     app.config['SECRET_KEY'] = 'test'
     app.debug = True
 
+    # The deployment role of the process, see assentio.roles
+    app.config['ASSENTIO_ROLE'] = 'all'
+
+    # Server-side page cache for anonymous users, see PageCacheMiddleware
+    app.config['PAGE_CACHE_BACKEND'] = 'memory'
+    app.config['PAGE_CACHE_TIMEOUT'] = 300
+    app.config['PAGE_CACHE_MAX_SIZE'] = 32 * 1024 * 1024
+    app.config['PAGE_CACHE_DIR'] = os.path.join(app.instance_path,
+                                                'page_cache')
+
+    # Per-request SQL and render timings, see InstrumentationMiddleware
+    app.config['INSTRUMENTATION_ENABLED'] = True
+    app.config['INSTRUMENTATION_WINDOW'] = 1000
+
+    # Fingerprinted static files, see AssetManifest
+    app.config['ASSETS_FOLDER'] = 'assets'
+
+    # Resized variants of the media images, see ImageDerivatives
+    app.config['IMAGE_VARIANTS'] = VARIANTS
+    app.config['IMAGE_QUALITY'] = 82
+    app.config['IMAGE_WORKERS'] = 2
+
     # Creating instance path
     if not os.path.exists(app.instance_path):
         os.makedirs(app.instance_path)
@@ -51,27 +102,33 @@ def create_flask_app(config_file=None, config_object=None, **kwargs):
         db_path = 'sqlite:///%s/%s' % (app.instance_path, 'blog.db')
         app.config['SQLALCHEMY_DATABASE_URI'] = db_path
 
-    # first override configurations from object if any
-    if config_object:
-        app.config.from_object(config_object)
+    with timer.step('configuration'):
+        # first override configurations from object if any
+        if config_object:
+            app.config.from_object(config_object)
 
-    # then override configurations from file if any
-    if config_file:
-        app.config.from_pyfile(config_file)
+        # then override configurations from file if any
+        if config_file:
+            app.config.from_pyfile(config_file)
 
-    # then override configuration from envvar
-    if 'ASSENTIO_SETTINGS' in os.environ:
-        app.config.from_envvar('ASSENTIO_SETTINGS')
+        # then override configuration from envvar
+        if 'ASSENTIO_SETTINGS' in os.environ:
+            app.config.from_envvar('ASSENTIO_SETTINGS')
+        if 'ASSENTIO_ROLE' in os.environ:
+            app.config['ASSENTIO_ROLE'] = os.environ['ASSENTIO_ROLE']
 
-    if app.debug and not app.config.get('TESTING', None):
-        app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-        app.config['DEBUG_TB_PROFILER_ENABLED'] = True
-        app.config['DEBUG_TB_TEMPLATE_EDITOR_ENABLED'] = True
-        DebugToolbarExtension(app)
+    role = app.config['ASSENTIO_ROLE']
+    if role not in ROLES:
+        raise ValueError('Unknown ASSENTIO_ROLE %r, not one of %s' % (
+                                                    role, ', '.join(ROLES)))
 
-    from .apps.login import LoginManager
-    from .apps.admin import AdminApp
-    from .apps.blog import BlogApp
+    if app.debug and not app.config.get('TESTING', None):
+        with timer.step('debug toolbar'):
+            from flask_debugtoolbar import DebugToolbarExtension
+            app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+            app.config['DEBUG_TB_PROFILER_ENABLED'] = True
+            app.config['DEBUG_TB_TEMPLATE_EDITOR_ENABLED'] = True
+            DebugToolbarExtension(app)
 
     # Ensure we have an extensions registry on the app
     if not hasattr(app, 'extensions'):
@@ -79,34 +136,80 @@ def create_flask_app(config_file=None, config_object=None, **kwargs):
 
     # registering apps / exensions
     if 'db' in kwargs:
-        kwargs['db'].init_app(app)
+        with timer.step('sqlalchemy'):
+            kwargs['db'].init_app(app)
 
     if 'bcrypt' in kwargs:
-        kwargs['bcrypt'].init_app(app)
-        # Store the bcrypt object in the extensions registry
-        app.extensions['bcrypt'] = kwargs['bcrypt']
-
-    login_manager = LoginManager()
-    login_manager.init_app(app)
-    AdminApp(app, 'assentio')
-    BlogApp(app)
+        with timer.step('bcrypt'):
+            kwargs['bcrypt'].init_app(app)
+            # Store the bcrypt object in the extensions registry
+            app.extensions['bcrypt'] = kwargs['bcrypt']
+
+    with timer.step('media'):
+        MediaFiles(app)
+
+    # Public workers serve anonymous users only, the admin is mounted on
+    # its first request unless this is an admin worker
+    if role == 'public':
+        with timer.step('anonymous users'):
+            AnonymousUsers(app)
+    else:
+        with timer.step('login'):
+            from .apps.login import LoginManager
+            login_manager = LoginManager()
+            login_manager.init_app(app)
+    if role == 'admin':
+        with timer.step('admin'):
+            from .apps.admin import AdminApp
+            AdminApp(app, 'assentio')
+    elif role == 'all':
+        LazyAdmin(app, 'assentio')
+
+    with timer.step('blog'):
+        from .apps.blog import BlogApp
+        BlogApp(app)
+    with timer.step('assets'):
+        AssetManifest(app)
+    with timer.step('images'):
+        ImageDerivatives(app)
+    with timer.step('templates'):
+        templates = TemplateCache(app)
 
     # applying middlewares
-    for mw in MIDDLEWARES:
-        app.wsgi_app = mw(app.wsgi_app)
+    with timer.step('middlewares'):
+        for mw in MIDDLEWARES:
+            app.wsgi_app = mw(app.wsgi_app, app)
 
     app.register_blueprint(bp)
 
-    # register jinja filters
-    jinja_environment = app.create_jinja_environment()
-    jinja_environment.filters['datetimeformat'] = datetimeformat
-    app.create_jinja_environment = lambda *args: jinja_environment
-
+    # The jinja environment is built on the first render
+    create_jinja_environment = app.create_jinja_environment
+
+    def create_configured_environment():
+        # The bytecode cache and the auto reload, see TemplateCache
+        app.jinja_options = dict(app.jinja_options,
+                                 **templates.jinja_options())
+        jinja_environment = create_jinja_environment()
+        jinja_environment.template_class = TimedTemplate
+        # register jinja filters
+        jinja_environment.filters['datetimeformat'] = datetimeformat
+        assets = app.extensions['assets']
+        jinja_environment.globals['asset_url'] = assets.url
+        jinja_environment.globals['asset_bundle'] = assets.bundle_urls
+        jinja_environment.globals['image_info'] = \
+                                            app.extensions['images'].info
+        return jinja_environment
+
+    app.create_jinja_environment = create_configured_environment
+
+    # See assentio.startup
+    app.extensions['startup'] = timer.steps
     return app
 
 
 def runserver():
-    from . import app
+    from . import get_app
+    app = get_app()
     if app.config['TESTING'] == True:
         app.logger.error("Hey... you're running in TESTING mode.. keep your"
                          " eyes open")
@@ -1,10 +1,13 @@
 import os
-from flask.ext.script import Manager
+import sys
+import subprocess
+from flask.ext.script import Manager, Command
+from sqlalchemy.engine.reflection import Inspector
 
-from assentio import app as main_app
-from assentio.apps.login import User
+from assentio import get_app, startup
 
-manager = Manager(main_app)
+# The app is created only when a command runs
+manager = Manager(get_app)
 
 
 @manager.command
@@ -14,8 +17,8 @@ def syncdb():
 
 
 def _syncdb(app=None):
-    # using main_app if an app is not passed
-    app = app or main_app
+    # using the default app if an app is not passed
+    app = app or get_app()
 
     #app.logger.info('Syncing db...')
 
@@ -39,6 +42,174 @@ def _syncdb(app=None):
         app.extensions['sqlalchemy'].db.create_all()
 
 
+@manager.command
+def migratedb():
+    'Add the missing columns and indexes to an existing db'
+    for action in _migratedb():
+        print action
+
+
+def _migratedb(app=None):
+    """Bring an existing db up to date with the models: create the missing
+    tables, add the missing nullable columns and create the missing indexes.
+    Return the list of the applied changes"""
+    # using the default app if an app is not passed
+    app = app or get_app()
+
+    # create the missing tables
+    _syncdb(app)
+
+    actions = []
+    with app.app_context():
+        db = app.extensions['sqlalchemy'].db
+        engine = db.engine
+        inspector = Inspector.from_engine(engine)
+        # Quote the names which are reserved words, like page.order
+        preparer = engine.dialect.identifier_preparer
+
+        for table in db.metadata.sorted_tables:
+            columns = set(column['name'] for column in
+                                        inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+
+                # Columns requiring a value can't be added automatically
+                if not column.nullable:
+                    actions.append('Column %s.%s must be added by hand' %
+                                                    (table.name, column.name))
+                    continue
+
+                engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                            preparer.format_table(table),
+                            preparer.format_column(column),
+                            column.type.compile(dialect=engine.dialect)))
+                actions.append('Added column %s.%s' %
+                                                    (table.name, column.name))
+
+            indexes = set(index['name'] for index in
+                                        inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(bind=engine)
+                    actions.append('Created index %s' % index.name)
+
+    return actions
+
+
+@manager.command
+def explain():
+    'Show the query plans of the most frequent queries'
+    for name, plan in _explain():
+        print '%s:' % name
+        for row in plan:
+            print '    %s' % ' '.join(map(unicode, row))
+
+
+def _explain(app=None):
+    """Return the [(name, query plan rows)] of the queries run by the public
+    pages, as seen by an anonymous user"""
+    # using the default app if an app is not passed
+    app = app or get_app()
+
+    with app.test_request_context():
+        app.preprocess_request()
+
+        db = app.extensions['sqlalchemy'].db
+        blog_app = app.extensions['blog']
+        from assentio.apps.blog import Post, Page
+        newest = (Post.date.desc(), Post.id.desc())
+
+        queries = [
+            ('home page', blog_app.get_all_posts().order_by(*newest)),
+            ('feed', blog_app.get_all_posts(unrestricted=True)
+                                .filter_by(state='public').order_by(*newest)),
+            ('post', Post.query.filter_by(stored_shortname='shortname')),
+            ('pages', Page.query.join(Post).filter(Post.state == 'public')
+                                                    .order_by(Page.order)),
+            ('social buttons', blog_app.get_social_buttons(ordered=True)),
+        ]
+        for portlet_class in blog_app.portlet_classes.values():
+            queries.append(('%s portlets' % portlet_class.type,
+                            portlet_class.query
+                                .filter(portlet_class.slot_id.in_([1, 2]))
+                                .filter(portlet_class.state == 'public')
+                                .order_by(portlet_class.order)))
+
+        return [(name, _query_plan(db.engine, query.limit(5)))
+                                                for name, query in queries]
+
+
+def _query_plan(engine, query):
+    "Return the rows of the db query plan"
+    compiled = query.statement.compile(dialect=engine.dialect)
+
+    prefix = 'EXPLAIN'
+    if engine.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN'
+
+    params = compiled.params
+    if compiled.positional:
+        params = [params[name] for name in compiled.positiontup]
+
+    return engine.execute('%s %s' % (prefix, compiled), params).fetchall()
+
+
+@manager.command
+def reindex():
+    'Rebuild the posts full-text search index'
+    print 'Indexed %d posts' % _reindex()
+
+
+def _reindex(app=None):
+    "Rebuild the search index, return the number of indexed posts"
+    # using the default app if an app is not passed
+    app = app or get_app()
+
+    with app.app_context():
+        return app.extensions['blog'].search_index.reindex()
+
+
+@manager.option('-d', '--directory', dest='directory', default=None,
+                help='where the site is exported (default: instance/export)')
+@manager.option('-u', '--base-url', dest='base_url', default=None,
+                help='the url the site is served from')
+def export(directory, base_url):
+    'Export the public site as static files'
+    counts = _export(directory, base_url)
+    print '%(rendered)d files rendered, %(unchanged)d unchanged, ' \
+          '%(removed)d removed' % counts
+
+
+def _export(directory=None, base_url=None, app=None):
+    "Export the site, return the counts of rendered/unchanged/removed files"
+    # using the default app if an app is not passed
+    app = app or get_app()
+
+    directory = directory or os.path.join(app.instance_path, 'export')
+    base_url = base_url or app.config.get('EXPORT_BASE_URL',
+                                          'http://localhost/')
+    from assentio.export import SiteExporter
+    return SiteExporter(app, directory, base_url).export()
+
+
+@manager.command
+def buildassets():
+    'Fingerprint, bundle and precompress the static files'
+    manifest = _buildassets()
+    print 'Built %d assets' % len(manifest)
+
+
+def _buildassets(app=None):
+    "Build the assets, return the manifest"
+    # using the default app if an app is not passed
+    app = app or get_app()
+
+    from assentio.assets import AssetManifest
+    assets = app.extensions.get('assets') or AssetManifest(app)
+    return assets.build()
+
+
 @manager.command
 def adduser(username, password):
     'Add a user'
@@ -46,12 +217,13 @@ def adduser(username, password):
 
 
 def _adduser(username, password, app=None):
-    # using main_app if an app is not passed
-    app = app or main_app
+    # using the default app if an app is not passed
+    app = app or get_app()
 
     # put the app in debug for logging purpose
     app.debug = True
 
+    from assentio.apps.login import User
     admin = User(username)
     admin.password = password
     try:
@@ -66,6 +238,43 @@ def _adduser(username, password, app=None):
     app.debug = False
 
 
+class StartupProfile(Command):
+    'Show the import and bootstrap times of the app in a new process'
+
+    def run(self):
+        # The modules imported by this process would be free
+        script = os.path.splitext(startup.__file__)[0] + '.py'
+        return subprocess.call([sys.executable, script])
+
+manager.add_command('startup-profile', StartupProfile())
+
+
+class CompileTemplates(Command):
+    'Compile the templates into the bytecode cache, see TemplateCache'
+
+    def run(self):
+        compiled, errors = _compile_templates()
+        for name, error in sorted(errors.items()):
+            print '%s: %s' % (name, error)
+        print 'Compiled %d templates, %d errors' % (len(compiled),
+                                                    len(errors))
+        return errors and 1 or 0
+
+manager.add_command('compile-templates', CompileTemplates())
+
+
+def _compile_templates(app=None):
+    "Compile the templates, return the compiled ones and the errors"
+    # using the default app if an app is not passed
+    app = app or get_app()
+
+    # The admin templates too
+    lazy_admin = app.extensions.get('lazy_admin')
+    if lazy_admin:
+        lazy_admin.mount()
+    return app.extensions['templates'].compile()
+
+
 def manage():
     manager.run()
 
@@ -0,0 +1,180 @@
+import os
+import mimetypes
+from zlib import adler32
+from datetime import datetime
+
+from flask import Blueprint, current_app, request, abort
+from flask.helpers import safe_join
+from werkzeug.http import http_date, is_resource_modified
+from werkzeug.urls import url_quote
+from werkzeug.wsgi import wrap_file
+
+# The precompressed siblings of the files, by preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# Byte ranges are streamed in chunks of this size
+CHUNK_SIZE = 64 * 1024
+
+
+def send_media(directory, filename):
+    """Send a file of the media folder.
+
+    The transfer is delegated to the front server through the MEDIA_SENDFILE
+    configuration:
+        'x-sendfile': the X-Sendfile header with the file path (Apache
+                      mod_xsendfile, lighttpd)
+        'x-accel-redirect': the X-Accel-Redirect header with the file under
+                      the MEDIA_ACCEL_PREFIX internal location (nginx)
+        None: the file is sent by the app itself, see serve_file
+    """
+    path = safe_join(directory, filename)
+    if not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    mode = current_app.config['MEDIA_SENDFILE']
+
+    if mode == 'x-sendfile':
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Sendfile'] = path
+    elif mode == 'x-accel-redirect':
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = '%s/%s' % (
+                    current_app.config['MEDIA_ACCEL_PREFIX'].rstrip('/'),
+                    url_quote(filename))
+    elif mode is None:
+        response = serve_file(path, mimetype)
+    else:
+        raise ValueError('Unknown MEDIA_SENDFILE %r' % mode)
+    return response
+
+
+def find_variant(path):
+    """Return the path and the encoding of the precompressed sibling of the
+    file accepted by the client, if any, and whether any sibling exists"""
+    accepted = request.accept_encodings
+    mtime = os.path.getmtime(path)
+    found = False
+
+    for encoding, suffix in ENCODINGS:
+        variant = path + suffix
+        # Stale siblings are ignored
+        if not os.path.isfile(variant) or \
+                                    os.path.getmtime(variant) < mtime:
+            continue
+        found = True
+        if accepted[encoding]:
+            return variant, encoding, found
+    return path, None, found
+
+
+def serve_file(path, mimetype):
+    """Send the file, or its precompressed sibling, supporting conditional
+    requests and single byte ranges. Whole files are sent through the
+    wsgi.file_wrapper of the server, if any, which can use sendfile"""
+    path, encoding, has_variants = find_variant(path)
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = 'media-%d-%d-%08x' % (stat.st_mtime, size,
+                                  adler32(path) & 0xffffffff)
+    last_modified = datetime.utcfromtimestamp(int(stat.st_mtime))
+
+    response = current_app.response_class(mimetype=mimetype,
+                                          direct_passthrough=True)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Accept-Ranges'] = 'bytes'
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if has_variants:
+        response.headers['Vary'] = 'Accept-Encoding'
+
+    if not is_resource_modified(request.environ, etag=etag,
+                                last_modified=last_modified):
+        response.status_code = 304
+        return response
+
+    byte_range = get_range(size, etag, last_modified)
+    if byte_range is False:
+        response.status_code = 416
+        response.headers['Content-Range'] = 'bytes */%d' % size
+        return response
+
+    stored = open(path, 'rb')
+    if byte_range is None:
+        response.response = wrap_file(request.environ, stored)
+        response.content_length = size
+    else:
+        start, stop = byte_range
+        response.status_code = 206
+        response.response = read_range(stored, start, stop)
+        response.content_length = stop - start
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                                                    start, stop - 1, size)
+    return response
+
+
+def get_range(size, etag, last_modified):
+    """Return the (start, stop) of the requested range, None to send the
+    whole file or False if the range can't be satisfied"""
+    byte_range = request.range
+    if byte_range is None:
+        return None
+
+    # The range is valid only for the version of the file the client has
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and \
+                        http_date(if_range.date) != http_date(last_modified):
+        return None
+
+    # Multiple ranges aren't supported, the whole file is sent
+    if byte_range.units != 'bytes' or len(byte_range.ranges) != 1:
+        return None
+    return byte_range.range_for_length(size) or False
+
+
+def read_range(stored, start, stop):
+    "Yield the bytes of the file from start to stop"
+    try:
+        stored.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = stored.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        stored.close()
+
+
+class MediaFiles(object):
+    """The media folder, the uploaded files served at /media. It's mounted
+    by every role, the files are uploaded through the admin.
+
+    Configurations:
+        MEDIA_SENDFILE: how the files are sent, see send_media
+        MEDIA_ACCEL_PREFIX: the nginx internal location of the media folder
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.path = os.path.join(app.instance_path, 'media')
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+
+        app.config.setdefault('MEDIA_SENDFILE', None)
+        app.config.setdefault('MEDIA_ACCEL_PREFIX', '/protected-media/')
+
+        bp = Blueprint('media', __name__)
+        bp.add_url_rule('/media/<path:filename>', 'send', self.send)
+        app.register_blueprint(bp)
+        app.extensions['media'] = self
+
+    def send(self, filename):
+        # Only for testing purpose
+        if self.app.config.get('TESTING', None) and filename == 'anything':
+            return 'OK'
+        return send_media(self.path, filename)
@@ -1 +1,3 @@
-from caching import SimpleCachingMiddleware
+from caching import SimpleCachingMiddleware, PageCacheMiddleware
+from compression import CompressionMiddleware, negotiate_encoding
+from instrumentation import InstrumentationMiddleware, TimedTemplate
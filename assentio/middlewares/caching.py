@@ -1,43 +1,372 @@
-from time import mktime
+from time import time
+from uuid import uuid4
 
 from wsgiref.handlers import format_date_time
-from datetime import datetime, timedelta
 
-from flask import url_for, request
-from flask.ext.login import current_user
+from werkzeug.http import (parse_cookie, parse_cache_control_header,
+                           is_resource_modified, remove_entity_headers)
+from werkzeug.datastructures import Headers
+from werkzeug.wsgi import get_current_url
+from flask import _request_ctx_stack
+from flask.ext.sqlalchemy import models_committed
 
+from assentio.cache import make_cache
+from assentio.middlewares.compression import negotiate_encoding
 
-class SimpleCachingMiddleware(object):
-    "Apply the cache-control header"
+# Seconds anonymous responses may be cached by clients
+MAX_AGE = 30
 
-    def __init__(self, app):
-        self.app = app
+# Only these kind of responses are stored in the page cache
+CACHED_MIMETYPES = ('text/html', 'application/rss+xml')
 
-    def __call__(self, environ, start_response):
-        # Apply a simple cache-control header. 30 seconds for auth users, no
-        # caching for anon
+# The page cache entry changed by every invalidation, see PageCacheMiddleware
+GENERATION_KEY = 'generation'
+
+# The caching policies: the max-age of the responses, if they're immutable
+# and if they're cacheable only for anonymous users. A None policy means
+# no caching at all.
+CACHE_POLICIES = {
+    'assets': {'max_age': 365 * 24 * 3600, 'immutable': True},
+    'static': {'max_age': 60 * 60},
+    'media': {'max_age': 24 * 3600},
+    'feed': {'max_age': 5 * 60},
+    'html': {'max_age': MAX_AGE, 'anonymous': True},
+    'private': None,
+}
+
+# The policy of the requests, by endpoint or by path prefix (starting with
+# a '/'). Requests not matching any rule get the CACHE_DEFAULT_POLICY.
+CACHE_RULES = (
+    ('static', 'static'),
+    ('adminview.static', 'static'),
+    # Fingerprinted files, see AssetManifest
+    ('/static/assets/', 'assets'),
+    ('media.send', 'media'),
+    ('blog.rss', 'feed'),
+    # Logout view must be not cached or it will not work
+    ('auth.logout_view', 'private'),
+)
 
-        # HTTP/1.1
-        no_cache = [('Cache-Control', 'no-cache private')]
+NO_CACHE = 'no-cache, private'
 
+# {seconds: (now, Expires value)}
+_expires = {}
+
+
+def http_expires(seconds):
+    """Return the Expires header value for a response living seconds from now.
+    The value is computed once per second."""
+    now = int(time())
+    cached = _expires.get(seconds)
+    if cached is None or cached[0] != now:
         # HTTP/1.0 - Datetime in RFC 1123 format
-        expires_on = datetime.now() + timedelta(seconds=30)
-        expires_on = mktime(expires_on.timetuple())
-        expires_on = format_date_time(expires_on)
+        cached = _expires[seconds] = (now, format_date_time(now + seconds))
+    return cached[1]
 
-        minimal_caching = [('Cache-Control', 'public, max-age=30'),
-                           ('Expires', expires_on)]
 
-        def _start_response(status, response_headers, exc_info=None):
-            # Logout view must be not cached or it will not work
-            not_caching_urls = (url_for('auth.logout_view'),
-                                url_for('blog.rss'))
+class CachePolicy(object):
+    "The Cache-Control and Expires headers of a kind of responses"
+
+    def __init__(self, name, max_age=0, immutable=False, anonymous=False,
+                 cacheable=True):
+        self.name = name
+        self.max_age = max_age
+        self.anonymous = anonymous
+        self.cacheable = cacheable
+
+        if cacheable:
+            self.cache_control = 'public, max-age=%d' % max_age
+            if immutable:
+                self.cache_control += ', immutable'
+        else:
+            self.cache_control = NO_CACHE
+
+    def headers(self, authenticated=False):
+        "Return the caching headers of a response"
+        if not self.cacheable or (self.anonymous and authenticated):
+            return [('Cache-Control', NO_CACHE)]
+        return [('Cache-Control', self.cache_control),
+                ('Expires', http_expires(self.max_age))]
+
+
+class SimpleCachingMiddleware(object):
+    """Apply the Cache-Control and Expires headers of the caching policy of
+    every request.
+
+    The policies and the rules choosing them are set through the
+    CACHE_POLICIES, CACHE_RULES and CACHE_DEFAULT_POLICY configurations
+    (see the module defaults). The rules are resolved into path lookups on
+    the first request, after all the routes have been registered, and again
+    if routes are added later (see LazyAdmin): a request is matched by its
+    path only, without any url routing. The user is
+    checked only for the policies cacheable just by anonymous users."""
+
+    def __init__(self, app, flask_app=None):
+        self.app = app
+        self.flask_app = flask_app
+        config = flask_app is not None and flask_app.config or {}
 
-            if not current_user.is_authenticated() and request.path not in \
-                                                            not_caching_urls:
-                response_headers.extend(minimal_caching)
+        policies = config.get('CACHE_POLICIES', CACHE_POLICIES)
+        self.policies = {}
+        for name, options in policies.items():
+            if options is None:
+                self.policies[name] = CachePolicy(name, cacheable=False)
             else:
-                response_headers.extend(no_cache)
+                self.policies[name] = CachePolicy(name, **options)
 
+        self.rules = config.get('CACHE_RULES', CACHE_RULES)
+        self.default = self.policies[config.get('CACHE_DEFAULT_POLICY',
+                                                'html')]
+
+        # Requests carrying these cookies could belong to logged-in users
+        self.session_cookies = (
+                    flask_app is not None and flask_app.session_cookie_name
+                    or 'session',
+                    config.get('REMEMBER_COOKIE_NAME', 'remember_token'))
+
+        # {path: policy} and [(prefix, policy)], the longest prefix first
+        self.paths = None
+        self.prefixes = None
+        # The routes resolved so far
+        self.resolved_rules = 0
+
+    def resolve(self):
+        "Turn the rules into the path and path prefix lookups"
+        paths, prefixes = {}, {}
+        endpoints = {}
+        for rule, name in self.rules:
+            if rule.startswith('/'):
+                prefixes[rule] = self.policies[name]
+            else:
+                endpoints[rule] = self.policies[name]
+
+        if self.flask_app is not None:
+            self.resolved_rules = len(self.flask_app.url_map._rules)
+            for url_rule in self.flask_app.url_map.iter_rules():
+                policy = endpoints.get(url_rule.endpoint)
+                if policy is None:
+                    continue
+                # The path up to the first variable part
+                path = url_rule.rule.split('<', 1)[0]
+                if '<' in url_rule.rule:
+                    prefixes[path] = policy
+                else:
+                    paths[path] = policy
+
+        self.prefixes = sorted(prefixes.items(),
+                               key=lambda (prefix, policy): -len(prefix))
+        self.paths = paths
+
+    def get_policy(self, path):
+        "Return the caching policy of the request path"
+        if self.paths is None or (self.flask_app is not None and
+                len(self.flask_app.url_map._rules) != self.resolved_rules):
+            self.resolve()
+
+        policy = self.paths.get(path)
+        if policy is not None:
+            return policy
+        for prefix, policy in self.prefixes:
+            if path.startswith(prefix):
+                return policy
+        return self.default
+
+    def is_authenticated(self, environ):
+        "Check if the request comes from a logged-in user"
+        cookies = parse_cookie(environ)
+        if not any(name in cookies for name in self.session_cookies):
+            return False
+
+        # The user has been already loaded by the login manager
+        user = getattr(_request_ctx_stack.top, 'user', None)
+        return user is None or user.is_authenticated()
+
+    def __call__(self, environ, start_response):
+        def _start_response(status, response_headers, exc_info=None):
+            # Looked up once the app has run, it may have added routes
+            policy = self.get_policy(environ.get('PATH_INFO', ''))
+            authenticated = policy.anonymous and \
+                                            self.is_authenticated(environ)
+            response_headers = [(name, value)
+                                for name, value in response_headers
+                                if name.lower() not in ('cache-control',
+                                                        'expires')]
+            response_headers.extend(policy.headers(authenticated))
             return start_response(status, response_headers, exc_info)
         return self.app(environ, _start_response)
+
+
+class PageCacheMiddleware(object):
+    """Serve the pages requested by anonymous users from a server-side cache.
+    The cache is keyed on the full url (path + query string) and it's
+    cleared every time a blog content is committed to the db.
+
+    Backend is chosen through the PAGE_CACHE_BACKEND configuration: the
+    'memory' backend, the default, lives in the worker process and a commit
+    only clears the cache of the worker which made it, the others keep
+    serving their pages until PAGE_CACHE_TIMEOUT. Use the 'filesystem' one
+    to share the cache (and its invalidation) between many workers.
+
+    With read replicas (see ReplicaSet) the pages rendered in the
+    SQLALCHEMY_REPLICA_LAG seconds following an invalidation could come
+    from a replica not having the change yet: they're kept for the lag
+    only, so they can't undo the invalidation."""
+
+    def __init__(self, app, flask_app):
+        self.app = app
+        self.flask_app = flask_app
+        config = flask_app.config
+
+        backend = config['PAGE_CACHE_BACKEND']
+        options = {'default_timeout': config['PAGE_CACHE_TIMEOUT']}
+        if backend == 'memory':
+            options['max_size'] = config['PAGE_CACHE_MAX_SIZE']
+        elif backend == 'filesystem':
+            options['cache_dir'] = config['PAGE_CACHE_DIR']
+
+        self.cache = make_cache(backend, **options)
+        self.enabled = bool(backend)
+
+        # Requests carrying these cookies could belong to logged-in users,
+        # or to users who must read their own writes from the primary
+        from assentio.database import PRIMARY_UNTIL_COOKIE
+        self.session_cookies = (flask_app.session_cookie_name,
+                                config.get('REMEMBER_COOKIE_NAME',
+                                           'remember_token'),
+                                PRIMARY_UNTIL_COOKIE)
+        self.static_url_path = flask_app.static_url_path
+
+        models_committed.connect(self.invalidate, sender=flask_app)
+        # Pages showing the images rendered without their derivatives
+        from assentio.images import derivatives_ready
+        derivatives_ready.connect(self.clear, sender=flask_app)
+        flask_app.extensions['page_cache'] = self
+
+    def invalidate(self, sender, changes):
+        "Clear the cache if a blog content has been changed"
+        from assentio.apps.blog import Post, Page, SocialButton
+        from assentio.apps.blog.base import BasePortlet
+        from assentio.apps.blog.slots import PortletSlot
+
+        contents = (Post, Page, SocialButton, BasePortlet, PortletSlot)
+
+        if any(isinstance(model, contents) for model, operation in changes):
+            self.clear(sender)
+
+    def clear(self, sender, **extra):
+        "Clear the cache"
+        self.cache.clear()
+        # A page rendered before the clear is never stored after it,
+        # even by the workers sharing the cache
+        self.cache.set(GENERATION_KEY, (uuid4().hex, time()))
+
+    def cache_key(self, environ):
+        "Return the cache key of the request or None if it can't be cached"
+        if not self.enabled:
+            return None
+
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return None
+
+        path = environ.get('PATH_INFO', '')
+        if self.static_url_path and path.startswith(self.static_url_path):
+            return None
+
+        cookies = parse_cookie(environ)
+        if any(name in cookies for name in self.session_cookies):
+            return None
+
+        # Responses are compressed (Vary: Accept-Encoding), see
+        # CompressionMiddleware
+        return '%s|%s' % (get_current_url(environ),
+                          negotiate_encoding(environ))
+
+    def is_cacheable(self, status, response_headers):
+        "Check the response can be stored in the cache"
+        if not status.startswith('200'):
+            return False
+
+        mimetype = ''
+        for name, value in response_headers:
+            name = name.lower()
+            # Don't store responses setting a session or a cookie
+            if name == 'set-cookie':
+                return False
+            if name == 'content-type':
+                mimetype = value.split(';')[0].strip()
+
+        # No session cookie has been sent (see cache_key), the user is
+        # anonymous
+        return mimetype in CACHED_MIMETYPES
+
+    def __call__(self, environ, start_response):
+        key = self.cache_key(environ)
+        if key is None:
+            return self.app(environ, start_response)
+
+        entry = self.cache.get(key)
+        if entry is not None:
+            return self.serve(entry, environ, start_response)
+
+        # HEAD responses have no body to store
+        storing = []
+        generation = self.cache.get(GENERATION_KEY)
+
+        def _start_response(status, response_headers, exc_info=None):
+            if environ['REQUEST_METHOD'] == 'GET' and \
+                            self.is_cacheable(status, response_headers):
+                storing.append((status, list(response_headers)))
+            return start_response(status, response_headers, exc_info)
+
+        app_iter = self.app(environ, _start_response)
+        if not storing:
+            return app_iter
+
+        return self.store(key, storing[0], app_iter, generation)
+
+    def store(self, key, (status, response_headers), app_iter, generation):
+        "Stream the response and store it once completely sent"
+        body = []
+        try:
+            for chunk in app_iter:
+                body.append(chunk)
+                yield chunk
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+        if generation != self.cache.get(GENERATION_KEY):
+            return
+
+        timeout = None
+        config = self.flask_app.config
+        lag = config.get('SQLALCHEMY_REPLICAS') and \
+                                        config['SQLALCHEMY_REPLICA_LAG']
+        if lag and generation and generation[1] + lag > time():
+            timeout = lag
+        self.cache.set(key, (status, response_headers, ''.join(body)),
+                       timeout)
+
+    def serve(self, entry, environ, start_response):
+        "Send a cached response"
+        status, response_headers, body = entry
+        response_headers = Headers(response_headers)
+
+        # The client copy could be still valid
+        etag = response_headers.get('ETag')
+        if etag and not is_resource_modified(environ, etag=etag,
+                        last_modified=response_headers.get('Last-Modified')):
+            status, body = '304 NOT MODIFIED', ''
+            remove_entity_headers(response_headers)
+
+        if 'Expires' in response_headers:
+            cache_control = parse_cache_control_header(
+                                        response_headers.get('Cache-Control'))
+            response_headers['Expires'] = http_expires(
+                                            cache_control.max_age or MAX_AGE)
+        response_headers['X-Page-Cache'] = 'HIT'
+
+        start_response(status, response_headers.to_list())
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        return [body]
@@ -0,0 +1,221 @@
+import re
+import zlib
+
+from werkzeug.http import parse_accept_header, parse_cache_control_header
+from werkzeug.wsgi import get_current_url
+from werkzeug.datastructures import Headers
+
+from assentio.cache import MemoryCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Only these kind of responses are compressed, media types like images or
+# archives are compressed already
+COMPRESSIBLE_MIMETYPES = ('text/', 'application/javascript',
+                          'application/json', 'application/xml',
+                          'application/rss+xml', 'application/atom+xml',
+                          'image/svg+xml')
+
+# The suffix of the ETags of the compressed responses, so a compressed copy
+# is never validated against the uncompressed one
+etag_suffix_re = re.compile(r'\+(br|gzip)"')
+
+
+def negotiate_encoding(environ):
+    "Return the encoding accepted by the client: 'br', 'gzip' or 'identity'"
+    encodings = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+    if brotli is not None and encodings['br']:
+        return 'br'
+    if encodings['gzip']:
+        return 'gzip'
+    return 'identity'
+
+
+def is_compressible(mimetype):
+    return mimetype.startswith(COMPRESSIBLE_MIMETYPES)
+
+
+class Compressor(object):
+    "An incremental gzip or brotli compressor"
+
+    def __init__(self, encoding, level, quality):
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=quality)
+            self.compress = self._compressor.process
+        else:
+            # The gzip container
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                                16 + zlib.MAX_WBITS)
+            self.compress = self._compressor.compress
+
+    def finish(self):
+        if hasattr(self._compressor, 'finish'):
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+class CompressionMiddleware(object):
+    """Compress the responses with brotli or gzip, as accepted by the client.
+
+    Small bodies are compressed at once, with their Content-Length, while
+    bodies bigger than COMPRESSION_STREAM_SIZE or of unknown length are
+    compressed as they're streamed. The compressed bodies of the responses
+    with an ETag (e.g. the static files) are kept in memory, so a file is
+    compressed once per version.
+
+    It's inside the page cache, which stores and serves the compressed
+    pages (keyed by negotiate_encoding), so pages are compressed once per
+    version too.
+
+    Configurations:
+        COMPRESSION_ENABLED: compress the responses
+        COMPRESSION_MIN_SIZE: smaller bodies are sent as they are
+        COMPRESSION_STREAM_SIZE: bigger bodies are compressed as streamed
+        COMPRESSION_LEVEL: the gzip compression level
+        COMPRESSION_BROTLI_QUALITY: the brotli quality
+        COMPRESSION_CACHE_MAX_SIZE: the bytes of compressed bodies kept
+    """
+
+    def __init__(self, app, flask_app):
+        self.app = app
+        config = flask_app.config
+        config.setdefault('COMPRESSION_ENABLED', True)
+        config.setdefault('COMPRESSION_MIN_SIZE', 500)
+        config.setdefault('COMPRESSION_STREAM_SIZE', 256 * 1024)
+        config.setdefault('COMPRESSION_LEVEL', 6)
+        config.setdefault('COMPRESSION_BROTLI_QUALITY', 5)
+        config.setdefault('COMPRESSION_CACHE_MAX_SIZE', 8 * 1024 * 1024)
+
+        self.enabled = config['COMPRESSION_ENABLED']
+        self.min_size = config['COMPRESSION_MIN_SIZE']
+        self.stream_size = config['COMPRESSION_STREAM_SIZE']
+        self.level = config['COMPRESSION_LEVEL']
+        self.quality = config['COMPRESSION_BROTLI_QUALITY']
+        # {(url, etag, encoding): compressed body}
+        self.cache = MemoryCache(config['COMPRESSION_CACHE_MAX_SIZE'])
+
+    def compressor(self, encoding):
+        return Compressor(encoding, self.level, self.quality)
+
+    def compress(self, encoding, data):
+        compressor = self.compressor(encoding)
+        return compressor.compress(data) + compressor.finish()
+
+    def __call__(self, environ, start_response):
+        if not self.enabled:
+            return self.app(environ, start_response)
+
+        encoding = negotiate_encoding(environ)
+
+        # The app validates the ETags of the uncompressed responses
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        validated = None
+        if if_none_match and etag_suffix_re.search(if_none_match):
+            validated = etag_suffix_re.search(if_none_match).group(1)
+            environ['HTTP_IF_NONE_MATCH'] = etag_suffix_re.sub(
+                                                        '"', if_none_match)
+
+        # (mode, status, headers) of the response to compress
+        compressing = []
+        returned = []
+        # The body sent through write, if buffered
+        written = []
+
+        def _start_response(status, response_headers, exc_info=None):
+            headers = Headers(response_headers)
+            mode = exc_info is None and self.get_mode(environ, status,
+                                                      headers, encoding)
+            # Apps starting the response lazily, while their body is being
+            # iterated, are sent as they are
+            if returned:
+                mode = None
+            if mode == 'buffer':
+                compressing.append((mode, status, headers))
+                return written.append
+            if mode == 'stream':
+                compressing.append((mode, status, headers))
+                del headers['Content-Length']
+                self.set_encoding(headers, encoding)
+            if status.startswith('304') and validated and 'ETag' in headers:
+                headers['ETag'] = self.suffix_etag(headers['ETag'], validated)
+            return start_response(status, headers.to_list(), exc_info)
+
+        app_iter = self.app(environ, _start_response)
+        returned.append(True)
+        if not compressing:
+            return app_iter
+
+        mode, status, headers = compressing[0]
+        if mode == 'stream':
+            return self.stream(app_iter, self.compressor(encoding))
+
+        # The ETag could be the same for many urls (e.g. the index pages)
+        etag = headers.get('ETag')
+        key = etag and (get_current_url(environ), etag, encoding)
+        body = key and self.cache.get(key)
+        if body is None:
+            try:
+                body = self.compress(encoding,
+                                     ''.join(written) + ''.join(app_iter))
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+            if key:
+                self.cache.set(key, body)
+        elif hasattr(app_iter, 'close'):
+            app_iter.close()
+
+        headers['Content-Length'] = str(len(body))
+        self.set_encoding(headers, encoding)
+        start_response(status, headers.to_list())
+        return [body]
+
+    def get_mode(self, environ, status, headers, encoding):
+        """Return how the response is compressed: 'buffer', 'stream' or
+        None if it's not. Vary is set on every compressible response"""
+        mimetype = headers.get('Content-Type', '').split(';')[0].strip()
+        if not is_compressible(mimetype) or 'Content-Encoding' in headers:
+            return None
+
+        vary = [value.strip() for value in
+                                headers.get('Vary', '').split(',') if value]
+        if 'accept-encoding' not in [value.lower() for value in vary]:
+            headers['Vary'] = ', '.join(vary + ['Accept-Encoding'])
+
+        if encoding == 'identity' or not status.startswith('200') or \
+                                        environ['REQUEST_METHOD'] == 'HEAD':
+            return None
+        if parse_cache_control_header(
+                            headers.get('Cache-Control')).no_transform:
+            return None
+
+        length = headers.get('Content-Length', type=int)
+        if length is None or length > self.stream_size:
+            return 'stream'
+        if length < self.min_size:
+            return None
+        return 'buffer'
+
+    def set_encoding(self, headers, encoding):
+        headers['Content-Encoding'] = encoding
+        if 'ETag' in headers:
+            headers['ETag'] = self.suffix_etag(headers['ETag'], encoding)
+
+    def suffix_etag(self, etag, encoding):
+        return '%s+%s"' % (etag[:-1], encoding)
+
+    def stream(self, app_iter, compressor):
+        "Compress the body as it's sent"
+        try:
+            for chunk in app_iter:
+                if chunk:
+                    data = compressor.compress(chunk)
+                    if data:
+                        yield data
+            yield compressor.finish()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
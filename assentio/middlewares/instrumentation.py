@@ -0,0 +1,209 @@
+import json
+import logging
+from threading import Lock
+from collections import deque
+from timeit import default_timer
+
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.wsgi import ClosingIterator
+from flask import request, has_request_context
+
+from assentio.utils import percentile
+
+logger = logging.getLogger('assentio.instrumentation')
+
+# The key of the RequestStats in the WSGI environ
+ENVIRON_KEY = 'assentio.stats'
+
+# Logged statements are truncated to this length
+MAX_STATEMENT_LENGTH = 200
+
+
+class RequestStats(object):
+    "What a request spent in the db and in rendering templates"
+
+    def __init__(self):
+        self.started = default_timer()
+        self.endpoint = None
+        self.queries = 0
+        self.sql_time = 0.0
+        self.render_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement = None
+        # Lookups of the logged-in user, see ExtendedLoginManager.load_user
+        self.user_cache_hits = 0
+        self.user_cache_misses = 0
+        # Waits for a db connection, see TimedQueuePool
+        self.pool_wait = 0.0
+        self.rendering = False
+        self._query_started = None
+
+    def server_timing(self):
+        "Return the Server-Timing header value, durations are in ms"
+        return 'db;dur=%.2f;desc="%d queries", render;dur=%.2f, ' \
+               'total;dur=%.2f' % (self.sql_time * 1000, self.queries,
+                                   self.render_time * 1000,
+                                   (default_timer() - self.started) * 1000)
+
+
+def current_stats():
+    "Return the RequestStats of the current request, if instrumented"
+    if has_request_context():
+        return request.environ.get(ENVIRON_KEY)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    stats = current_stats()
+    if stats is not None:
+        stats._query_started = default_timer()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stats = current_stats()
+    if stats is None or stats._query_started is None:
+        return
+
+    duration = default_timer() - stats._query_started
+    stats._query_started = None
+    stats.queries += 1
+    stats.sql_time += duration
+    if duration > stats.slowest_time:
+        stats.slowest_time = duration
+        stats.slowest_statement = statement
+
+
+class TimedTemplate(Template):
+    "A template recording its render time in the request stats"
+
+    def render(self, *args, **kwargs):
+        stats = current_stats()
+        # Templates rendered by other templates are already timed
+        if stats is None or stats.rendering:
+            return Template.render(self, *args, **kwargs)
+
+        stats.rendering = True
+        started = default_timer()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            stats.render_time += default_timer() - started
+            stats.rendering = False
+
+
+class InstrumentationMiddleware(object):
+    """Record the queries, the SQL time and the templates render time of
+    every request. They're sent back in the Server-Timing header, logged to
+    the assentio.instrumentation logger and aggregated by endpoint over the
+    last INSTRUMENTATION_WINDOW requests (see summary).
+
+    It must be the outermost middleware, so responses served by the page
+    cache are measured too."""
+
+    def __init__(self, app, flask_app):
+        self.app = app
+        config = flask_app.config
+        self.enabled = config['INSTRUMENTATION_ENABLED']
+        self.window = config['INSTRUMENTATION_WINDOW']
+
+        # {endpoint: deque of (duration, queries, sql, render, slowest,
+        #                      slowest statement, user cache hits, misses,
+        #                      pool wait)}
+        self.endpoints = {}
+        self._lock = Lock()
+
+        flask_app.extensions['instrumentation'] = self
+        flask_app.before_request(self._set_endpoint)
+
+    def _set_endpoint(self):
+        stats = current_stats()
+        if stats is not None:
+            stats.endpoint = request.endpoint
+
+    def __call__(self, environ, start_response):
+        if not self.enabled:
+            return self.app(environ, start_response)
+
+        stats = environ[ENVIRON_KEY] = RequestStats()
+        status_code = []
+
+        def _start_response(status, response_headers, exc_info=None):
+            status_code.append(status.split(None, 1)[0])
+            if 'X-Page-Cache' in dict(response_headers):
+                stats.endpoint = 'page_cache'
+            response_headers.append(('Server-Timing', stats.server_timing()))
+            return start_response(status, response_headers, exc_info)
+
+        def _finished():
+            self.record(environ, status_code and status_code[0], stats)
+
+        app_iter = self.app(environ, _start_response)
+        return ClosingIterator(app_iter, _finished)
+
+    def record(self, environ, status, stats):
+        "Log the request and add it to the endpoint statistics"
+        duration = default_timer() - stats.started
+        endpoint = stats.endpoint or 'unknown'
+
+        statement = stats.slowest_statement
+        if statement:
+            statement = ' '.join(statement.split())[:MAX_STATEMENT_LENGTH]
+
+        logger.info('method=%s path=%s endpoint=%s status=%s '
+                    'duration_ms=%.2f queries=%d sql_ms=%.2f render_ms=%.2f '
+                    'user_cache_hits=%d user_cache_misses=%d '
+                    'pool_wait_ms=%.2f '
+                    'slowest_ms=%.2f slowest_sql=%s',
+                    environ['REQUEST_METHOD'],
+                    json.dumps(environ.get('PATH_INFO', '')), endpoint,
+                    status, duration * 1000, stats.queries,
+                    stats.sql_time * 1000, stats.render_time * 1000,
+                    stats.user_cache_hits, stats.user_cache_misses,
+                    stats.pool_wait * 1000, stats.slowest_time * 1000,
+                    json.dumps(statement))
+
+        with self._lock:
+            requests = self.endpoints.get(endpoint)
+            if requests is None:
+                requests = self.endpoints[endpoint] = \
+                                            deque(maxlen=self.window)
+            requests.append((duration, stats.queries, stats.sql_time,
+                             stats.render_time, stats.slowest_time,
+                             statement, stats.user_cache_hits,
+                             stats.user_cache_misses, stats.pool_wait))
+
+    def summary(self):
+        """Return the statistics of every endpoint over its last requests,
+        durations are in ms"""
+        with self._lock:
+            endpoints = [(endpoint, list(requests)) for endpoint, requests
+                                                in self.endpoints.items()]
+
+        summary = []
+        for endpoint, requests in sorted(endpoints):
+            count = float(len(requests))
+            durations, queries, sql, render = zip(*requests)[:4]
+            durations = sorted(duration * 1000 for duration in durations)
+            slowest = max(requests, key=lambda entry: entry[4])
+            summary.append({'endpoint': endpoint,
+                            'requests': len(requests),
+                            'p50': percentile(durations, 50),
+                            'p90': percentile(durations, 90),
+                            'p99': percentile(durations, 99),
+                            'queries': sum(queries) / count,
+                            'sql': sum(sql) * 1000 / count,
+                            'render': sum(render) * 1000 / count,
+                            'slowest_sql': slowest[4] * 1000,
+                            'slowest_statement': slowest[5],
+                            'user_cache_hits': sum(entry[6]
+                                                   for entry in requests),
+                            'user_cache_misses': sum(entry[7]
+                                                     for entry in requests),
+                            'pool_wait': sum(entry[8] for entry in requests)
+                                                            * 1000 / count})
+        return summary
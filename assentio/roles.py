@@ -0,0 +1,111 @@
+from threading import Lock
+
+from flask import g, abort, url_for, _request_ctx_stack
+from flask.sessions import SessionInterface
+from flask.ext.login import AnonymousUser
+
+# The deployment roles, see ASSENTIO_ROLE:
+#   public: the anonymous reads only, no login and no admin
+#   admin: everything, mounted at startup
+#   all: everything, the admin is mounted on its first request
+ROLES = ('public', 'admin', 'all')
+
+# The url of the admin, see AdminApp
+ADMIN_URL = '/admin'
+
+# The pages served by the login app, linked by the public pages
+LOGIN_RULES = (('/login/', 'auth.login_view'),
+               ('/logout', 'auth.logout_view'))
+
+
+class NoSessions(SessionInterface):
+    "Never read nor write the session cookie"
+
+    def open_session(self, app, request):
+        return self.make_null_session(app)
+
+    def save_session(self, app, session, response):
+        pass
+
+
+class AnonymousUsers(object):
+    """The users of the public role, all anonymous: the session isn't
+    loaded and there's no login manager. The login pages are served by the
+    admin workers, the public ones only build their urls. Users who just
+    wrote something keep reading from the primary database, see ReplicaSet"""
+
+    def __init__(self, app):
+        self.user = AnonymousUser()
+        app.session_interface = NoSessions()
+        app.before_request(self.set_anonymous)
+        for rule, endpoint in LOGIN_RULES:
+            app.add_url_rule(rule, endpoint, self.not_served)
+        app.extensions['anonymous_users'] = self
+
+    def set_anonymous(self):
+        "Set the anonymous user as current_user and g.user"
+        _request_ctx_stack.top.user = self.user
+        g.user = self.user
+
+    @staticmethod
+    def not_served():
+        abort(404)
+
+
+class LazyAdmin(object):
+    """Mount the admin (and its model views) on the first request to
+    ADMIN_URL, or the first time one of its urls is built, e.g. by the
+    pages of a logged-in user. Processes not serving the admin never pay
+    for it.
+
+    In debug mode Flask refuses setups after the first request: the mount
+    lifts the check by resetting the first request flag for a moment, so
+    a request served meanwhile by another thread could run the
+    before_first_request functions again. Debug mode is meant for the
+    single-threaded development server, production runs don't touch the
+    flag.
+    """
+
+    def __init__(self, app, app_name):
+        self.app = app
+        self.app_name = app_name
+        self.mounted = False
+        self._lock = Lock()
+
+        self.wsgi_app = app.wsgi_app
+        app.wsgi_app = self
+        app.url_build_error_handlers.append(self.build_url)
+        app.extensions['lazy_admin'] = self
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not self.mounted and (path == ADMIN_URL or
+                                 path.startswith(ADMIN_URL + '/')):
+            self.mount()
+        return self.wsgi_app(environ, start_response)
+
+    def mount(self):
+        "Mount the admin, once"
+        with self._lock:
+            if self.mounted:
+                return
+            from .apps.admin import AdminApp
+            if not self.app.debug:
+                AdminApp(self.app, self.app_name)
+            else:
+                # Flask refuses late setups in debug mode, this one is on
+                # purpose. Not thread-safe, see above
+                got_first_request = self.app._got_first_request
+                self.app._got_first_request = False
+                try:
+                    AdminApp(self.app, self.app_name)
+                finally:
+                    self.app._got_first_request = got_first_request
+            self.mounted = True
+
+    def build_url(self, error, endpoint, values):
+        "Mount the admin and build the url again, see url_for"
+        if self.mounted:
+            return None
+        self.mount()
+        return url_for(endpoint, **values)
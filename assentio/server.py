@@ -0,0 +1,430 @@
+import os
+import gc
+import sys
+import time
+import errno
+import fcntl
+import random
+import select
+import signal
+import socket
+import logging
+import argparse
+import tempfile
+import multiprocessing
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+logger = logging.getLogger('assentio.server')
+
+
+class ProductionConfig(object):
+    """The production profile: no debug mode and no debug toolbar. The page
+    cache and the feed are stored in the instance folder, where they're
+    shared (and invalidated) by all the workers. The caches living in every
+    worker expire sooner, as they miss the commits of the other workers.
+
+    Configurations (the command line options override them):
+        SERVER_BIND: the host:port to listen on
+        SERVER_WORKERS: the worker processes
+        SERVER_BACKLOG: the connections waiting to be accepted
+        SERVER_MAX_REQUESTS: a worker is replaced after serving as many
+                             requests, 0 to never replace it
+        SERVER_MAX_REQUESTS_JITTER: the random requests added to the max,
+                                    so the workers aren't replaced together
+        SERVER_TIMEOUT: seconds after which a silent worker is killed
+        SERVER_READ_TIMEOUT: seconds a client has to send its request, or
+                             to receive a chunk of the response, before
+                             its connection is closed
+        SERVER_GRACEFUL_TIMEOUT: seconds the workers have to finish their
+                                 request on reload and shutdown
+    """
+    DEBUG = False
+    TESTING = False
+    SERVER_BIND = '127.0.0.1:8000'
+    SERVER_WORKERS = multiprocessing.cpu_count() * 2 + 1
+    SERVER_BACKLOG = 128
+    SERVER_MAX_REQUESTS = 1000
+    SERVER_MAX_REQUESTS_JITTER = 50
+    SERVER_TIMEOUT = 30
+    SERVER_READ_TIMEOUT = 10
+    SERVER_GRACEFUL_TIMEOUT = 30
+    PAGE_CACHE_BACKEND = 'filesystem'
+    # Relative to the instance folder
+    FEED_DIR = 'feed'
+    PORTLET_CACHE_TIMEOUT = 30
+    USER_CACHE_TIMEOUT = 30
+
+
+def make_app():
+    "Return the app with the production profile"
+    from assentio import db, get_bcrypt
+    from assentio.main import create_flask_app
+    return create_flask_app(config_object=ProductionConfig, db=db,
+                            bcrypt=get_bcrypt())
+
+
+def make_listener(bind, backlog):
+    "Return the listening socket of the host:port"
+    host, port = bind.rsplit(':', 1)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, int(port)))
+    listener.listen(backlog)
+    # Every worker waits on it, only one gets the connection
+    listener.setblocking(0)
+    return listener
+
+
+def close_on_exec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+class RequestHandler(WSGIRequestHandler):
+    "Log the requests to the assentio.server logger"
+
+    def log_message(self, format, *args):
+        logger.info('%s - %s', self.client_address[0], format % args)
+
+
+class Worker(object):
+    "A worker process, serving the requests until it's told to stop"
+
+    def __init__(self, app, listener, heartbeat, max_requests,
+                 read_timeout=None):
+        self.app = app
+        self.listener = listener
+        self.heartbeat = heartbeat
+        self.max_requests = max_requests
+        self.read_timeout = read_timeout
+        self.requests = 0
+        self.alive = True
+        self.ppid = os.getppid()
+
+    def stop(self, signum, frame):
+        "Stop once the current request has been served"
+        self.alive = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGQUIT, self.stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTTIN, signal.SIG_IGN)
+        signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+        self.dispose_engines()
+
+        server = WSGIServer(self.listener.getsockname(), RequestHandler,
+                            bind_and_activate=False)
+        server.socket = self.listener
+        server.server_name, server.server_port = \
+                                        self.listener.getsockname()[:2]
+        server.setup_environ()
+        server.set_app(self.app)
+
+        while self.alive:
+            self.notify()
+            if self.max_requests and self.requests >= self.max_requests:
+                logger.info('Worker %d served %d requests, recycling',
+                            os.getpid(), self.requests)
+                break
+            # The master is gone
+            if os.getppid() != self.ppid:
+                break
+
+            try:
+                ready = select.select([self.listener], [], [], 1.0)[0]
+            except select.error, error:
+                if error.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                continue
+
+            try:
+                request, client_address = self.listener.accept()
+            except socket.error, error:
+                # Another worker got it
+                if error.args[0] in (errno.EAGAIN, errno.ECONNABORTED,
+                                     errno.EWOULDBLOCK):
+                    continue
+                raise
+
+            self.requests += 1
+            # A worker serves a request at a time, a slow client must not
+            # hold it until the master kills it
+            request.settimeout(self.read_timeout)
+            try:
+                server.finish_request(request, client_address)
+            except socket.timeout:
+                logger.info('%s - timed out', client_address[0])
+            except Exception:
+                server.handle_error(request, client_address)
+            finally:
+                server.shutdown_request(request)
+
+    def notify(self):
+        "Tell the master this worker is not stuck"
+        os.utime(self.heartbeat, None)
+
+    def dispose_engines(self):
+        "Never share the connections opened by the master"
+        state = self.app.extensions.get('sqlalchemy')
+        for connector in state and state.connectors.values() or ():
+            if connector._engine is not None:
+                connector._engine.dispose()
+
+
+class Arbiter(object):
+    """A preforking WSGI server. The master process loads the app once and
+    forks the workers, which share the listening socket and serve a request
+    at a time with the stdlib wsgiref server. The master keeps them
+    running, replacing the ones exiting after their max requests and
+    killing the ones stuck for more than the timeout. Signals:
+        HUP: reload the configuration and the app, replace the workers
+             gracefully (listening on the new SERVER_BIND, if it changed)
+        TERM, INT: graceful shutdown, QUIT: immediate shutdown
+        TTIN, TTOU: add or remove a worker
+    """
+
+    SIGNALS = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGQUIT,
+               signal.SIGCHLD, signal.SIGTTIN, signal.SIGTTOU)
+
+    def __init__(self, app_factory, options):
+        self.app_factory = app_factory
+        self.options = options
+        self.app = None
+        self.listener = None
+        # {pid: heartbeat file}
+        self.workers = {}
+        self.signals = []
+        self.pipe = None
+
+    def setting(self, name):
+        "Return the option of the command line, or the app configuration"
+        value = self.options.get(name)
+        if value is None:
+            value = self.app.config['SERVER_%s' % name.upper()]
+        return value
+
+    def load(self):
+        """Load the app before forking, so the workers share its memory.
+        The objects allocated so far are moved out of the collected ones
+        where gc.freeze is available, collected otherwise, so the garbage
+        collector of the workers doesn't touch (and copy) their pages"""
+        self.app = self.app_factory()
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+
+        # A commit invalidates the caches of its own worker only
+        if self.setting('workers') > 1:
+            if self.app.config['PAGE_CACHE_BACKEND'] == 'memory':
+                logger.warning('The page cache is in memory: the workers '
+                               'serve stale pages until PAGE_CACHE_TIMEOUT')
+            if not self.app.config['FEED_DIR']:
+                logger.warning('FEED_DIR is not set: the workers serve '
+                               'stale feeds until FEED_TIMEOUT')
+
+    def listen(self):
+        "Open the listening socket of the bind setting"
+        self.listener = make_listener(self.setting('bind'),
+                                      self.setting('backlog'))
+        close_on_exec(self.listener.fileno())
+
+    def run(self):
+        self.load()
+        self.listen()
+        self.pipe = os.pipe()
+        for fd in self.pipe:
+            close_on_exec(fd)
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        for signum in self.SIGNALS:
+            signal.signal(signum, self.signal)
+
+        logger.info('Listening on %s with %d workers (master %d)',
+                    self.setting('bind'), self.setting('workers'),
+                    os.getpid())
+        self.manage_workers()
+
+        while True:
+            self.reap_workers()
+            signum = self.signals and self.signals.pop(0)
+            if not signum:
+                self.murder_workers()
+                self.manage_workers()
+                self.sleep()
+            elif signum == signal.SIGHUP:
+                self.reload()
+            elif signum in (signal.SIGTERM, signal.SIGINT):
+                self.stop(graceful=True)
+                return
+            elif signum == signal.SIGQUIT:
+                self.stop(graceful=False)
+                return
+            elif signum == signal.SIGTTIN:
+                self.options['workers'] = self.setting('workers') + 1
+            elif signum == signal.SIGTTOU:
+                self.options['workers'] = max(1, self.setting('workers') - 1)
+
+    def signal(self, signum, frame):
+        if signum != signal.SIGCHLD:
+            self.signals.append(signum)
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            os.write(self.pipe[1], '.')
+        except OSError, error:
+            if error.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def sleep(self):
+        "Wait for a signal, or a second"
+        try:
+            if select.select([self.pipe[0]], [], [], 1.0)[0]:
+                while os.read(self.pipe[0], 1):
+                    pass
+        except (select.error, OSError), error:
+            if error.args[0] not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def spawn_worker(self):
+        fd, heartbeat = tempfile.mkstemp(prefix='assentio-worker-')
+        os.close(fd)
+        max_requests = self.setting('max_requests')
+        if max_requests:
+            max_requests += random.randint(0,
+                                    self.setting('max_requests_jitter'))
+
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = heartbeat
+            return pid
+
+        # The worker
+        status = 0
+        try:
+            random.seed()
+            for fd in self.pipe:
+                os.close(fd)
+            Worker(self.app, self.listener, heartbeat, max_requests,
+                   self.setting('read_timeout')).run()
+        except SystemExit, exit:
+            status = exit.code or 0
+        except Exception:
+            logger.exception('Worker %d failed', os.getpid())
+            status = 1
+        finally:
+            # Never run the master cleanups
+            os._exit(status)
+
+    def manage_workers(self):
+        "Spawn the missing workers, stop the extra ones"
+        missing = self.setting('workers') - len(self.workers)
+        for i in range(missing):
+            self.spawn_worker()
+        for pid in sorted(self.workers)[:max(0, -missing)]:
+            self.kill_worker(pid, signal.SIGTERM)
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, error:
+                if error.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            heartbeat = self.workers.pop(pid, None)
+            if heartbeat and os.path.exists(heartbeat):
+                os.unlink(heartbeat)
+
+    def murder_workers(self):
+        "Kill the workers stuck for more than the timeout"
+        timeout = self.setting('timeout')
+        now = time.time()
+        for pid, heartbeat in self.workers.items():
+            try:
+                last_seen = os.stat(heartbeat).st_mtime
+            except OSError:
+                continue
+            if now - last_seen > timeout:
+                logger.error('Worker %d timed out, killing it', pid)
+                self.kill_worker(pid, signal.SIGKILL)
+
+    def kill_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError, error:
+            if error.errno != errno.ESRCH:
+                raise
+
+    def reload(self):
+        """Load the app again, start new workers and stop the old ones. The
+        new workers listen on the new bind, if it changed"""
+        logger.info('Reloading')
+        old_workers = list(self.workers)
+        bind = self.setting('bind')
+        self.load()
+        if self.setting('bind') != bind:
+            old_listener = self.listener
+            self.listen()
+            old_listener.close()
+            logger.info('Listening on %s', self.setting('bind'))
+        for i in range(self.setting('workers')):
+            self.spawn_worker()
+        for pid in old_workers:
+            self.kill_worker(pid, signal.SIGTERM)
+
+    def stop(self, graceful=True):
+        "Stop the workers, waiting for them if graceful"
+        self.listener.close()
+        signum = graceful and signal.SIGTERM or signal.SIGKILL
+        for pid in list(self.workers):
+            self.kill_worker(pid, signum)
+
+        deadline = time.time() + self.setting('graceful_timeout')
+        while self.workers and time.time() < deadline:
+            self.reap_workers()
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            self.kill_worker(pid, signal.SIGKILL)
+        self.reap_workers()
+        logger.info('Stopped')
+
+
+def serve(argv=None):
+    "Run the production server"
+    parser = argparse.ArgumentParser(
+                        description='Serve Assentio with preforked workers')
+    parser.add_argument('--bind', help='the host:port to listen on')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--backlog', type=int)
+    parser.add_argument('--max-requests', type=int,
+                        help='replace a worker after as many requests')
+    parser.add_argument('--max-requests-jitter', type=int)
+    parser.add_argument('--timeout', type=int,
+                        help='kill the workers silent for as many seconds')
+    parser.add_argument('--read-timeout', type=int,
+                        help='close the connections of the clients silent '
+                             'for as many seconds')
+    parser.add_argument('--graceful-timeout', type=int)
+    parser.add_argument('--role', choices=('public', 'admin', 'all'),
+                        help='the ASSENTIO_ROLE of the app')
+    args = vars(parser.parse_args(argv))
+
+    role = args.pop('role')
+    if role:
+        os.environ['ASSENTIO_ROLE'] = role
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s [%(process)d] %(message)s')
+    Arbiter(make_app, args).run()
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1:])
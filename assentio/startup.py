@@ -0,0 +1,143 @@
+import os
+import imp
+import sys
+from contextlib import contextmanager
+from timeit import default_timer
+
+# The modules listed by the report
+REPORT_SIZE = 25
+
+
+class BootstrapTimer(object):
+    "Time the steps of the app bootstrap, as [(step, seconds)]"
+
+    def __init__(self):
+        self.steps = []
+
+    @contextmanager
+    def step(self, name):
+        started = default_timer()
+        try:
+            yield
+        finally:
+            self.steps.append((name, default_timer() - started))
+
+
+class ImportTimer(object):
+    """An import hook timing the modules execution, with and without the
+    modules they import. Modules in zip files and the ones with their own
+    importer are loaded untimed"""
+
+    def __init__(self):
+        # {module: (self seconds, total seconds)}
+        self.modules = {}
+        self._children = []
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        sys.meta_path.remove(self)
+
+    def find_module(self, fullname, path=None):
+        # Packages imported under an alias (e.g. flask.ext.*) have their own
+        # importer
+        parent = fullname.rpartition('.')[0]
+        if parent and getattr(sys.modules.get(parent), '__name__',
+                              parent) != parent:
+            return None
+        try:
+            stream, filename, description = imp.find_module(
+                                            fullname.rpartition('.')[2], path)
+        except ImportError:
+            return None
+        # Loaders are looked up without loading too (e.g. by pkgutil)
+        if stream:
+            stream.close()
+        return TimedLoader(self, filename, description)
+
+    def load(self, fullname, filename, description):
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+
+        stream = None
+        if description[2] in (imp.PY_SOURCE, imp.PY_COMPILED,
+                              imp.C_EXTENSION):
+            stream = open(filename, description[1])
+
+        self._children.append(0.0)
+        started = default_timer()
+        try:
+            return imp.load_module(fullname, stream, filename, description)
+        finally:
+            total = default_timer() - started
+            children = self._children.pop()
+            if self._children:
+                self._children[-1] += total
+            if stream:
+                stream.close()
+            self.modules[fullname] = (total - children, total)
+
+
+class TimedLoader(object):
+    "The PEP 302 loader of ImportTimer"
+
+    def __init__(self, timer, filename, description):
+        self.timer = timer
+        self.filename = filename
+        self.description = description
+
+    def load_module(self, fullname):
+        return self.timer.load(fullname, self.filename, self.description)
+
+    def is_package(self, fullname):
+        return self.description[2] == imp.PKG_DIRECTORY
+
+    def get_filename(self, fullname):
+        if self.is_package(fullname):
+            return os.path.join(self.filename, '__init__.py')
+        return self.filename
+
+
+def profile_startup(app_factory=None):
+    """Import the package and bootstrap the app, return the import times of
+    the modules, the bootstrap steps and the total time. It's meaningful
+    only in a new process, see main"""
+    timer = ImportTimer()
+    timer.install()
+    started = default_timer()
+    try:
+        import assentio
+        app = (app_factory or assentio.get_app)()
+    finally:
+        timer.uninstall()
+    return {'modules': timer.modules,
+            'steps': app.extensions.get('startup', []),
+            'total': default_timer() - started}
+
+
+def format_report(profile, size=REPORT_SIZE):
+    "Return the lines of the report of profile_startup"
+    modules = profile['modules']
+    lines = ['Startup: %.1f ms, %d modules imported' % (
+                                profile['total'] * 1000, len(modules)), '',
+             'Imports (ms)', '%8s %8s  %s' % ('self', 'total', 'module')]
+    for name, (own, total) in sorted(modules.items(),
+                                     key=lambda item: -item[1][0])[:size]:
+        lines.append('%8.1f %8.1f  %s' % (own * 1000, total * 1000, name))
+
+    lines.extend(['', 'Bootstrap (ms)'])
+    for name, duration in profile['steps']:
+        lines.append('%8.1f  %s' % (duration * 1000, name))
+    return lines
+
+
+def main():
+    for line in format_report(profile_startup()):
+        print line
+
+
+if __name__ == '__main__':
+    # Run as a script, so the package itself is imported by the profile
+    sys.path[0] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    main()
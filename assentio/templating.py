@@ -0,0 +1,107 @@
+import os
+import sys
+import errno
+import tempfile
+
+from jinja2 import FileSystemBytecodeCache, TemplateSyntaxError
+
+# The files of the template folders which are templates
+TEMPLATE_EXTENSIONS = ('.html', '.xml', '.txt')
+
+
+class SharedBytecodeCache(FileSystemBytecodeCache):
+    """A bytecode cache many workers can share: the files are replaced
+    atomically and an unreadable file is a cache miss. The marshalled code
+    depends on the Python version, so it's part of the file names"""
+
+    def __init__(self, directory):
+        try:
+            os.makedirs(directory)
+        except OSError, error:
+            if error.errno != errno.EEXIST:
+                raise
+        pattern = '__jinja2_%%s.py%d%d.cache' % sys.version_info[:2]
+        FileSystemBytecodeCache.__init__(self, directory, pattern)
+
+    def load_bytecode(self, bucket):
+        try:
+            FileSystemBytecodeCache.load_bytecode(self, bucket)
+        except Exception:
+            # Written by an older Jinja, or truncated
+            bucket.reset()
+
+    def dump_bytecode(self, bucket):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.rename(temp_path, self._get_cache_filename(bucket))
+        except Exception:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+
+class TemplateCache(object):
+    """The compiled templates: a new worker loads the bytecode of the
+    templates from the cache folder, shared by the workers, instead of
+    parsing and compiling them. The templates can be compiled at deploy
+    time with `manage.py compile-templates`.
+
+    Templates are checked for changes on each render only if
+    TEMPLATES_AUTO_RELOAD, by default in debug mode: in production a
+    deploy has to reload the workers.
+
+    Configurations:
+        TEMPLATE_CACHE_DIR: the bytecode cache folder, None to disable it
+        TEMPLATE_CACHE_SIZE: the compiled templates kept in memory
+        TEMPLATES_AUTO_RELOAD: True or False, None to follow the debug mode
+    """
+
+    def __init__(self, app):
+        self.app = app
+        app.config.setdefault('TEMPLATE_CACHE_DIR',
+                              os.path.join(app.instance_path,
+                                           'template_cache'))
+        app.config.setdefault('TEMPLATE_CACHE_SIZE', 200)
+        app.config.setdefault('TEMPLATES_AUTO_RELOAD', None)
+        self._bytecode_cache = None
+        app.extensions['templates'] = self
+
+    @property
+    def bytecode_cache(self):
+        directory = self.app.config['TEMPLATE_CACHE_DIR']
+        if directory and self._bytecode_cache is None:
+            self._bytecode_cache = SharedBytecodeCache(directory)
+        return directory and self._bytecode_cache or None
+
+    @property
+    def auto_reload(self):
+        auto_reload = self.app.config['TEMPLATES_AUTO_RELOAD']
+        if auto_reload is None:
+            return self.app.debug
+        return auto_reload
+
+    def jinja_options(self):
+        "The options of the jinja environment, see create_flask_app"
+        return {'bytecode_cache': self.bytecode_cache,
+                'auto_reload': self.auto_reload,
+                'cache_size': self.app.config['TEMPLATE_CACHE_SIZE']}
+
+    def list_templates(self):
+        "Return the names of the templates of the app and its blueprints"
+        return sorted(name for name in self.app.jinja_env.list_templates()
+                      if os.path.splitext(name)[1] in TEMPLATE_EXTENSIONS)
+
+    def compile(self):
+        """Compile every template into the bytecode cache, return the names
+        of the compiled ones and the {name: error} of the others"""
+        compiled, errors = [], {}
+        for name in self.list_templates():
+            try:
+                self.app.jinja_env.get_template(name)
+            except TemplateSyntaxError, error:
+                errors[name] = error
+            else:
+                compiled.append(name)
+        return compiled, errors
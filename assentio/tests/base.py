@@ -2,9 +2,9 @@ import unittest
 
 from flask.ext.login import AnonymousUser
 from flask.ext.bcrypt import Bcrypt
-from flask.ext.sqlalchemy import SQLAlchemy
 
 from assentio import create_flask_app, db 
+from assentio.database import SQLAlchemy
 from assentio.manage import _syncdb as syncdb, _adduser as adduser
 from assentio.apps.login import User
 from assentio.apps.blog import Post
@@ -28,6 +28,10 @@ class BaseTestCase(unittest.TestCase):
             TESTING = True
             CSRF_ENABLED = False
             SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+            # Hash in the test process, where bcrypt is mocked
+            PASSWORD_HASHING_PROCESSES = 0
+            # Templates are compiled in memory, see test_template_cache
+            TEMPLATE_CACHE_DIR = None
 
         return create_flask_app(config_object=TestingConfig, **args)
 
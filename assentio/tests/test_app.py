@@ -1,12 +1,30 @@
 import os
+import sys
+import time
+import zlib
+import signal
+import socket
 import random
+import shutil
+import httplib
+import logging
 import unittest
+import subprocess
 
-from tempfile import NamedTemporaryFile, gettempdir
+from tempfile import NamedTemporaryFile, TemporaryFile, gettempdir, mkdtemp
 
 from assentio.tests import base
+from assentio.cache import MemoryCache, make_cache
 from assentio.main import create_flask_app
-from assentio.manage import _syncdb as syncdb
+from assentio.roles import NoSessions
+from assentio.benchmarks import run_benchmark
+from assentio.middlewares import CompressionMiddleware
+from assentio.middlewares.caching import GENERATION_KEY
+from assentio.apps.blog import Post
+from assentio.manage import (_syncdb as syncdb, _migratedb as migratedb,
+                             _adduser as adduser, _explain as explain,
+                             _buildassets as buildassets,
+                             _compile_templates as compile_templates)
 
 class AssentioComponentTestCase(base.BaseTestCase):
 
@@ -17,6 +35,426 @@ class AssentioComponentTestCase(base.BaseTestCase):
         self.assertIn('Cache-Control', res.headers)
         self.assertIn('Expires', res.headers)
 
+    def test_cache_policies(self):
+        "Test the caching policy is chosen by the request path"
+        res = self.client.get('/')
+        self.assertEqual(res.headers.getlist('Cache-Control'),
+                         ['public, max-age=30'])
+
+        # Flask's own header of the static files is replaced
+        res = self.client.get('/static/css/admin.css')
+        self.assertEqual(res.headers.getlist('Cache-Control'),
+                         ['public, max-age=3600'])
+        self.assertEqual(len(res.headers.getlist('Expires')), 1)
+
+        res = self.client.get('/media/anything')
+        self.assertEqual(res.headers['Cache-Control'], 'public, max-age=86400')
+
+        res = self.client.get('/feed')
+        self.assertEqual(res.headers['Cache-Control'], 'public, max-age=300')
+        res.data
+        # The page cache refreshes the Expires with the feed max-age
+        res = self.client.get('/feed')
+        self.assertEqual(res.headers.get('X-Page-Cache'), 'HIT')
+        self.assertEqual(res.headers['Cache-Control'], 'public, max-age=300')
+
+        res = self.client.get('/logout')
+        self.assertEqual(res.headers['Cache-Control'], 'no-cache, private')
+        self.assertNotIn('Expires', res.headers)
+
+    def test_build_assets(self):
+        "Test the static files are fingerprinted and bundled"
+        directory = mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        # The static url path is named after the folder
+        static_folder = os.path.join(directory, 'static')
+        for name in ('css', 'js', 'img', 'chosen', 'ckeditor'):
+            shutil.copytree(os.path.join(self.app.static_folder, name),
+                            os.path.join(static_folder, name))
+        self.app.static_folder = static_folder
+
+        # Not built yet, the bundle files are included one by one
+        res = self.client.get('/')
+        self.assertIn('/static/css/style.css', res.data)
+        self.assertIn('/static/css/responsive.css', res.data)
+
+        manifest = buildassets(self.app)
+        self.assertNotIn('ckeditor/ckeditor.js', manifest)
+        self.assertRegexpMatches(manifest['css/site.css'],
+                                 r'^assets/css/site\.[0-9a-f]{12}\.css$')
+        self.assertTrue(os.path.exists(os.path.join(
+                        static_folder, manifest['css/site.css'] + '.gz')))
+
+        # A url not in the page cache yet
+        res = self.client.get('/?page=1')
+        self.assertIn('/static/%s' % manifest['css/site.css'], res.data)
+        self.assertIn('/static/%s' % manifest['js/script.js'], res.data)
+        self.assertNotIn('/static/css/style.css', res.data)
+
+        res = self.client.get('/static/%s' % manifest['css/site.css'])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Cache-Control'],
+                         'public, max-age=31536000, immutable')
+        # The stylesheet points to the fingerprinted images
+        self.assertIn('url(/static/%s)' % manifest['img/wallpaper.png'],
+                      res.data)
+        self.assertNotIn('/*', res.data)
+
+    def test_page_cache_middleware(self):
+        "Test anonymous pages are served from the page cache"
+        res = self.client.get('/')
+        self.assertNotIn('X-Page-Cache', res.headers)
+        # the response is stored once it's completely sent
+        res.data
+
+        # The second hit comes from the cache, with a fresh Expires header
+        res = self.client.get('/')
+        self.assertEqual(res.headers.get('X-Page-Cache'), 'HIT')
+        self.assertIn('<!-- HomePage -->', res.data)
+        self.assertIn('Expires', res.headers)
+
+        # The query string is part of the key
+        res = self.client.get('/?page=1')
+        self.assertNotIn('X-Page-Cache', res.headers)
+        res.data
+
+        # Saving a content invalidates the cache
+        self.create_post('cached post', 'body', state='public')
+        res = self.client.get('/')
+        self.assertNotIn('X-Page-Cache', res.headers)
+        self.assertIn('cached post', res.data)
+
+        # Pages rendered before another worker clears the cache aren't
+        # stored after it
+        res = self.client.get('/?page=2')
+        self.app.extensions['page_cache'].cache.set(GENERATION_KEY, 'other')
+        res.data
+        res = self.client.get('/?page=2')
+        self.assertNotIn('X-Page-Cache', res.headers)
+
+        # Authenticated users are never served from the cache
+        self.login(base.TESTUSER, base.TESTUSER)
+        res = self.client.get('/')
+        self.assertNotIn('X-Page-Cache', res.headers)
+
+    def test_compression(self):
+        "Test the responses are compressed once, and cached compressed"
+        gzipped = {'Accept-Encoding': 'gzip'}
+        res = self.client.get('/', headers=gzipped)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertTrue(res.headers['ETag'].endswith('+gzip"'))
+        body = res.data
+        self.assertEqual(len(body), int(res.headers['Content-Length']))
+        self.assertIn('<!-- HomePage -->',
+                      zlib.decompress(body, 16 + zlib.MAX_WBITS))
+
+        # The page cache serves the compressed copy, and validates it
+        res = self.client.get('/', headers=gzipped)
+        self.assertEqual(res.headers.get('X-Page-Cache'), 'HIT')
+        self.assertEqual(res.data, body)
+        etag = res.headers['ETag']
+        res = self.client.get('/?page=1', headers={'Accept-Encoding': 'gzip',
+                                                    'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+
+        # Clients not accepting it get the plain page
+        res = self.client.get('/')
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertIn('<!-- HomePage -->', res.data)
+
+        # Compressed media types are sent as they are
+        res = self.client.get('/static/img/wallpaper.png', headers=gzipped)
+        self.assertNotIn('Content-Encoding', res.headers)
+        res = self.client.get('/static/css/style.css', headers=gzipped)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+
+    def test_compression_cache_key(self):
+        "Test the compressed pages sharing an ETag aren't mixed up"
+        for i in range(1, 6):
+            self.create_post('post_%d' % i, 'body', state='public')
+        gzipped = {'Accept-Encoding': 'gzip'}
+        unzip = lambda res: zlib.decompress(res.data, 16 + zlib.MAX_WBITS)
+
+        first = self.client.get('/', headers=gzipped)
+        self.assertIn('post_5', unzip(first))
+        second = self.client.get('/?page=2', headers=gzipped)
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+        self.assertIn('post_1', unzip(second))
+        self.assertNotIn('post_5', unzip(second))
+
+    def test_compression_lazy_apps(self):
+        "Test the apps starting late or writing the body are served whole"
+        body = 'x' * 1000
+        headers = [('Content-Type', 'text/plain')]
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/',
+                   'HTTP_ACCEPT_ENCODING': 'gzip'}
+
+        def lazy_app(environ, start_response):
+            start_response('200 OK', headers)
+            yield body
+
+        def writing_app(environ, start_response):
+            write = start_response('200 OK', headers +
+                                   [('Content-Length', str(len(body)))])
+            write(body[:400])
+            return [body[400:]]
+
+        for app, encoded in ((lazy_app, False), (writing_app, True)):
+            started = []
+
+            def start_response(status, headers, exc_info=None):
+                started.append(headers)
+
+            middleware = CompressionMiddleware(app, self.app)
+            data = ''.join(middleware(dict(environ), start_response))
+            sent = dict(started[0])
+            if encoded:
+                self.assertEqual(sent['Content-Encoding'], 'gzip')
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            else:
+                self.assertNotIn('Content-Encoding', sent)
+            self.assertEqual(data, body)
+
+    def test_instrumentation(self):
+        "Test the requests timings are sent, logged and aggregated"
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('assentio.instrumentation')
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+
+        res = self.client.get('/')
+        self.assertIn('db;dur=', res.headers['Server-Timing'])
+        self.assertIn('render;dur=', res.headers['Server-Timing'])
+        res.data
+        res.close()
+
+        # The cached copy is timed too
+        res = self.client.get('/')
+        self.assertIn('db;dur=0.00;desc="0 queries"',
+                      res.headers['Server-Timing'])
+        res.close()
+
+        logger.removeHandler(handler)
+        messages = [record.getMessage() for record in records]
+        self.assertIn('endpoint=common.index status=200', messages[0])
+        self.assertIn('endpoint=page_cache status=200', messages[1])
+
+        self.login(base.TESTUSER, base.TESTUSER)
+        res = self.client.get('/admin/stats/')
+        self.assertIn('common.index', res.data)
+        self.assertIn('page_cache', res.data)
+
+    def test_memory_cache(self):
+        "Test the LRU memory cache respects its size limit"
+        cache = MemoryCache(max_size=10)
+        cache.set('a', '12345')
+        cache.set('b', '12345')
+
+        # 'a' becomes the most recently used
+        self.assertEqual(cache.get('a'), '12345')
+
+        # so 'b' is evicted
+        cache.set('c', '12345')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), '12345')
+        self.assertEqual(cache.size, 10)
+
+        # Values bigger than the cache are not stored at all
+        cache.set('d', '12345678901')
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(len(cache), 2)
+
+        # Expired values are not returned
+        cache.set('e', '1', timeout=-1)
+        self.assertIsNone(cache.get('e'))
+
+    def test_filesystem_page_cache(self):
+        "Test the filesystem backend is shared between instances"
+        cache_dir = os.path.join(gettempdir(), 'test_page_cache-%s' %
+                        ''.join(map(str, random.sample(range(100), 5))))
+
+        cache = make_cache('filesystem', cache_dir=cache_dir)
+        make_cache('filesystem', cache_dir=cache_dir).set('key', 'value')
+        self.assertEqual(cache.get('key'), 'value')
+
+        cache.clear()
+        os.rmdir(cache_dir)
+
+    def test_benchmark(self):
+        "Test the benchmark drives every public path"
+        results = run_benchmark(posts=5, requests=2, warmup=0)
+        statuses = dict((name, stats['status']) for name, stats in
+                                            results['results'].items())
+        self.assertEqual(statuses, {'index': [200], 'index_page': [404],
+                                    'post': [200], 'post_id': [302],
+                                    'feed': [200], 'login': [200]})
+
+    def test_prefork_server(self):
+        "Test the production server recycles, reloads and stops its workers"
+        def free_port():
+            probe = socket.socket()
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+            probe.close()
+            return port
+
+        # The bind comes from the settings, reloaded on SIGHUP
+        settings = NamedTemporaryFile(suffix='.cfg')
+
+        def configure(port):
+            settings.seek(0)
+            settings.truncate()
+            settings.write("SERVER_BIND = '127.0.0.1:%d'\n" % port)
+            settings.flush()
+
+        port = free_port()
+        configure(port)
+        log = TemporaryFile()
+        server = subprocess.Popen([sys.executable, '-m', 'assentio.server',
+                                   '--workers', '2', '--max-requests', '2',
+                                   '--max-requests-jitter', '0',
+                                   '--read-timeout', '1'],
+                                  stderr=log,
+                                  env=dict(os.environ,
+                                           ASSENTIO_SETTINGS=settings.name))
+        self.addCleanup(lambda: server.poll() is None and server.kill())
+
+        def get(port, path='/static/css/style.css'):
+            for attempt in range(100):
+                try:
+                    connection = httplib.HTTPConnection('127.0.0.1', port)
+                    connection.request('GET', path)
+                    response = connection.getresponse()
+                    response.read()
+                    return response.status
+                except socket.error:
+                    time.sleep(0.1)
+
+        self.assertEqual([get(port) for i in range(6)], [200] * 6)
+        new_port = free_port()
+        configure(new_port)
+        server.send_signal(signal.SIGHUP)
+        self.assertEqual([get(new_port) for i in range(3)], [200] * 3)
+
+        # Clients sending nothing don't hold the workers
+        silent = [socket.create_connection(('127.0.0.1', new_port))
+                  for i in range(2)]
+        started = time.time()
+        self.assertEqual(get(new_port), 200)
+        self.assertLess(time.time() - started, 5)
+        for connection in silent:
+            connection.close()
+
+        server.send_signal(signal.SIGTERM)
+        self.assertEqual(server.wait(), 0)
+
+        log.seek(0)
+        output = log.read()
+        self.assertIn('with 2 workers', output)
+        self.assertIn('served 2 requests, recycling', output)
+        self.assertIn('Reloading', output)
+        self.assertIn('Listening on 127.0.0.1:%d' % new_port, output)
+        self.assertIn('127.0.0.1 - timed out', output)
+        self.assertNotIn('Traceback', output)
+        self.assertNotIn('stale', output)
+
+    def test_template_cache(self):
+        "Test the templates are compiled once, for every worker"
+        tmp = mkdtemp()
+        try:
+            app = self._get_an_app()
+            app.config['TEMPLATE_CACHE_DIR'] = tmp
+            compiled, errors = compile_templates(app)
+            self.assertEqual(errors, {})
+            self.assertIn('index.html', compiled)
+            self.assertIn('admin/master.html', compiled)
+            self.assertEqual(len(os.listdir(tmp)), len(compiled))
+            self.assertTrue(app.jinja_env.auto_reload)
+
+            def compile(*args, **kwargs):
+                raise AssertionError('Compiled again')
+
+            # Another worker loads the bytecode
+            app = self._get_an_app()
+            app.config['TEMPLATE_CACHE_DIR'] = tmp
+            app.config['TEMPLATES_AUTO_RELOAD'] = False
+            app.jinja_env.compile = compile
+            self.assertTrue(app.jinja_env.get_template('index.html'))
+            self.assertFalse(app.jinja_env.auto_reload)
+
+            # Broken files are compiled again
+            for name in os.listdir(tmp):
+                with open(os.path.join(tmp, name), 'r+b') as f:
+                    f.truncate(20)
+            app = self._get_an_app()
+            app.config['TEMPLATE_CACHE_DIR'] = tmp
+            self.assertTrue(app.jinja_env.get_template('index.html'))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_lazy_bootstrap(self):
+        "Test importing the package builds nothing, and the startup profile"
+        output = subprocess.check_output([sys.executable, '-c',
+                    'import sys, assentio\n'
+                    'print assentio._app is None, '
+                    '"flask_admin" in sys.modules'])
+        self.assertEqual(output.split(), ['True', 'False'])
+
+        # The commands import the apps they use only
+        output = subprocess.check_output([sys.executable, '-c',
+                    'import sys, assentio.manage\n'
+                    'print [name for name in ("wtforms", "flask_wtf", '
+                    '"PyRSS2Gen", "bcrypt", "flask_login") '
+                    'if name in sys.modules]'])
+        self.assertEqual(output.strip(), '[]')
+
+        script = os.path.join(os.path.dirname(base.__file__), os.pardir,
+                              'startup.py')
+        output = subprocess.check_output([sys.executable, script])
+        self.assertIn('Imports (ms)', output)
+        self.assertRegexpMatches(output, r'\d+\.\d  login')
+
+    def test_roles(self):
+        "Test the public role has no login, and the admin is mounted lazily"
+        endpoints = lambda app: set(rule.endpoint
+                                    for rule in app.url_map.iter_rules())
+
+        # The default role mounts the admin on its first request, the
+        # anonymous users don't receive a session
+        self.assertNotIn('adminview.index', endpoints(self.app))
+        self.assertNotIn('Set-Cookie', self.client.get('/').headers)
+        self.login(base.TESTUSER, base.TESTUSER)
+        res = self.client.get('/')
+        self.assertIn('href="/admin/"', res.data)
+        self.assertIn('adminview.index', endpoints(self.app))
+
+        os.environ['ASSENTIO_ROLE'] = 'public'
+        try:
+            public_app = self._get_an_app(with_new_db=True)
+        finally:
+            del os.environ['ASSENTIO_ROLE']
+        syncdb(public_app)
+        self.assertNotIn('login_manager', public_app.extensions)
+        self.assertNotIn('lazy_admin', public_app.extensions)
+
+        client = public_app.test_client()
+        res = client.get('/', headers={'Cookie': 'session=anything'})
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('href="/login/"', res.data)
+        self.assertNotIn('Set-Cookie', res.headers)
+        self.assertEqual(client.get('/login/').status_code, 404)
+        self.assertEqual(client.get('/admin/').status_code, 404)
+        self.assertEqual(client.get('/media/anything').data, 'OK')
+
+        class WrongRole(object):
+            ASSENTIO_ROLE = 'writer'
+        self.assertRaises(ValueError, create_flask_app,
+                          config_object=WrongRole)
+
     def test_sqlalchemy(self):
         "Test sqlalchemy is correctly instantiated"
         self.assertIn('sqlalchemy', self.app.extensions)
@@ -34,6 +472,57 @@ class AssentioComponentTestCase(base.BaseTestCase):
         res = self.client.get('%s/anything' % self.media_location)
         self.assertEqual(res.status_code, 200)
 
+    def test_media_serving(self):
+        "Test the media files support ranges, validators and precompression"
+        path = os.path.join(self.app.instance_path, 'media', 'sample.txt')
+        data = ''.join(str(i % 10) for i in range(1000))
+        with open(path, 'wb') as sample:
+            sample.write(data)
+        self.addCleanup(os.remove, path)
+
+        url = '%s/sample.txt' % self.media_location
+        res = self.client.get(url)
+        self.assertEqual(res.data, data)
+        self.assertEqual(res.headers['Accept-Ranges'], 'bytes')
+        etag = res.headers['ETag']
+
+        res = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+        res = self.client.get(url, headers={'Range': 'bytes=10-19'})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.data, data[10:20])
+        self.assertEqual(res.headers['Content-Range'], 'bytes 10-19/1000')
+
+        # A range of an older version gets the whole file
+        res = self.client.get(url, headers={'Range': 'bytes=10-19',
+                                            'If-Range': '"stale"'})
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client.get(url, headers={'Range': 'bytes=2000-'})
+        self.assertEqual(res.status_code, 416)
+
+        # The precompressed sibling is sent to the clients accepting it
+        with open(path + '.gz', 'wb') as compressed:
+            compressed.write('gzipped')
+        self.addCleanup(os.remove, path + '.gz')
+        res = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.data, 'gzipped')
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+        res = self.client.get(url)
+        self.assertEqual(res.data, data)
+
+        # The transfer can be delegated to the front server
+        self.app.config['MEDIA_SENDFILE'] = 'x-accel-redirect'
+        res = self.client.get(url)
+        self.assertEqual(res.headers['X-Accel-Redirect'],
+                         '/protected-media/sample.txt')
+        self.assertEqual(res.data, '')
+
+        res = self.client.get('%s/missing.txt' % self.media_location)
+        self.assertEqual(res.status_code, 404)
+
     def test_configurations(self):
         "Test handling configurations"
 
@@ -90,6 +579,181 @@ class AssentioComponentTestCase(base.BaseTestCase):
         # Trying with in-memory db
         self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
         syncdb(self.app)
+
+    def test_database_tuning(self):
+        "Test the sqlite pragmas and the timed pool of the database files"
+        tmp = mkdtemp()
+        try:
+            self.app.config['SQLALCHEMY_DATABASE_URI'] = \
+                                'sqlite:///%s' % os.path.join(tmp, 'tuned.db')
+            self.app.config['SQLITE_CACHE_SIZE'] = -4096
+            syncdb(self.app)
+            db = self.app.extensions['sqlalchemy'].db
+            engine = db.engine
+            self.assertEqual(engine.execute('PRAGMA journal_mode').scalar(),
+                             'wal')
+            self.assertEqual(engine.execute('PRAGMA cache_size').scalar(),
+                             -4096)
+            # NORMAL
+            self.assertEqual(engine.execute('PRAGMA synchronous').scalar(), 1)
+
+            stats = db.pool_stats()
+            self.assertEqual(stats['size'], 5)
+            self.assertTrue(stats['checkouts'] >= 3)
+
+            res = self.client.get('/')
+            res.close()
+            summary = self.app.extensions['instrumentation'].summary()
+            self.assertIn('pool_wait', summary[0])
+            engine.dispose()
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_read_replicas(self):
+        "Test the public reads go to the replicas, but for recent writers"
+        tmp = mkdtemp()
+        primary = os.path.join(tmp, 'primary.db')
+        replica = os.path.join(tmp, 'replica.db')
+        db = self.app.extensions['sqlalchemy'].db
+        try:
+            self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + primary
+            self.app.config['SQLITE_JOURNAL_MODE'] = 'DELETE'
+            db.session.remove()
+            syncdb(self.app)
+            adduser(base.TESTUSER, base.TESTUSER, self.app)
+            self.create_post('Hello world', 'Body', 'hello', state='public')
+            # The replica is in sync
+            db.engine.dispose()
+            shutil.copy(primary, replica)
+            self.app.config['SQLALCHEMY_REPLICAS'] = ['sqlite:///' + replica]
+
+            # Lagging behind
+            db.get_engine(self.app, ('replica', 0)).execute(
+                            "UPDATE post SET title = 'Stale world'")
+            res = self.client.get('/post/hello')
+            self.assertIn('Stale world', res.data)
+            db.session.remove()
+
+            # The writer reads from the primary
+            with self.app.test_request_context():
+                post = Post.query.first()
+                post.body = 'Changed'
+                post.save(self.app)
+                with db.reading():
+                    self.assertEqual(db.session.query(Post.title).scalar(),
+                                     'Hello world')
+            with self.app.test_request_context():
+                with db.reading():
+                    self.assertEqual(db.session.query(Post.title).scalar(),
+                                     'Stale world')
+            db.session.remove()
+
+            # The deadline is a signed cookie, also read by the public
+            # workers which never load the session
+            with self.app.test_request_context():
+                post = Post.query.first()
+                post.body = 'Changed again'
+                post.save(self.app)
+                response = self.app.process_response(
+                                                self.app.response_class())
+            cookie = response.headers['Set-Cookie'].split(';')[0]
+            self.assertTrue(cookie.startswith('primary_until='))
+            db.session.remove()
+            session_interface = self.app.session_interface
+            self.app.session_interface = NoSessions()
+            try:
+                for cookie, title in ((cookie, 'Hello world'), (
+                        'primary_until=%d.forged' % (time.time() + 60),
+                        'Stale world')):
+                    with self.app.test_request_context(
+                                                headers={'Cookie': cookie}):
+                        with db.reading():
+                            self.assertEqual(
+                                db.session.query(Post.title).scalar(), title)
+                    db.session.remove()
+            finally:
+                self.app.session_interface = session_interface
+
+            # The reads of a block go to a single replica, the next block
+            # moves on to the next one
+            replica_2 = os.path.join(tmp, 'replica_2.db')
+            shutil.copy(replica, replica_2)
+            self.app.config['SQLALCHEMY_REPLICAS'].append(
+                                                    'sqlite:///' + replica_2)
+            db.get_engine(self.app, ('replica', 1)).execute(
+                            "UPDATE post SET title = 'Other world'")
+            titles = set()
+            for block in range(2):
+                with self.app.test_request_context():
+                    with db.reading():
+                        title = db.session.query(Post.title).scalar()
+                        for query in range(3):
+                            self.assertEqual(
+                                db.session.query(Post.title).scalar(), title)
+                        titles.add(title)
+                db.session.remove()
+            self.assertEqual(titles, set(['Stale world', 'Other world']))
+
+            # Pages read from a replica right after an invalidation are kept
+            # for the replication lag only
+            self.app.config['SQLALCHEMY_REPLICA_LAG'] = 0.2
+            with self.app.test_request_context():
+                post = Post.query.first()
+                post.body = 'Changed once more'
+                post.save(self.app)
+            db.session.remove()
+            self.client.get('/post/hello').data
+            res = self.client.get('/post/hello')
+            self.assertEqual(res.headers.get('X-Page-Cache'), 'HIT')
+            time.sleep(0.3)
+            res = self.client.get('/post/hello')
+            self.assertNotIn('X-Page-Cache', res.headers)
+            res.data
+            db.session.remove()
+
+            # Replicas not answering are skipped from their next check
+            self.app.config['SQLALCHEMY_REPLICAS'] = \
+                                ['sqlite:///%s/missing/replica.db' % tmp]
+            self.app.extensions['db_replicas'].checked.clear()
+            with self.app.test_request_context():
+                with db.reading():
+                    self.assertEqual(db.session.query(Post.title).scalar(),
+                                     'Hello world')
+            self.assertIn(0, self.app.extensions['db_replicas'].down)
+        finally:
+            db.session.remove()
+            shutil.rmtree(tmp)
+
+    def test_migratedb(self):
+        "Test migratedb brings an outdated db up to date"
+        engine = self.app.extensions['sqlalchemy'].db.engine
+
+        # Nothing to do on a fresh db
+        self.assertEqual(migratedb(self.app), [])
+
+        # A db created before the indexes and the timestamps, built by hand
+        # as old sqlite versions can't drop columns
+        engine.execute('DROP INDEX ix_post_state_type_date')
+        engine.execute('DROP TABLE page')
+        engine.execute('CREATE TABLE page ('
+                       'id INTEGER NOT NULL, '
+                       'category VARCHAR(25) NOT NULL, '
+                       '"order" INTEGER NOT NULL, '
+                       'post_id INTEGER, '
+                       'PRIMARY KEY (id), '
+                       'FOREIGN KEY(post_id) REFERENCES post (id))')
+
+        self.assertItemsEqual(migratedb(self.app),
+                         ['Added column page.modified',
+                          'Created index ix_page_category_order',
+                          'Created index ix_post_state_type_date'])
+
+    def test_explain(self):
+        "Test the query plans of the public listings use the indexes"
+        plans = dict(explain(self.app))
+        for name in ('home page', 'feed', 'social buttons',
+                     'textportlet portlets'):
+            self.assertIn('USING INDEX ix_', repr(plans[name]))
         
 
         
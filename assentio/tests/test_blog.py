@@ -1,4 +1,9 @@
+import os
 import unittest
+from gzip import GzipFile
+from shutil import rmtree
+from tempfile import mkdtemp
+from cStringIO import StringIO
 from datetime import datetime, timedelta
 
 from werkzeug.urls import url_fix
@@ -6,8 +11,15 @@ from sqlalchemy.exc import IntegrityError
 
 from assentio.tests import base
 from assentio.tests.base import TESTUSER
-from assentio.manage import _syncdb as syncdb 
-from assentio.apps.blog import Post, Page, SocialButton, views
+from assentio.manage import (_syncdb as syncdb, _reindex as reindex,
+                             _export as export)
+from flask.ext.sqlalchemy import get_debug_queries
+
+from assentio.utils import brotli
+from assentio.images import Image
+
+from assentio.apps.blog import (Post, Page, SocialButton, TextPortlet, views,
+                                search)
 from assentio.apps.blog.base import BasePortlet
 from assentio.apps.blog.slots import PortletSlot
 
@@ -304,6 +316,38 @@ class BlogComponentTestCase(base.BaseTestCase):
         with self.assertRaises(NotImplementedError):
             test_portlet_2.get_template()
 
+    def test_portlet_rendering(self):
+        "Check the rendered portlets are cached until they change"
+
+        blog_app = self.app.extensions['blog']
+
+        portlet = TextPortlet()
+        portlet.title = 'Text <Portlet>'
+        portlet.body = '<b>body</b>'
+        portlet.save(self.app)
+
+        ctx = self._fake_user_context()
+        portlet = TextPortlet.query.first()
+
+        html = portlet.get_template()
+        self.assertIn('<b>body</b>', html)
+        self.assertIn('Text &lt;Portlet&gt;', html)
+        self.assertEqual(len(blog_app.portlets_cache), 1)
+
+        # The html is not rendered again
+        blog_app.portlets_cache.set('textportlet-%s' % portlet.id,
+                                    (portlet._modified, 'cached'))
+        self.assertEqual(portlet.get_template(), 'cached')
+
+        # until the portlet changes
+        portlet.body = 'changed'
+        portlet.save(self.app)
+        self.assertEqual(len(blog_app.portlets_cache), 0)
+
+        portlet = TextPortlet.query.first()
+        self.assertIn('changed', portlet.get_template())
+        ctx.pop()
+
     def test_slots(self):
         "Check slots working"
         
@@ -367,6 +411,93 @@ class BlogComponentTestCase(base.BaseTestCase):
 
         ctx.pop()
 
+    def test_slots_queries(self):
+        "Check the portlets of all the slots are loaded at once"
+
+        db = self.app.extensions['sqlalchemy'].db
+        blog_app = self.app.extensions['blog']
+
+        for name in ('left', 'right', 'bottom'):
+            slot = PortletSlot()
+            slot.name = name
+            for order in (2, 1):
+                portlet = TextPortlet()
+                portlet.title = '%s %d' % (name, order)
+                portlet.body = 'body'
+                portlet.order = order
+                portlet.state = 'public'
+                portlet.slot = slot
+                db.session.add(portlet)
+        db.session.commit()
+
+        ctx = self._fake_user_context()
+        queries = len(get_debug_queries())
+
+        for name in ('left', 'right', 'bottom', 'missing'):
+            portlets = blog_app.get_portlets_by_slot(name, ordered=True)
+            if name != 'missing':
+                self.assertEqual([p.title for p in portlets],
+                                 ['%s 1' % name, '%s 2' % name])
+
+        # One query for the slots, one for the text portlets
+        self.assertEqual(len(get_debug_queries()) - queries, 2)
+        ctx.pop()
+
+    def test_navigation_cache(self):
+        "Check the navigation is loaded once and kept until it changes"
+
+        for title in ('page_post_1', 'page_post_2'):
+            self.create_post(title, 'body', type='page', state='public')
+            page = Page()
+            page.post = Post.query.filter_by(title=title).first()
+            page.save(self.app)
+
+        blog_app = self.app.extensions['blog']
+
+        # The pages come with their posts in a single query
+        ctx = self._fake_user_context()
+        queries = len(get_debug_queries())
+        pages = blog_app.get_pages(ordered=True)
+        self.assertEqual([p.post.title for p in pages],
+                         ['page_post_1', 'page_post_2'])
+        self.assertEqual(len(get_debug_queries()) - queries, 1)
+
+        # The navigation is kept across requests
+        blog_app.get_navigation()
+        ctx.pop()
+
+        # checked against the stamps fetched for the page validators
+        ctx = self._fake_user_context()
+        queries = len(get_debug_queries())
+        blog_app.get_page_validators()
+        pages, buttons = blog_app.get_navigation()
+        self.assertEqual(len(get_debug_queries()) - queries, 1)
+        self.assertEqual(pages[0].post.title, 'page_post_1')
+        ctx.pop()
+
+        # until a post is changed
+        post = Post.query.filter_by(title='page_post_1').first()
+        post.title = 'renamed'
+        post.save(self.app)
+
+        ctx = self._fake_user_context()
+        pages, buttons = blog_app.get_navigation()
+        self.assertEqual(pages[0].post.title, 'renamed')
+        ctx.pop()
+
+        # even by another worker, this one isn't notified
+        db = self.app.extensions['sqlalchemy'].db
+        db.session.execute(Post.__table__.update().
+                           where(Post.title == 'renamed').values(
+                                title='renamed again',
+                                modified=datetime.now() + timedelta(1)))
+        db.session.commit()
+
+        ctx = self._fake_user_context()
+        pages, buttons = blog_app.get_navigation()
+        self.assertEqual(pages[0].post.title, 'renamed again')
+        ctx.pop()
+
     def test_rss(self):
         "Check the RSS feed is working"
 
@@ -391,6 +522,251 @@ class BlogComponentTestCase(base.BaseTestCase):
         # Ensure there's the full url in the link
         self.assertIn('http://localhost/post/2', res.data)
 
+    def test_rss_cache(self):
+        "Check the feed is kept serialized and paged"
+
+        feed = self.app.extensions['blog'].feed
+        feed.max_items = 2
+        feed.paged = True
+        feed.directory = mkdtemp()
+
+        self.create_post('post_1', 'post_body', state='public')
+        self.create_post('post_2', 'post_body', state='public')
+        self.create_post('post_3', 'post_body', state='public')
+
+        res = self.client.get('/feed')
+        self.assertEqual(res.data.count('<item>'), 2)
+        self.assertIn('href="http://localhost/feed?page=2" rel="next"',
+                      res.data)
+
+        # The older post is in the second page
+        res = self.client.get('/feed?page=2')
+        self.assertEqual(res.data.count('<item>'), 1)
+        self.assertIn('http://localhost/post/1', res.data)
+        self.assertIn('href="http://localhost/feed" rel="previous"',
+                      res.data)
+
+        # Pages out of the feed aren't built nor stored
+        for page in ('3', '0', '-1'):
+            res = self.client.get('/feed?page=%s' % page)
+            self.assertEqual(res.status_code, 404)
+
+        # The urls don't follow the Host of the request
+        res = self.client.get('/feed', base_url='http://other.host/')
+        self.assertIn('http://localhost/post/3', res.data)
+        self.assertNotIn('other.host', res.data)
+        self.assertEqual(sorted(feed.documents),
+                         [('http://localhost/', 1), ('http://localhost/', 2)])
+
+        # The gzipped copy is served to the clients accepting it
+        res = self.client.get('/feed', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        xml = GzipFile(fileobj=StringIO(res.data)).read()
+        self.assertEqual(xml, self.client.get('/feed').data)
+
+        # Unpublishing a post rebuilds only its item
+        items = feed.items
+        post = Post.query.filter_by(title='post_3').first()
+        post.state = 'private'
+        post.save(self.app)
+        self.assertNotIn(3, items)
+        self.assertIn(2, items)
+
+        res = self.client.get('/feed')
+        self.assertNotIn('http://localhost/post/3', res.data)
+        self.assertIn('http://localhost/post/1', res.data)
+
+        rmtree(feed.directory)
+
+    def test_rss_stale_items(self):
+        "Check the items of posts changed by other workers are built again"
+        feed = self.app.extensions['blog'].feed
+        self.create_post('post_1', 'post_body', state='public')
+        with self.app.test_request_context():
+            self.app.preprocess_request()
+            self.assertIn('post_1', feed.get_document('http://localhost/').xml)
+
+            # Committed by another worker, this one isn't notified
+            db = self.app.extensions['sqlalchemy'].db
+            db.session.execute(Post.__table__.update().values(
+                        title='post_1 changed',
+                        modified=datetime.now() + timedelta(seconds=1)))
+            db.session.commit()
+            self.assertIn(1, feed.items)
+
+            # Once the page expires
+            feed.documents.clear()
+            self.assertIn('post_1 changed',
+                          feed.get_document('http://localhost/').xml)
+
+    def test_search(self):
+        "Check the full-text search respects the posts visibility"
+
+        self.create_post('Flask tips', '<p>Using <b>blueprints</b></p>',
+                         state='public')
+        self.create_post('Hidden', 'More blueprints', state='private')
+        self.create_post('Other', 'Nothing to see', state='public')
+
+        # The body is indexed without its markup, matches are highlighted
+        res = self.client.get('/search?q=blueprint')
+        self.assertIn('Flask tips', res.data)
+        self.assertIn('<mark>blueprints</mark>', res.data)
+        self.assertNotIn('Hidden', res.data)
+        self.assertNotIn('Nothing to see', res.data)
+
+        # Private posts are found by authenticated users only
+        self.login(TESTUSER, TESTUSER)
+        res = self.client.get('/search?q=blueprints')
+        self.assertIn('Hidden', res.data)
+
+        # Edits are indexed, quotes in the terms are not a syntax error
+        post = Post.query.filter_by(title='Other').first()
+        post.body = 'Now with "blueprints" too'
+        post.save(self.app)
+        res = self.client.get('/search?q=%22blueprints')
+        self.assertIn('Other', res.data)
+
+        res = self.client.get('/search?q=nothing')
+        self.assertIn('No posts match', res.data)
+
+        # The index can be rebuilt from scratch
+        self.assertEqual(reindex(self.app), 3)
+        res = self.client.get('/search?q=blueprints')
+        self.assertEqual(res.data.count('<article'), 3)
+
+    def test_search_unavailable(self):
+        "Check the posts are saved without the search index"
+        db = self.app.extensions['sqlalchemy'].db
+
+        # A db created before the index
+        db.engine.execute('DROP TABLE post_search')
+        search._indexed.clear()
+        self.create_post('Flask tips', 'Using blueprints', state='public')
+        self.assertEqual(self.client.get('/search?q=flask').status_code, 404)
+
+        # Rebuilding it creates it
+        self.assertEqual(reindex(self.app), 1)
+        self.assertTrue(search._indexed[db.engine])
+        res = self.client.get('/search?q=flask')
+        self.assertIn('<mark>Flask</mark> tips', res.data)
+
+        # SQLite built without FTS5
+        search._fts5[db.engine] = False
+        try:
+            db.engine.execute('DROP TABLE post_search')
+            db.create_all()
+            self.assertFalse(db.engine.has_table('post_search'))
+            self.create_post('More tips', 'Using macros', state='public')
+            self.assertEqual(reindex(self.app), 0)
+            res = self.client.get('/search?q=flask')
+            self.assertEqual(res.status_code, 404)
+        finally:
+            del search._fts5[db.engine]
+
+    def test_export(self):
+        "Check the site is exported as static files, incrementally"
+
+        directory = mkdtemp()
+        for i in range(1, 6):
+            self.create_post('post_%d' % i, 'post_body', state='public')
+        self.create_post('draft', 'post_body')
+
+        counts = export(directory, app=self.app)
+        files = lambda: sorted(os.listdir(directory))
+
+        # Home, the older and newer posts listings, feed and the five posts
+        self.assertEqual(counts['rendered'], 9)
+        self.assertIn('index.html', files())
+        self.assertIn('index.html.gz', files())
+        self.assertIn('feed.xml', files())
+        suffixes = ('', '.gz', '.br') if brotli else ('', '.gz')
+        self.assertEqual(sorted(os.listdir(os.path.join(directory, 'post'))),
+                         sorted(['post_%d.html%s' % (i, suffix) for i in
+                                        range(1, 6) for suffix in suffixes]))
+        self.assertTrue([name for name in files()
+                                        if name.startswith('index.before=')])
+        with open(os.path.join(directory, 'redirects.conf')) as redirects:
+            self.assertIn('location = /post/1 { return 302 /post/post_1; }',
+                          redirects.read())
+
+        # Nothing changed, nothing is rendered again
+        counts = export(directory, app=self.app)
+        self.assertEqual(counts['rendered'], 0)
+        self.assertEqual(counts['unchanged'], 9)
+
+        # Unpublished posts are removed, with the listings not needed anymore
+        post = Post.query.filter_by(title='post_5').first()
+        post.state = 'private'
+        post.save(self.app)
+        counts = export(directory, app=self.app)
+        self.assertEqual(counts['removed'], 3)
+        self.assertEqual(counts['rendered'], 2)
+        self.assertNotIn('post_5.html',
+                         os.listdir(os.path.join(directory, 'post')))
+
+        rmtree(directory)
+
+    @unittest.skipIf(Image is None, 'Pillow is not installed')
+    def test_image_derivatives(self):
+        "Check the resized variants of the media images are used"
+        images = self.app.extensions['images']
+        path = os.path.join(images.media_path, 'landscape.jpg')
+        Image.new('RGB', (2000, 1000), 'red').save(path, 'JPEG')
+        self.addCleanup(os.remove, path)
+        self.addCleanup(rmtree, os.path.join(images.media_path, 'derived'),
+                        True)
+
+        self.create_post('image post', 'post_body', type='image',
+                         state='public')
+        post = Post.query.filter_by(title='image post').first()
+        post.image = '/media/landscape.jpg'
+        shortname = post.shortname
+        post.save(self.app)
+
+        # The original is sent until the variants are ready
+        res = self.client.get('/')
+        self.assertIn('src="/media/landscape.jpg"', res.data)
+        self.assertNotIn('srcset', res.data)
+        etag = res.headers['ETag']
+
+        info = images.submit(path).get()
+        self.assertEqual([width for url, width, height in info.variants],
+                         [320, 770, 1540])
+        self.assertEqual(info.variants[0][2], 160)
+        for url, width, height in info.variants:
+            self.assertTrue(os.path.exists(os.path.join(
+                images.media_path, url[len('/media/'):])))
+
+        res = self.client.get('/post/%s' % shortname)
+        self.assertIn('srcset="%s 320w' % info.variants[0][0], res.data)
+        self.assertIn('/media/landscape.jpg 2000w', res.data)
+        self.assertIn('width="2000" height="1000"', res.data)
+
+        # The pages rendered meanwhile are out of date
+        res = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('X-Page-Cache', res.headers)
+        self.assertIn('srcset="%s 320w' % info.variants[0][0], res.data)
+
+        # Photos are turned as their EXIF orientation says
+        path = os.path.join(images.media_path, 'portrait.jpg')
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        Image.new('RGB', (2000, 1000), 'red').save(path, 'JPEG',
+                                                   exif=exif.tobytes())
+        self.addCleanup(os.remove, path)
+        info = images.submit(path).get()
+        self.assertEqual((info.width, info.height), (1000, 2000))
+        self.assertEqual(info.variants[0][1:], (320, 640))
+        variant = Image.open(os.path.join(images.media_path,
+                                          info.variants[0][0][7:]))
+        self.assertEqual(variant.size, (320, 640))
+
+        # External images are left as they are
+        info = images.info('http://example.com/image.jpg')
+        self.assertEqual(info.attributes(),
+                         'src="http://example.com/image.jpg"')
+
         
 def test_suite():
     tests_classes = [
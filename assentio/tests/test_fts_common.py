@@ -1,15 +1,18 @@
 # -*- coding: utf-8 -*-
     
+import re
 import unittest
 
 from werkzeug.urls import url_fix
 from assentio.tests import base
 from assentio.tests.base import TESTUSER
 from assentio.apps.blog import Post
+from assentio.apps.blog.pagination import KeysetPagination
 
 STATUS_CODES = {'200': '200 OK',
                 '301': '301 MOVED PERMANENTLY',
                 '302': '302 FOUND',
+                '304': '304 NOT MODIFIED',
                 '400': '400 BAD REQUEST',
                 '403': '403 FORBIDDEN',
                 '404': '404 NOT FOUND'}
@@ -192,9 +195,12 @@ class AssentioFunctionalTestCase(base.BaseTestCase):
         res = self.client.get(self.admin_location)
         self.assertIn('Logout', res.data)
 
-        # and then logout
-        res = self.logout()
-        self.assertNotIn('_fresh', res.headers['Set-Cookie'])
+        # and then logout, anonymous responses don't send the session back
+        # so check the cookies set by the logout view itself
+        res = self.client.get(self.logout_location)
+        cookies = ''.join(res.headers.getlist('Set-Cookie'))
+        self.assertIn('session=', cookies)
+        self.assertNotIn('_fresh', cookies)
 
     def test_pagination(self):
         "Check the pagination is working"
@@ -226,6 +232,89 @@ class AssentioFunctionalTestCase(base.BaseTestCase):
         # the same :D
         self.assertEqual(res.status, STATUS_CODES['404'])
 
+    def test_keyset_pagination(self):
+        "Check the home page is walked through the cursors"
+
+        self.login(TESTUSER,TESTUSER)
+        for i in range(1, 7):
+            self.create_post('post-%d' % i, 'Post-%d' % i)
+
+        # The first page links the older posts only
+        res = self.client.get('/')
+        self.assertIn('post-6', res.data)
+        self.assertNotIn('post-2', res.data)
+        self.assertNotIn('after=', res.data)
+        older = re.search(r'href="(/\?before=[^"]+)"', res.data).group(1)
+
+        # The older page has the remaining posts and a link back
+        res = self.client.get(older)
+        self.assertIn('post-1', res.data)
+        self.assertNotIn('post-3', res.data)
+        self.assertNotIn('before=', res.data)
+        newer = re.search(r'href="(/\?after=[^"]+)"', res.data).group(1)
+
+        res = self.client.get(newer)
+        self.assertIn('post-6', res.data)
+        self.assertIn('post-3', res.data)
+        self.assertNotIn('post-2', res.data)
+
+        # Posts without a date are left out of the listing
+        db = self.app.extensions['sqlalchemy'].db
+        db.session.execute(Post.__table__.update().
+                           where(Post.title == 'post-6').values(date=None))
+        db.session.commit()
+        with self.app.test_request_context():
+            pagination = KeysetPagination(Post.query, per_page=10)
+            self.assertEqual([post.title for post in pagination.items],
+                             ['post-5', 'post-4', 'post-3', 'post-2',
+                              'post-1'])
+            self.assertEqual(pagination.next_cursor.split('-')[1], '1')
+            self.assertEqual(pagination.total, 5)
+
+        # Invalid cursors and empty pages are not found
+        res = self.client.get('/?before=not_a_cursor')
+        self.assertEqual(res.status, STATUS_CODES['404'])
+        res = self.client.get('/?before=19700101000000000000-1')
+        self.assertEqual(res.status, STATUS_CODES['404'])
+
+    def test_conditional_get(self):
+        "Check the clients copies are validated before rendering"
+        self.create_post('post-1', 'Post-1', state='public')
+        post = Post.query.filter_by(title='post-1').first()
+        urls = ('/', '/post/%s' % post.shortname, '/feed')
+        etags = {}
+
+        for url in urls:
+            res = self.client.get(url)
+            self.assertEqual(res.status, STATUS_CODES['200'])
+            etag = etags[url] = res.headers['ETag']
+            last_modified = res.headers['Last-Modified']
+
+            # The copy is still valid
+            res = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(res.status, STATUS_CODES['304'])
+            self.assertEqual(res.data, '')
+
+            res = self.client.get(url,
+                            headers={'If-Modified-Since': last_modified})
+            self.assertEqual(res.status, STATUS_CODES['304'])
+
+        # Changing the post invalidates all the copies
+        post = Post.query.filter_by(title='post-1').first()
+        post.title = 'post-1 changed'
+        post.save(self.app)
+
+        for url in urls:
+            res = self.client.get(url, headers={'If-None-Match': etags[url]})
+            self.assertEqual(res.status, STATUS_CODES['200'])
+
+        # Logged-in users get their own validators
+        res = self.client.get('/')
+        etag = res.headers['ETag']
+        self.login(TESTUSER, TESTUSER)
+        res = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(res.status, STATUS_CODES['200'])
+
     def test_caching(self):
         "Checking the Cache-Control header are correcly applyed"
 
@@ -1,8 +1,16 @@
+import time
 import unittest
+from threading import BoundedSemaphore
 
+import bcrypt
 from sqlalchemy.exc import IntegrityError
+from flask.ext.bcrypt import Bcrypt
+
+from assentio import db, create_flask_app
+from assentio.manage import _syncdb as syncdb
 from assentio.tests import base
 from assentio.apps.login import User
+from assentio.apps.login.hashing import cost_re, HashingBusy
 
 
 class UserComponentTestCase(base.BaseTestCase):
@@ -74,6 +82,106 @@ class UserComponentTestCase(base.BaseTestCase):
             # Assert the password is stored as plaintext
             self.assertEqual(user.password, 'test')
 
+    def test_password_hashing_pool(self):
+        "Test the passwords are hashed in the processes pool"
+
+        class PoolConfig(object):
+            TESTING = True
+            CSRF_ENABLED = False
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+            BCRYPT_LOG_ROUNDS = 4
+            PASSWORD_HASHING_PROCESSES = 1
+            LOGIN_CONCURRENCY_PER_IP = 1
+
+        local_app = create_flask_app(config_object=PoolConfig, db=db,
+                                     bcrypt=Bcrypt())
+        syncdb(local_app)
+        hasher = local_app.extensions['password_hasher']
+        self.addCleanup(hasher.pool.terminate)
+
+        # A password hashed with an older cost factor
+        with local_app.app_context():
+            old_hash = Bcrypt().generate_password_hash('secret', 5)
+        self.create_user('pooled', 'secret', local_app)
+        with local_app.app_context():
+            # Not through the Encrypted type, which would hash it again
+            db.session.execute("UPDATE user SET password = :password "
+                               "WHERE username = 'pooled'",
+                               {'password': old_hash})
+            db.session.commit()
+
+        client = local_app.test_client()
+        res = client.post('/login/', data={'username': 'pooled',
+                                           'password': 'secret'})
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(hasher.stats()['completed'], 3)
+
+        # Rehashed with the current cost factor
+        with local_app.app_context():
+            user = User.query.filter_by(username='pooled').first()
+            self.assertEqual(cost_re.match(user.password).group(1), '04')
+            self.assertFalse(hasher.needs_rehash(user.password))
+            self.assertTrue(user.check_password('secret'))
+            self.assertFalse(user.check_password('wrong'))
+
+        # A client can't run more logins than allowed
+        with hasher.client_slot('10.0.0.1'):
+            res = client.post('/login/', data={'username': 'pooled',
+                                               'password': 'secret'},
+                              environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '5')
+        self.assertEqual(hasher.stats()['rejected'], 1)
+        self.assertEqual(hasher.stats()['clients'], 0)
+
+        # A hashing the request stopped waiting for keeps its slot until
+        # it's over
+        slow_hash = bcrypt.hashpw('secret', bcrypt.gensalt(12))
+        hasher.slots = BoundedSemaphore(1)
+        hasher.timeout = 0.001
+        with local_app.app_context():
+            self.assertRaises(HashingBusy, hasher.check, slow_hash, 'secret')
+            self.assertEqual(hasher.stats()['pending'], 1)
+            hasher.timeout = 10
+            self.assertRaises(HashingBusy, hasher.check, slow_hash, 'secret')
+            self.assertEqual(hasher.stats()['rejected'], 2)
+            for attempt in range(50):
+                if not hasher.stats()['pending']:
+                    break
+                time.sleep(0.1)
+            self.assertTrue(hasher.check(slow_hash, 'secret'))
+
+    def test_user_cache(self):
+        "Test the logged-in user is loaded lazily, from the users cache"
+        self.mock_bcrypt()
+        self.login(base.TESTUSER, base.TESTUSER)
+        instrumentation = self.app.extensions['instrumentation']
+        user_cache = lambda endpoint: [(stats['user_cache_hits'],
+                                        stats['user_cache_misses'])
+                                    for stats in instrumentation.summary()
+                                    if stats['endpoint'] == endpoint][0]
+
+        # Assets don't need the user
+        self.client.get('/admin/static/css/admin.css').close()
+        self.assertEqual(user_cache('adminview.static'), (0, 0))
+
+        self.client.get('/').close()
+        self.assertEqual(user_cache('common.index'), (0, 1))
+        res = self.client.get('/')
+        self.assertIn(base.TESTUSER, res.data)
+        res.close()
+        self.assertEqual(user_cache('common.index'), (1, 1))
+
+        # Saving a user forgets its identity
+        with self.app.app_context():
+            user = User.query.filter_by(username=base.TESTUSER).first()
+            user.username = u'renamed'
+            user.save(self.app)
+        res = self.client.get('/')
+        self.assertIn('renamed', res.data)
+        res.close()
+        self.assertEqual(user_cache('common.index'), (1, 2))
+
     def test_user_on_g_object(self):
         "Checking the g object is correctly initialized for user auth"
        
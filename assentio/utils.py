@@ -1,3 +1,20 @@
+import os
+import gzip
+import errno
+import tempfile
+from time import mktime
+from datetime import datetime
+from cStringIO import StringIO
+
+from sqlalchemy import Column, DateTime
+from sqlalchemy.orm.attributes import instance_state
+from werkzeug.http import is_resource_modified
+from flask import current_app, request, session
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 # Mixin class for db.Model with some convenience methods
@@ -10,6 +27,92 @@ class DBMixin(object):
             app.extensions['sqlalchemy'].db.session.commit()
 
 
+# Mixin class for db.Model storing the last modification time
+class TimestampMixin(object):
+    # '_'-prefixed column name are not shown by flask-admin
+    _modified = Column('modified', DateTime, default=datetime.now,
+                       onupdate=datetime.now)
+
+
+def get_pk(instance):
+    "Return the primary key of a persisted instance, without loading it"
+    return instance_state(instance).key[1][0]
+
+
+def to_http_date(value):
+    "Convert a local naive datetime to the naive UTC one used by HTTP"
+    return datetime.utcfromtimestamp(mktime(value.timetuple()))
+
+
+def not_modified(etag, last_modified=None):
+    """Return a 304 response if the copy of the client is still valid,
+    None otherwise. It must be called before building the response."""
+    # Pending flash messages must be rendered
+    if '_flashes' in session:
+        return None
+
+    if is_resource_modified(request.environ, etag=etag,
+                                            last_modified=last_modified):
+        return None
+
+    return set_validators(current_app.response_class(status=304), etag,
+                                                            last_modified)
+
+
+def set_validators(response, etag, last_modified=None):
+    "Apply the ETag and Last-Modified headers to the response"
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
+
+def gzipped(data):
+    "Return the data gzipped at the highest level, with no timestamp"
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9,
+                       mtime=0) as compressed:
+        compressed.write(data)
+    return buf.getvalue()
+
+
+def write_atomic(path, data, precompress=False):
+    """Write the file through a temporary one renamed over it, so it's never
+    read half written. If precompress its .gz (and .br, if the brotli module
+    is installed) copies are written first"""
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError, error:
+        if error.errno != errno.EEXIST:
+            raise
+
+    files = []
+    if precompress:
+        files.append(('.gz', gzipped(data)))
+        if brotli:
+            files.append(('.br', brotli.compress(data)))
+    files.append(('', data))
+
+    for suffix, content in files:
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as stored:
+                stored.write(content)
+            os.chmod(tmp, 0644)
+            os.rename(tmp, path + suffix)
+        except Exception:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+
+def percentile(values, percent):
+    "Return the nearest-rank percentile of the sorted values"
+    index = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[index]
+
+
 # DateTime conversion template filter
 def datetimeformat(value, format="%d %B %Y"):
     "Format the datetime (default is in the format: '23 August 2012')"
@@ -45,6 +45,8 @@ setup(name='assentio',
       ],
       entry_points={
           'console_scripts': ['runserver = assentio.main:runserver',
-                              'manage = assentio.manage:manage']
+                              'serve = assentio.server:serve',
+                              'manage = assentio.manage:manage',
+                              'benchmark = assentio.benchmarks:main']
       }
       )